@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.utils.html import format_html
+from django.db import transaction
 from django.db.models import Count
 from django.urls import reverse
 from .models import (
@@ -8,6 +9,8 @@ from .models import (
     SavedListing, SavedSearch, Account, Role, RolePermission,
     AuditLog, Setting, CMSImage, Impression
 )
+from auto_app.utils.search_index import vehicle_index
+from auto_app.utils.similarity import refresh_worker
 
 
 # Inline admins for related models
@@ -142,12 +145,18 @@ class VehicleAdmin(admin.ModelAdmin):
 
     def publish_vehicles(self, request, queryset):
         from django.utils import timezone
+        pks = list(queryset.values_list('pk', flat=True))
         updated = queryset.update(published=True, published_date=timezone.now().date())
+        transaction.on_commit(lambda: vehicle_index.changed(pks))
+        transaction.on_commit(lambda: refresh_worker.enqueue(pks))
         self.message_user(request, f"{updated} vehicle(s) published successfully.")
     publish_vehicles.short_description = "Publish selected vehicles"
 
     def unpublish_vehicles(self, request, queryset):
+        pks = list(queryset.values_list('pk', flat=True))
         updated = queryset.update(published=False)
+        transaction.on_commit(lambda: vehicle_index.changed(pks))
+        transaction.on_commit(lambda: refresh_worker.enqueue(pks))
         self.message_user(request, f"{updated} vehicle(s) unpublished.")
     unpublish_vehicles.short_description = "Unpublish selected vehicles"
 
@@ -640,17 +649,18 @@ class ImpressionAdmin(admin.ModelAdmin):
         'id', 'vehicle_link', 'ip_address', 'location_display',
         'country_code', 'created_at'
     )
+    # no date_hierarchy or filters on the table's own values: they run
+    # DISTINCT queries over the whole table on every page load
     list_filter = (
-        'country', 'country_code',
         ('created_at', admin.DateFieldListFilter),
-        ('vehicle__seller', admin.RelatedOnlyFieldListFilter),
+        ('vehicle__seller', admin.RelatedFieldListFilter),
     )
     search_fields = (
         'ip_address', 'city', 'region', 'country',
         'vehicle__model__name', 'vehicle__make__name'
     )
     list_per_page = 100
-    date_hierarchy = 'created_at'
+    show_full_result_count = False
 
     fieldsets = (
         ('Vehicle Information', {
@@ -7,4 +7,4 @@ class AutoAppConfig(AppConfig):
     name = 'auto_app'
 
     def ready(self):
-        from . import signals
+        from . import checks, signals
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+
+LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches)
+def shared_cache_check(app_configs, **kwargs):
+    """
+    The role permission, entitlement and invalidation caches rely on every
+    worker seeing the same default cache.
+    """
+    if not getattr(settings, 'SHARED_CACHE_REQUIRED', False):
+        return []
+    backend = settings.CACHES.get('default', {}).get('BACKEND', LOCAL_CACHES[0])
+    if backend in LOCAL_CACHES:
+        return [Error(
+            f"The default cache ({backend}) is local to each process.",
+            hint="Set CACHE_URL to a shared Redis cache, or leave SHARED_CACHE_REQUIRED "
+                 "unset when running a single process.",
+            id='auto_app.E001',
+        )]
+    return []
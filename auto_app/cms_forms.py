@@ -1,6 +1,6 @@
 from auto_app.utils.serial import to_field_json
 from django.db.models.fields import NOT_PROVIDED
-from django.db import models
+from django.db import models, transaction
 import copy
 import datetime
 from django.core.files.base import ContentFile
@@ -64,7 +64,9 @@ class Field():
         field_json = to_field_json(self.name, self.model)
         model_field = self.model._meta.get_field(self.name)
         default = None
-        if not model_field.default is NOT_PROVIDED:
+        # callable defaults (dict, timezone.now) are evaluated per instance,
+        # not when the schema is built
+        if not model_field.default is NOT_PROVIDED and not callable(model_field.default):
             default = model_field.default
         return {
             "fieldname": self.name,
@@ -397,6 +399,23 @@ class JSONToModelParser(object):
                                 existing_instance.save()
                                 break
 
+    def updated(self):
+        """
+        Tells the caches kept fresh by signals about an update, which
+        ``QuerySet.update`` saves without sending any.
+        """
+        from auto_app.models import Role, RolePermission, Seller, Vehicle
+        from auto_app.utils.permissions import role_permissions
+        from auto_app.utils.search_index import vehicle_index
+        from auto_app.utils.similarity import refresh_worker
+
+        if self.model in (Role, RolePermission, Seller):
+            role_permissions.invalidate()
+        if self.model is Vehicle:
+            pk = self.instance.pk
+            transaction.on_commit(lambda: vehicle_index.changed([pk]))
+            transaction.on_commit(lambda: refresh_worker.enqueue([pk]))
+
     def update(self):
         # check for changes
         parent = copy.deepcopy(self.cleaned_data)
@@ -404,6 +423,7 @@ class JSONToModelParser(object):
 
         self.model.objects.filter(pk=self.instance.pk).update(**parent, updated_by=self.user)
         self.instance = self.model.objects.get(pk=self.instance.pk)
+        self.updated()
         draft = False
 
         for k, v in db_values.items():
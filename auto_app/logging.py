@@ -1,81 +1,299 @@
-import boto3
+"""
+Non-blocking, structured logging.
+
+Loggers routed to the ``queue`` handler in LOGGING (``auto_app``,
+``billing`` and ``django.request``) hand their records to QueueHandler,
+which only puts them on a bounded in-memory queue, so request threads
+never wait on log I/O. A background listener drains the queue in batches
+of up to ``LOG_BATCH_SIZE`` records and writes them as JSON lines to
+``LOG_DIR/autohaus.jsonl``, rotated every ``LOG_MAX_BYTES``, and to the
+console when ``LOG_CONSOLE`` is set.
+
+``LOG_REMOTE_SINK`` optionally ships the lines elsewhere in batches of
+``LOG_REMOTE_BATCH_SIZE`` or every ``LOG_REMOTE_INTERVAL`` seconds, e.g.
+to CloudWatch with CloudWatchSink, to a collector with HTTPSink, or to
+MemorySink to stub it out locally::
+
+    LOG_REMOTE_SINK = {
+        'BACKEND': 'auto_app.logging.CloudWatchSink',
+        'OPTIONS': {'log_group': 'Autohaus', 'log_stream': 'app-logs', 'region': 'af-south-1'},
+    }
+
+When the queue is full, records are dropped and counted rather than
+waiting for room.
+"""
+import atexit
+import json
 import logging
-from datetime import datetime
-import watchtower
-import os
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+# attributes every LogRecord has, anything else was passed in ``extra``
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one line of JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class BatchFileHandler(logging.handlers.RotatingFileHandler):
+    """Writes a batch of records with one flush, rotating as it goes"""
+
+    def write_batch(self, records):
+        with self.lock:
+            if self.stream is None:
+                self.stream = self._open()
+            for record in records:
+                try:
+                    line = self.format(record) + self.terminator
+                    if self.maxBytes and self.stream.tell() + len(line) >= self.maxBytes:
+                        self.doRollover()
+                        if self.stream is None:
+                            self.stream = self._open()
+                    self.stream.write(line)
+                except Exception:
+                    self.handleError(record)
+            self.stream.flush()
+
+
+class MemorySink:
+    """Keeps the batches it is sent, for development and tests"""
+
+    def __init__(self):
+        self.batches = []
+
+    def send(self, events):
+        self.batches.append([line for _, line in events])
+
+
+class HTTPSink:
+    """POSTs each batch as newline delimited JSON"""
+
+    def __init__(self, url, timeout=5, headers=None):
+        self.url = url
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/x-ndjson', **(headers or {})}
+
+    def send(self, events):
+        body = '\n'.join(line for _, line in events).encode()
+        request = urllib.request.Request(self.url, data=body, headers=self.headers, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+class CloudWatchSink:
+    """Puts each batch to a CloudWatch Logs stream, creating it if needed"""
 
+    def __init__(self, log_group, log_stream, region=None):
+        self.log_group = log_group
+        self.log_stream = log_stream
+        self.region = region
+        self._client = None
 
-class CloudWatchLogger:
-    def __init__(self, log_group_name, log_stream_name=None, region=None):
-        """
-        Initialize CloudWatch logger
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
 
-        Args:
-            log_group_name (str): Name of the CloudWatch log group
-            log_stream_name (str): Name of the log stream (defaults to datetime)
-            region (str): AWS region for CloudWatch
-        """
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.INFO)
+            self._client = boto3.client('logs', region_name=self.region)
+            try:
+                self._client.create_log_stream(logGroupName=self.log_group, logStreamName=self.log_stream)
+            except self._client.exceptions.ResourceAlreadyExistsException:
+                pass
+        return self._client
 
-        # Clear any existing handlers
-        self.logger.handlers = []
+    def send(self, events):
+        self.client.put_log_events(
+            logGroupName=self.log_group,
+            logStreamName=self.log_stream,
+            logEvents=[{'timestamp': int(created * 1000), 'message': line} for created, line in events],
+        )
 
-        # Create log stream name if not provided
-        if not log_stream_name:
-            log_stream_name = datetime.now().strftime('%Y/%m/%d/%H/%M/%S')
 
-        # Create CloudWatch handler
+def create_sink():
+    config = getattr(settings, 'LOG_REMOTE_SINK', None)
+    if not config:
+        return None
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+def create_handlers():
+    formatter = JSONFormatter()
+    directory = Path(getattr(settings, 'LOG_DIR', Path(settings.BASE_DIR) / 'logs'))
+    directory.mkdir(parents=True, exist_ok=True)
+    file_handler = BatchFileHandler(
+        directory / 'autohaus.jsonl',
+        maxBytes=getattr(settings, 'LOG_MAX_BYTES', 10 * 1024 * 1024),
+        backupCount=getattr(settings, 'LOG_BACKUP_COUNT', 5),
+        encoding='utf-8',
+        delay=True,
+    )
+    file_handler.setFormatter(formatter)
+    handlers = [file_handler]
+    if getattr(settings, 'LOG_CONSOLE', False):
+        console = logging.StreamHandler()
+        console.setFormatter(formatter)
+        handlers.append(console)
+    return handlers
+
+
+class LogPipeline:
+    """The queue records wait on and the thread writing them out"""
+
+    def __init__(self):
+        self.queue = None
+        self.handlers = None
+        self.sink = None
+        self.dropped = 0
+        self._pending = []
+        self._sent = time.monotonic()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self.queue is None:
+                self.queue = queue.Queue(maxsize=getattr(settings, 'LOG_QUEUE_SIZE', 10000))
+                self.handlers = create_handlers()
+                self.sink = create_sink()
+                atexit.register(self.stop)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='log-listener', daemon=True)
+                self._thread.start()
+
+    def put(self, record):
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
         try:
-            cloudwatch_handler = watchtower.CloudWatchLogHandler(
-                log_group_name=log_group_name,
-                stream_name=log_stream_name,
-                boto3_client=boto3.client('logs')
-            )
-
-            # Set log format
-            formatter = logging.Formatter(
-                '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-            )
-            cloudwatch_handler.setFormatter(formatter)
-
-            # Add handler to logger
-            self.logger.addHandler(cloudwatch_handler)
-
-            # Optionally add console handler for local debugging
-            console_handler = logging.StreamHandler()
-            console_handler.setFormatter(formatter)
-            self.logger.addHandler(console_handler)
-
-        except Exception as e:
-            print(f"Error setting up CloudWatch logging: {str(e)}")
-            raise
-
-    def info(self, message):
-        """Log info level message"""
-        self.logger.info(message)
-
-    def error(self, message):
-        """Log error level message"""
-        self.logger.error(message)
-
-    def warning(self, message):
-        """Log warning level message"""
-        self.logger.warning(message)
-
-    def debug(self, message):
-        """Log debug level message"""
-        self.logger.debug(message)
-
-    def critical(self, message):
-        """Log critical level message"""
-        self.logger.critical(message)
-
-
-'''logger = CloudWatchLogger(
-    log_group_name='Autohaus',
-    log_stream_name='app-logs',
-    region='af-south-1'
-)'''
-
-logger = logging.getLogger(__file__)
\ No newline at end of file
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        batch_size = getattr(settings, 'LOG_BATCH_SIZE', 500)
+        interval = getattr(settings, 'LOG_REMOTE_INTERVAL', 5)
+        while True:
+            try:
+                records = [self.queue.get(timeout=interval)]
+            except queue.Empty:
+                records = []
+            while records and records[-1] is not None and len(records) < batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = bool(records) and records[-1] is None
+            records = [record for record in records if record is not None]
+            try:
+                self.write(records, force=stopping)
+            finally:
+                for _ in range(len(records) + stopping):
+                    self.queue.task_done()
+            if stopping:
+                return
+
+    def write(self, records, force=False):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"Dropped {dropped} log records, the queue was full",
+            }))
+        for handler in self.handlers if records else []:
+            try:
+                if isinstance(handler, BatchFileHandler):
+                    handler.write_batch(records)
+                else:
+                    for record in records:
+                        if record.levelno >= handler.level:
+                            handler.handle(record)
+            except Exception as e:
+                print(f"Failed to write log records: {str(e)}", file=sys.stderr)
+
+        if self.sink is None:
+            return
+        formatter = self.handlers[0].formatter
+        self._pending.extend((record.created, formatter.format(record)) for record in records)
+        due = time.monotonic() - self._sent >= getattr(settings, 'LOG_REMOTE_INTERVAL', 5)
+        batch_size = getattr(settings, 'LOG_REMOTE_BATCH_SIZE', 500)
+        while self._pending and (force or due or len(self._pending) >= batch_size):
+            events, self._pending = self._pending[:batch_size], self._pending[batch_size:]
+            try:
+                self.sink.send(events)
+            except Exception as e:
+                print(f"Failed to send {len(events)} log lines: {str(e)}", file=sys.stderr)
+            self._sent = time.monotonic()
+
+    def flush(self):
+        """Waits until every queued record has been written"""
+        if self.queue is not None and self._thread is not None and self._thread.is_alive():
+            self.queue.join()
+
+    def stop(self):
+        """Writes out the queued records and stops the listener"""
+        if self.queue is None or self._thread is None or not self._thread.is_alive():
+            return
+        self.queue.put(None)
+        self._thread.join(timeout=getattr(settings, 'LOG_SHUTDOWN_TIMEOUT', 5))
+
+
+pipeline = LogPipeline()
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the pipeline without waiting"""
+
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(None)
+        self.setLevel(level)
+
+    def prepare(self, record):
+        # resolve the message and traceback now, the listener runs later
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = JSONFormatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        pipeline.put(record)
+
+
+def queue_handler(level=logging.NOTSET):
+    """Handler factory for LOGGING"""
+    return QueueHandler(level)
+
+
+logger = logging.getLogger('auto_app')
@@ -0,0 +1,65 @@
+"""
+Management command to compile an IP range CSV into the geolocation database
+read by auto_app.utils.geoip.
+
+Each row is ``start,end,country_code,country,region,city,lat,lon`` with the
+first and last address of the range, IPv4 or IPv6; a header row and rows
+whose first column isn't an address are skipped. Running web processes pick
+up the new file within a minute:
+    python manage.py build_geoip_database ranges.csv
+"""
+import csv
+import ipaddress
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from auto_app.utils import geoip
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_ranges(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if len(row) < 2:
+                continue
+            try:
+                start = ipaddress.ip_address(row[0].strip())
+                end = ipaddress.ip_address(row[1].strip())
+            except ValueError:
+                continue
+            row = [value.strip() for value in row[2:]] + [''] * 6
+            yield start, end, {
+                'country_code': row[0],
+                'country': row[1],
+                'region': row[2],
+                'city': row[3],
+                'lat': parse_float(row[4]),
+                'lon': parse_float(row[5]),
+            }
+
+
+class Command(BaseCommand):
+    help = 'Compile an IP range CSV into the local geolocation database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='CSV of IP ranges and their locations')
+        parser.add_argument(
+            '--output', default=None,
+            help='Database file to write, defaults to settings.GEOIP_DATABASE'
+        )
+
+    def handle(self, *args, **options):
+        output = options['output'] or getattr(settings, 'GEOIP_DATABASE', None)
+        if not output:
+            raise CommandError("No output file given and GEOIP_DATABASE is not set")
+        try:
+            count = geoip.write_database(output, read_ranges(options['csv_file']))
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} IP ranges to {output}"))
@@ -0,0 +1,44 @@
+"""
+Management command to garbage collect unreferenced image files.
+
+Removes the stored images no VehiclePhoto or CMSImage has used for
+BLOB_GC_GRACE seconds, with their thumbnails and variants. Run it from cron:
+    python manage.py collect_blobs
+Add --recount to rebuild the reference counts from the image rows first.
+"""
+
+from django.core.management.base import BaseCommand
+from auto_app.utils import blobs
+
+
+class Command(BaseCommand):
+    help = 'Delete image files that no photo or CMS image references'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Blobs deleted per transaction, defaults to BLOB_GC_BATCH_SIZE'
+        )
+        parser.add_argument(
+            '--grace', type=int, default=None,
+            help='Seconds a blob must have been unreferenced, defaults to BLOB_GC_GRACE'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0.0,
+            help='Seconds to sleep between batches'
+        )
+        parser.add_argument(
+            '--recount', action='store_true',
+            help='Recompute the reference counts from the image rows first'
+        )
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            changed = blobs.recount()
+            self.stdout.write(f"Repaired {changed} reference counts")
+        count, freed = blobs.collect(
+            batch_size=options['batch_size'],
+            grace=options['grace'],
+            pause=options['pause'],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Deleted {count} blobs, freed {freed} bytes"))
@@ -0,0 +1,43 @@
+"""
+Management command to enforce the impression retention window.
+
+Rolls up outstanding impressions, then deletes (and optionally archives)
+raw impressions older than IMPRESSION_RETENTION_DAYS in small chunks.
+Run it daily from cron:
+    python manage.py compact_impressions --archive-dir /var/backups/impressions
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from auto_app.utils import retention
+
+
+class Command(BaseCommand):
+    help = 'Roll up and delete raw impressions older than the retention window'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help='Keep raw impressions this many days, defaults to IMPRESSION_RETENTION_DAYS'
+        )
+        parser.add_argument(
+            '--archive-dir', default=getattr(settings, 'IMPRESSION_ARCHIVE_DIR', None),
+            help='Write deleted impressions to gzipped JSON lines files in this directory'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help='Impressions deleted per transaction'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0.0,
+            help='Seconds to sleep between chunks'
+        )
+
+    def handle(self, *args, **options):
+        count = retention.compact(
+            days=options['days'],
+            archive_dir=options['archive_dir'],
+            chunk_size=options['chunk_size'],
+            pause=options['pause'],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Deleted {count} impressions"))
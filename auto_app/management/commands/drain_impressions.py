@@ -0,0 +1,18 @@
+"""
+Management command to ingest impressions left in the spool directory.
+
+The web workers drain their own spool files when idle; run this to pick up
+files left behind by a process that exited before it could:
+    python manage.py drain_impressions
+"""
+
+from django.core.management.base import BaseCommand
+from auto_app.utils.impressions import drain_spool
+
+
+class Command(BaseCommand):
+    help = 'Ingest spooled impression records'
+
+    def handle(self, *args, **options):
+        count = drain_spool()
+        self.stdout.write(self.style.SUCCESS(f"Ingested {count} spooled impressions"))
@@ -0,0 +1,34 @@
+"""
+Management command to create the thumbnails and responsive variants of
+images that don't have them.
+
+Jobs are queued in memory by the web process, so images saved just before a
+restart can be left unprocessed, and images uploaded before variants
+existed have none; run this to catch up:
+    python manage.py generate_image_variants
+"""
+
+from django.core.management.base import BaseCommand
+from auto_app.models import VehiclePhoto, CMSImage
+from auto_app.utils import thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Create missing thumbnails and image variants'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes')
+        parser.add_argument('--batch-size', type=int, default=200, help='Images per batch')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        processed = 0
+        with thumbnails.process_pool(options['workers']) as executor:
+            for model in (VehiclePhoto, CMSImage):
+                pks = [
+                    instance.pk for instance in model.objects.exclude(**{model.image_field: ''}).iterator()
+                    if thumbnails.needs_processing(instance)
+                ]
+                for start in range(0, len(pks), batch_size):
+                    processed += thumbnails.generate(model, pks[start:start + batch_size], executor)
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} images"))
@@ -0,0 +1,32 @@
+"""
+Management command to upload vehicle photos missing from the CDN.
+
+Photos are offloaded in the background once their thumbnail is rendered;
+this picks up any left behind, e.g. by a restart or a CDN outage:
+    python manage.py offload_photos --workers 8
+"""
+
+from django.core.management.base import BaseCommand
+from auto_app.utils import cdn
+
+
+class Command(BaseCommand):
+    help = 'Upload vehicle photos and thumbnails that are not on the CDN yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Concurrent uploads, defaults to CDN_WORKERS'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=200,
+            help='Photos offloaded per batch'
+        )
+
+    def handle(self, *args, **options):
+        pks = list(cdn.pending().order_by('pk').values_list('pk', flat=True))
+        offloaded = 0
+        with cdn.upload_pool(options['workers']) as executor:
+            for i in range(0, len(pks), options['batch_size']):
+                offloaded += cdn.offload(pks[i:i + options['batch_size']], executor)
+        self.stdout.write(self.style.SUCCESS(f"Offloaded {offloaded} of {len(pks)} photos"))
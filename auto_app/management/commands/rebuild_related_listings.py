@@ -0,0 +1,18 @@
+"""
+Management command to recompute the related listings table from scratch.
+
+Saving a vehicle refreshes the table incrementally; run this after a bulk
+import or to re-normalize the price/year/mileage features:
+    python manage.py rebuild_related_listings
+"""
+
+from django.core.management.base import BaseCommand
+from auto_app.utils import similarity
+
+
+class Command(BaseCommand):
+    help = 'Recompute the precomputed related listings of every published vehicle'
+
+    def handle(self, *args, **options):
+        count = similarity.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Computed related listings for {count} vehicles"))
@@ -0,0 +1,77 @@
+"""
+Management command to report per view request metrics.
+
+Prints the request count, queries, database time, serialization time and
+response size of each view, merged across every process, heaviest first:
+    python manage.py request_metrics
+    python manage.py request_metrics --sort db_ms --histograms
+    python manage.py request_metrics --json
+    python manage.py request_metrics --reset
+"""
+
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from auto_app.utils import metrics
+
+
+class Command(BaseCommand):
+    help = 'Report per view query counts, database time, serialization time and response sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sort', default='queries', choices=list(metrics.BUCKETS) + ['count'],
+            help='Metric to order the views by, by its mean'
+        )
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help='Only show this many views'
+        )
+        parser.add_argument(
+            '--histograms', action='store_true',
+            help='Print the histogram of each metric'
+        )
+        parser.add_argument(
+            '--json', action='store_true',
+            help='Print the report as JSON'
+        )
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Drop the metrics recorded so far'
+        )
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            metrics.reset()
+            self.stdout.write(self.style.SUCCESS("Request metrics reset"))
+            return
+
+        report = metrics.summary()
+        sort = options['sort']
+        views = sorted(
+            report.items(),
+            key=lambda item: item[1]['count'] if sort == 'count' else item[1][sort]['mean'],
+            reverse=True,
+        )[:options['limit']]
+
+        if options['json']:
+            self.stdout.write(json.dumps(dict(views), indent=2))
+            return
+        if not views:
+            self.stdout.write("No requests recorded")
+            return
+
+        budget = getattr(settings, 'REQUEST_QUERY_BUDGET', 50)
+        for view, entry in views:
+            self.stdout.write(self.style.MIGRATE_HEADING(view))
+            self.stdout.write(f"  requests: {entry['count']}, over the budget of {budget} queries: {entry['over_budget']}")
+            for name in metrics.BUCKETS:
+                metric = entry[name]
+                self.stdout.write(
+                    f"  {name}: mean {metric['mean']}, p50 {metric['p50']}, p95 {metric['p95']}, "
+                    f"p99 {metric['p99']}, max {metric['max']}"
+                )
+                if options['histograms']:
+                    buckets = ', '.join(f"{label}: {n}" for label, n in metric['histogram'].items() if n)
+                    self.stdout.write(f"    {buckets}")
@@ -0,0 +1,24 @@
+"""
+Management command to add new impressions to the hourly and daily rollups.
+
+Only impressions inserted since the previous run are read, so it is cheap to
+run often, e.g. every few minutes from cron:
+    python manage.py rollup_impressions
+"""
+
+from django.core.management.base import BaseCommand
+from auto_app.utils import rollups
+
+
+class Command(BaseCommand):
+    help = 'Aggregate new impressions into the hourly and daily rollup tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Impressions to aggregate per transaction'
+        )
+
+    def handle(self, *args, **options):
+        count = rollups.rollup(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {count} impressions"))
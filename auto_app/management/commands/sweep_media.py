@@ -0,0 +1,47 @@
+"""
+Management command to sweep up abandoned uploads.
+
+Deletes stale temporary vehicles, photos never attached to a vehicle,
+abandoned chunked uploads, unreferenced image blobs and files no row
+refers to, in batches, and reports the space reclaimed. Run it daily:
+    python manage.py sweep_media
+"""
+
+from django.core.management.base import BaseCommand
+from auto_app.utils import cleanup
+
+
+class Command(BaseCommand):
+    help = 'Delete orphaned photos, stale temporary vehicles and unreferenced media files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Rows or files deleted per batch, defaults to SWEEP_BATCH_SIZE'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Concurrent file deletions, defaults to SWEEP_WORKERS'
+        )
+        parser.add_argument(
+            '--grace', type=int, default=None,
+            help='Seconds a file must have been unused, defaults to BLOB_GC_GRACE'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0.0,
+            help='Seconds to sleep between batches of rows'
+        )
+
+    def handle(self, *args, **options):
+        report = cleanup.sweep(
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            grace=options['grace'],
+            pause=options['pause'],
+        )
+        self.stdout.write(f"Temporary vehicles: {report['temporary_vehicles']}")
+        self.stdout.write(f"Orphaned photos: {report['orphan_photos']}")
+        self.stdout.write(f"Abandoned uploads: {report['uploads']}")
+        self.stdout.write(f"Unreferenced blobs: {report['blobs']}")
+        self.stdout.write(f"Untracked files: {report['untracked_files']}")
+        self.stdout.write(self.style.SUCCESS(f"Reclaimed {report['bytes_freed']} bytes"))
@@ -0,0 +1,105 @@
+import re
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from auto_app.logging import logger
+from auto_app.utils.metrics import request_metrics
+
+
+LITERAL = re.compile(r"'(?:[^']|'')*'")
+PLACEHOLDERS = re.compile(r"%s(?:, %s){3,}")
+
+
+def sql_template(sql):
+    """
+    The statement as it is logged. Django passes the wrappers the query
+    with ``%s`` placeholders and the values apart, but raw SQL can still
+    inline them, so quoted literals are masked too. Long ``IN`` lists are
+    shortened to their first placeholders.
+    """
+    sql = LITERAL.sub("'?'", sql)
+    sql = PLACEHOLDERS.sub('%s, %s, ...', sql)
+    return ' '.join(sql.split())
+
+
+class QueryTimer:
+    """Database execute wrapper counting and timing a request's queries"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.seconds += elapsed
+            if elapsed * 1000 >= getattr(settings, 'SLOW_QUERY_MS', 200):
+                # never the params, they hold the users' data
+                logger.warning(f"Slow query ({elapsed * 1000:.0f} ms): {sql_template(sql)[:500]}")
+
+
+class InstrumentationMiddleware:
+    """
+    Records the queries, database time, serialization time and response
+    size of every request in auto_app.utils.metrics, and logs requests that
+    run more than REQUEST_QUERY_BUDGET queries.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'REQUEST_METRICS_ENABLED', True):
+            return self.get_response(request)
+
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in settings.DATABASES:
+                stack.enter_context(connections[alias].execute_wrapper(timer))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return response
+        view = f"{request.method} {match.route}"
+        budget = getattr(settings, 'REQUEST_QUERY_BUDGET', 50)
+        over_budget = timer.count > budget
+        if over_budget:
+            logger.warning(
+                f"{view} ran {timer.count} queries ({timer.seconds * 1000:.0f} ms), "
+                f"over the budget of {budget}: {request.get_full_path()}"
+            )
+
+        if response.streaming:
+            size = int(response.get('Content-Length') or 0)
+        else:
+            size = len(response.content)
+        request_metrics.record(
+            view,
+            over_budget=over_budget,
+            queries=timer.count,
+            db_ms=timer.seconds * 1000,
+            serialization_ms=getattr(request, '_render_seconds', 0.0) * 1000,
+            duration_ms=duration * 1000,
+            response_bytes=size,
+        )
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF and template responses render after the view returns
+        started = time.perf_counter()
+
+        def rendered(response):
+            request._render_seconds = time.perf_counter() - started
+
+        response.add_post_render_callback(rendered)
+        return response
@@ -1,9 +1,15 @@
-from django.contrib.auth.models import User
-from rest_framework.authtoken.models import Token
 from django.http import JsonResponse
+from auto_app.utils.authentication import token_cache
 
 
 class TokenAuthMiddleware:
+    """
+    Authenticates ``Authorization: Token`` requests to plain Django views
+    through ``token_cache``. It isn't in MIDDLEWARE: the API views
+    authenticate with CachedTokenAuthentication, and this would answer 401
+    to a stale token on every view, public ones included.
+    """
+
     def __init__(self, get_response):
         self.get_response = get_response
 
@@ -15,17 +21,15 @@ class TokenAuthMiddleware:
             # Extract the token
             token_key = auth_header.split(' ')[1]
 
-            try:
-                # Get the token object
-                token = Token.objects.select_related('user').get(key=token_key)
-
-                # Set the authenticated user on the request
-                request.user = token.user
-
-            except Token.DoesNotExist:
+            # Get the token object
+            token = token_cache.get(token_key)
+            if token is None:
                 return JsonResponse(
                     {'error': 'Invalid or expired token'},
                     status=401
                 )
 
+            # Set the authenticated user on the request
+            request.user = token.user
+
         return self.get_response(request)
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auto_app', '0026_create_impression_model'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['price', 'id'], name='auto_app_ve_price_d7d21a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['year', 'id'], name='auto_app_ve_year_9a2a0c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['mileage', 'id'], name='auto_app_ve_mileage_b56b60_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['created_at', 'id'], name='auto_app_ve_created_7183af_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auto_app', '0027_vehicle_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedVehicle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_to', to='auto_app.vehicle')),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_entries', to='auto_app.vehicle')),
+            ],
+            options={
+                'ordering': ['vehicle', 'rank'],
+                'indexes': [models.Index(fields=['vehicle', 'rank'], name='auto_app_re_vehicle_83637c_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:06
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auto_app', '0028_relatedvehicle'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='impression',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
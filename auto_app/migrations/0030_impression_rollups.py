@@ -0,0 +1,57 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auto_app', '0029_impression_created_at_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('position', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyImpressionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('city', models.CharField(blank=True, default='', max_length=255)),
+                ('region', models.CharField(blank=True, default='', max_length=255)),
+                ('impressions', models.PositiveIntegerField(default=0)),
+                ('visitors', models.PositiveIntegerField(default=0)),
+                ('date', models.DateField()),
+                ('seller', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='auto_app.seller')),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auto_app.vehicle')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['seller', 'date'], name='auto_app_da_seller__664ff6_idx'), models.Index(fields=['date'], name='auto_app_da_date_e272f4_idx')],
+                'unique_together': {('vehicle', 'city', 'region', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='HourlyImpressionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('city', models.CharField(blank=True, default='', max_length=255)),
+                ('region', models.CharField(blank=True, default='', max_length=255)),
+                ('impressions', models.PositiveIntegerField(default=0)),
+                ('visitors', models.PositiveIntegerField(default=0)),
+                ('hour', models.DateTimeField()),
+                ('seller', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='auto_app.seller')),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auto_app.vehicle')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['seller', 'hour'], name='auto_app_ho_seller__1f47aa_idx'), models.Index(fields=['hour'], name='auto_app_ho_hour_df0dde_idx')],
+                'unique_together': {('vehicle', 'city', 'region', 'hour')},
+            },
+        ),
+    ]
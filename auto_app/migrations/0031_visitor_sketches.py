@@ -0,0 +1,40 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auto_app', '0030_impression_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SellerVisitorSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('sketch', models.BinaryField()),
+                ('seller', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auto_app.seller')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date'], name='auto_app_se_date_bc4d79_idx')],
+                'unique_together': {('seller', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='VehicleVisitorSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('sketch', models.BinaryField()),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auto_app.vehicle')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date'], name='auto_app_ve_date_6b27a9_idx')],
+                'unique_together': {('vehicle', 'date')},
+            },
+        ),
+    ]
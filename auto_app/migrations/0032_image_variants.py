@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auto_app', '0031_visitor_sketches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cmsimage',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='vehiclephoto',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
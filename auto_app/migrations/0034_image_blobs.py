@@ -0,0 +1,68 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:26
+
+import auto_app.utils.blobs
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def create_blobs(apps, schema_editor):
+    """Counts the references to the files stored before content addressing"""
+    ImageBlob = apps.get_model('auto_app', 'ImageBlob')
+    blobs = {}
+    for model_name, field, has_thumbnail in (('VehiclePhoto', 'photo', True), ('CMSImage', 'image', False)):
+        model = apps.get_model('auto_app', model_name)
+        rows = model.objects.exclude(**{field: ''}).values(field).annotate(count=Count('pk')).order_by()
+        for row in rows:
+            blob = blobs.setdefault(row[field], ImageBlob(name=row[field]))
+            blob.refcount += row['count']
+        if has_thumbnail:
+            # thumbnails made before variants existed belong to the blob too,
+            # so they are reused and deleted with it
+            legacy = model.objects.exclude(**{field: ''}).exclude(thumbnail='').filter(variants={})
+            for row in legacy.values(field, 'thumbnail'):
+                blob = blobs[row[field]]
+                blob.thumbnail = blob.thumbnail or row['thumbnail']
+        # rows of the same file share its rendered files
+        rendered = model.objects.exclude(**{field: ''}).exclude(variants={})
+        for row in rendered.values(field, 'width', 'height', 'variants', *(['thumbnail'] if has_thumbnail else [])):
+            blob = blobs[row[field]]
+            blob.width, blob.height, blob.variants = row['width'], row['height'], row['variants']
+            blob.thumbnail = row.get('thumbnail') or ''
+    ImageBlob.objects.bulk_create(blobs.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auto_app', '0033_upload_session'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('digest', models.CharField(blank=True, db_index=True, default='', max_length=64)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('refcount', models.IntegerField(default=0)),
+                ('released_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('width', models.PositiveIntegerField(blank=True, null=True)),
+                ('height', models.PositiveIntegerField(blank=True, null=True)),
+                ('thumbnail', models.CharField(blank=True, default='', max_length=255)),
+                ('variants', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='cmsimage',
+            name='image',
+            field=models.ImageField(storage=auto_app.utils.blobs.blob_storage, upload_to='cms_images/'),
+        ),
+        migrations.AlterField(
+            model_name='vehiclephoto',
+            name='photo',
+            field=models.ImageField(storage=auto_app.utils.blobs.blob_storage, upload_to='vehicle_photos/'),
+        ),
+        migrations.RunPython(create_blobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:23
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def set_watermarks(apps, schema_editor):
+    """
+    The existing rows all got the same insertion time, so checkpointing at
+    that time and the old position keeps exactly the rows after it pending.
+    """
+    Impression = apps.get_model('auto_app', 'Impression')
+    RollupCheckpoint = apps.get_model('auto_app', 'RollupCheckpoint')
+    inserted_at = Impression.objects.order_by().values_list('inserted_at', flat=True).first()
+    if inserted_at is not None:
+        RollupCheckpoint.objects.update(watermark=inserted_at)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auto_app', '0034_image_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='impression',
+            name='inserted_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='rollupcheckpoint',
+            name='watermark',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='impression',
+            index=models.Index(fields=['inserted_at', 'id'], name='auto_app_im_inserte_6ce2ad_idx'),
+        ),
+        migrations.RunPython(set_watermarks, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,10 @@
+import uuid
+
 from django.db import models
-from django.db.models import Q
+from django.utils import timezone
 from django.apps import apps
 from django.contrib.auth.models import ContentType, Group
-
-
-CDN_DOMAIN_NAME = "https://autohaus-mukuta.s3.af-south-1.amazonaws.com"
+from auto_app.utils.blobs import blob_storage
 
 
 # Create your models here.
@@ -14,6 +14,7 @@ class BaseModel(models.Model):
     Includes automatic form generation, list views, and detail serialization.
     """
     list_fields = []  # Fields to show in list view
+    list_select_related = []  # Relations __str__ follows, joined in list views
     section_break_after = []  # Fields after which to add a section break
     column_break_after = []  # Fields after which to add a column break
 
@@ -33,41 +34,17 @@ class BaseModel(models.Model):
 
     def list_json(self):
         """Returns JSON representation for list views"""
-        from auto_app.utils.serial import generic_serializer
-        detail = self.detail_json()
-        if not self.list_fields:
-            return {'name': str(self), 'id': self.id}
-
-        data = {}
-        for f in self.list_fields:
-            if isinstance(getattr(self, f, None), models.Model):
-                data[f] = str(getattr(self, f))
-            else:
-                data[f] = detail.get(f)
-        data['name'] = str(self)
-        data['id'] = self.id
-        return data
+        from auto_app.utils.serial import list_serializer
+        return list_serializer(self.__class__, [self])[0]
 
     def detail_json(self):
         """Returns complete JSON representation including child tables"""
         from auto_app.utils.serial import generic_serializer
-        try:
-            form = self.__class__.form_fields().get('sections', [])
-        except:
-            # If form_fields not implemented, return basic serialization
-            form = []
-
-        fields = []
+        from auto_app.utils import schema
+        # built from form_fields() once per model, see auto_app.utils.schema
+        fields = list(schema.detail_fields(self.__class__))
         data = {}
 
-        for section in form:
-            for column in section:
-                for field_dict in column:
-                    if field_dict.get('fieldtype') == 'table':
-                        fields.append(f"{field_dict.get('related_model')}:{field_dict.get('fieldname')}")
-                    else:
-                        fields.append(field_dict.get('fieldname'))
-
         # If no form fields, serialize all concrete fields
         if not fields:
             fields = [field.name for field in self._meta.get_fields()
@@ -172,19 +149,17 @@ class Seller(BaseModel):
 
     def has_active_subscription(self):
         """Check if seller has an active subscription"""
-        from billing.models import Subscription
-        return Subscription.objects.filter(
-            user=self.user,
-            status='active'
-        ).exists()
+        from billing.entitlements import has_active_subscription
+        return has_active_subscription(self.user)
 
     def get_active_subscription(self):
         """Get the active subscription for this seller"""
+        from billing.entitlements import entitlement
         from billing.models import Subscription
-        return Subscription.objects.filter(
-            user=self.user,
-            status='active'
-        ).first()
+        active = entitlement(self.user)
+        if active is None:
+            return None
+        return Subscription.objects.filter(pk=active.subscription_id).first()
 
     @classmethod
     def form_fields(cls):
@@ -329,6 +304,15 @@ class Vehicle(BaseModel):
     description = models.TextField(blank=True, default="")
     temporary = models.BooleanField(default=False, blank=True)  # Flag for temporary vehicles during image upload
 
+    class Meta:
+        # keyset pagination sorts on these columns with the pk as a tie-breaker
+        indexes = [
+            models.Index(fields=['price', 'id']),
+            models.Index(fields=['year', 'id']),
+            models.Index(fields=['mileage', 'id']),
+            models.Index(fields=['created_at', 'id']),
+        ]
+
     @classmethod
     def form_fields(cls):
         from auto_app.cms_forms import CMSFormBuilder
@@ -371,26 +355,46 @@ class Vehicle(BaseModel):
         return str(self.model)
 
     def related_listings(self):
-        return Vehicle.objects.filter(Q(
-            Q(Q(make=self.make) & Q(model=self.model)) |
-            Q(price__range=(self.price - 1000, self.price + 1000)) |
-            Q(year__range=(self.year - 2, self.year + 2)) |
-            Q(fuel_type=self.fuel_type) |
-            Q(transmission=self.transmission) |
-            Q(drivetrain=self.drivetrain) |
-            Q(body_type=self.body_type)
-        )).exclude(pk=self.pk)[:10]
+        """Most similar published vehicles, precomputed in RelatedVehicle"""
+        return Vehicle.objects.filter(similar_to__vehicle=self, published=True).order_by('similar_to__rank')[:10]
+
+
+class RelatedVehicle(models.Model):
+    """
+    Precomputed nearest neighbours of a published vehicle, maintained by
+    auto_app.utils.similarity.
+    """
+    vehicle = models.ForeignKey('auto_app.Vehicle', on_delete=models.CASCADE, related_name='related_entries')
+    related = models.ForeignKey('auto_app.Vehicle', on_delete=models.CASCADE, related_name='similar_to')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['vehicle', 'rank']
+        indexes = [
+            models.Index(fields=['vehicle', 'rank']),
+        ]
+
+    def __str__(self):
+        return f"{self.vehicle_id} -> {self.related_id} ({self.score:.3f})"
 
 
 class VehiclePhoto(BaseModel):
+    # read by auto_app.utils.thumbnails
+    image_field = 'photo'
+    variants_upload_to = 'vehicle_variants/'
+
     vehicle = models.ForeignKey('auto_app.Vehicle', on_delete=models.CASCADE, related_name='photos', null=True)
-    photo = models.ImageField(upload_to='vehicle_photos/')
+    # content addressed and reference counted, see auto_app.utils.blobs
+    photo = models.ImageField(upload_to='vehicle_photos/', storage=blob_storage)
     thumbnail = models.ImageField(upload_to='vehicle_thumbnails/', null=True, blank=True)
     is_main = models.BooleanField(default=False, blank=True)
     width = models.PositiveIntegerField(default=128)
     height = models.PositiveIntegerField(default=96)
     cdn_photo = models.URLField(blank=True, null=True)
     cdn_thumbnail = models.URLField(blank=True, null=True)
+    # responsive variants manifest, see auto_app.utils.thumbnails
+    variants = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         if hasattr(self, 'name') and self.name:
@@ -398,42 +402,11 @@ class VehiclePhoto(BaseModel):
         return self.photo.name if self.photo else f"VehiclePhoto {self.id}"
 
     def save(self, *args, **kwargs):
-        if self.cdn_photo or self.cdn_thumbnail:
-            super().save(*args, **kwargs)
-            return
-
-        from PIL import Image
-        from io import BytesIO
-        from django.core.files.uploadedfile import InMemoryUploadedFile
-        import sys
-
-        if self.photo and not self.thumbnail:
-            im = Image.open(self.photo)
-            self.width, self.height = im.size
-            output = BytesIO()
-            # Resize/modify the image
-            im = im.resize((300, 300))
-            # after modifications, save it to the output
-            im.save(output, format='PNG', quality=100)
-            output.seek(0)
-            # change the imagefield value to be the newley modifed image value
-            self.thumbnail = InMemoryUploadedFile(output, 'ImageField', "%s_thumb.png" % self.photo.name.split('.')[0], 'image/png', sys.getsizeof(output), None)
-
+        # the thumbnail, variants, width and height are filled in by the
+        # thumbnail worker once the photo is committed, see
+        # auto_app.utils.thumbnails, then the photo and thumbnail are
+        # uploaded to the CDN, see auto_app.utils.cdn
         super(VehiclePhoto, self).save(*args, **kwargs)
-        # upload the photo and thumbnail to s3
-        # if upload_photo(self.photo.path, self.photo.name):
-        #     self.cdn_photo = f"{CDN_DOMAIN_NAME}/vehicle_photos/{self.photo.name}"
-        # if upload_photo(self.thumbnail.path, self.thumbnail.name):
-        #     self.cdn_thumbnail = f"{CDN_DOMAIN_NAME}/vehicle_thumbnails/{self.thumbnail.name}"
-
-        # self.save()
-
-    def delete(self, *args, **kwargs):
-        if self.photo:
-            self.photo.delete(save=False)
-        if self.thumbnail:
-            self.thumbnail.delete(save=False)
-        super().delete(*args, **kwargs)
 
 
 class City(BaseModel):
@@ -497,6 +470,7 @@ class Account(BaseModel):
     phone = models.CharField(max_length=255, blank=True)
     is_cms_user = models.BooleanField(default=False, blank=True)
     role = models.ForeignKey('auto_app.Role', null=True, blank=True, on_delete=models.SET_NULL, related_name='accounts')
+    list_select_related = ['user']
 
     class Meta:
         verbose_name = "Account (Deprecated)"
@@ -554,6 +528,7 @@ class RolePermission(BaseModel):
     can_read = models.BooleanField(default=False, blank=True)
     can_write = models.BooleanField(default=False, blank=True)
     can_delete = models.BooleanField(default=False, blank=True)
+    list_select_related = ['role', 'entity']
 
     def __str__(self):
         return f"{self.role.role_name} - {self.entity.model}"
@@ -607,10 +582,14 @@ class Setting(BaseModel):
 
 class CMSImage(BaseModel):
     """Generic image storage for CMS"""
+    image_field = 'image'
+    variants_upload_to = 'cms_variants/'
+
     name = models.CharField(max_length=255)
-    image = models.ImageField(upload_to='cms_images/')
+    image = models.ImageField(upload_to='cms_images/', storage=blob_storage)
     width = models.PositiveIntegerField(default=128)
     height = models.PositiveIntegerField(default=96)
+    variants = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return self.name
@@ -640,7 +619,10 @@ class Impression(models.Model):
     user_agent = models.TextField(blank=True, default="")
     referrer = models.URLField(blank=True, default="")
     session_id = models.CharField(max_length=64, blank=True, default="")
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set by the ingestion queue to when the page was viewed, not inserted
+    created_at = models.DateTimeField(default=timezone.now)
+    # when the row was written, which the rollups checkpoint on
+    inserted_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         ordering = ['-created_at']
@@ -648,7 +630,142 @@ class Impression(models.Model):
             models.Index(fields=['vehicle', 'created_at']),
             models.Index(fields=['ip_address']),
             models.Index(fields=['created_at']),
+            models.Index(fields=['inserted_at', 'id']),
         ]
 
     def __str__(self):
         return f"{self.vehicle} - {self.ip_address} - {self.created_at}"
+
+
+class ImpressionRollup(models.Model):
+    """
+    Impression counts per vehicle and visitor location for one period,
+    maintained by auto_app.utils.rollups. ``visitors`` counts the distinct
+    IPs seen in each increment added to the row, so it over-counts visitors
+    who return across rollup runs; use the visitor sketches for uniques.
+    """
+    vehicle = models.ForeignKey('auto_app.Vehicle', on_delete=models.CASCADE, related_name='+')
+    seller = models.ForeignKey('auto_app.Seller', on_delete=models.SET_NULL, null=True, related_name='+')
+    city = models.CharField(max_length=255, blank=True, default="")
+    region = models.CharField(max_length=255, blank=True, default="")
+    impressions = models.PositiveIntegerField(default=0)
+    visitors = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+
+class HourlyImpressionRollup(ImpressionRollup):
+    hour = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('vehicle', 'city', 'region', 'hour')
+        indexes = [
+            models.Index(fields=['seller', 'hour']),
+            models.Index(fields=['hour']),
+        ]
+
+    def __str__(self):
+        return f"{self.vehicle_id} - {self.hour} - {self.impressions}"
+
+
+class DailyImpressionRollup(ImpressionRollup):
+    date = models.DateField()
+
+    class Meta:
+        unique_together = ('vehicle', 'city', 'region', 'date')
+        indexes = [
+            models.Index(fields=['seller', 'date']),
+            models.Index(fields=['date']),
+        ]
+
+    def __str__(self):
+        return f"{self.vehicle_id} - {self.date} - {self.impressions}"
+
+
+class VehicleVisitorSketch(models.Model):
+    """HyperLogLog sketch of the IPs that viewed a vehicle on one day"""
+    vehicle = models.ForeignKey('auto_app.Vehicle', on_delete=models.CASCADE, related_name='+')
+    date = models.DateField()
+    sketch = models.BinaryField()
+
+    class Meta:
+        unique_together = ('vehicle', 'date')
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+
+
+class SellerVisitorSketch(models.Model):
+    """
+    HyperLogLog sketch of the IPs that viewed any of a seller's vehicles on
+    one day. The row without a seller covers every vehicle.
+    """
+    seller = models.ForeignKey('auto_app.Seller', on_delete=models.CASCADE, null=True, related_name='+')
+    date = models.DateField()
+    sketch = models.BinaryField()
+
+    class Meta:
+        unique_together = ('seller', 'date')
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+
+
+class UploadSession(models.Model):
+    """
+    A resumable chunked upload, see auto_app.utils.uploads. The bytes
+    received so far are in a temporary file named after the id.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey('auth.User', on_delete=models.CASCADE, related_name='+')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True, default="")
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def complete(self):
+        return self.received >= self.size
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+
+class ImageBlob(models.Model):
+    """
+    A stored image file and the number of VehiclePhoto and CMSImage rows
+    pointing to it, see auto_app.utils.blobs. The thumbnail and variants
+    rendered from it are shared by those rows.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    digest = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    size = models.PositiveBigIntegerField(default=0)
+    refcount = models.IntegerField(default=0)
+    # when the count last dropped to zero
+    released_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    thumbnail = models.CharField(max_length=255, blank=True, default="")
+    variants = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount})"
+
+
+class RollupCheckpoint(models.Model):
+    """
+    The last source row an incremental aggregation job has processed, by
+    primary key, or by insertion time and then primary key when
+    ``watermark`` is set.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    position = models.BigIntegerField(default=0)
+    watermark = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.position}"
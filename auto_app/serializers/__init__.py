@@ -1,6 +1,79 @@
 from auto_app.models import *
+from django.db.models import Count, OuterRef, Prefetch, Subquery
+from django.db.models.manager import BaseManager
 from rest_framework import serializers
 
+from auto_app.utils.thumbnails import srcset
+
+
+# users nested by the depth=1 serializers, whose groups and permissions are
+# serialized as well
+VEHICLE_USER_PATHS = [
+    'created_by', 'updated_by', 'seller__user', 'seller__created_by',
+    'seller__updated_by', 'photos__created_by', 'photos__updated_by',
+]
+
+
+def vehicle_serialization_plan(queryset):
+    """
+    Loads everything VehicleSerializer touches with the vehicles themselves:
+    the depth=1 relations and the seller's in one join, photos and the nested
+    users' groups and permissions in one prefetch each, and each seller's ad
+    count as an annotation.
+    """
+    ad_counts = Vehicle.objects.filter(seller=OuterRef('seller')).order_by().values('seller') \
+        .annotate(count=Count('pk')).values('count')
+    user_prefetches = [
+        f"{path}__{m2m}" for path in VEHICLE_USER_PATHS for m2m in ('groups', 'user_permissions')
+    ]
+    return queryset.select_related(
+        'make', 'model', 'currency', 'city', 'created_by', 'updated_by',
+        'seller', 'seller__city', 'seller__user', 'seller__role',
+        'seller__created_by', 'seller__updated_by',
+    ).prefetch_related(
+        Prefetch('photos', queryset=VehiclePhoto.objects.select_related('created_by', 'updated_by')),
+        *user_prefetches,
+    ).annotate(seller_ad_count=Subquery(ad_counts))
+
+
+def vehicle_list_context(vehicles, request=None):
+    """
+    Per-page lookups for VehicleSerializer: seller ad counts and the current
+    user's saved listing ids, one query each at most.
+    """
+    if all(hasattr(v, 'seller_ad_count') for v in vehicles):
+        seller_ad_counts = {v.seller_id: v.seller_ad_count or 0 for v in vehicles}
+    else:
+        seller_ad_counts = dict(
+            Vehicle.objects.filter(seller_id__in={v.seller_id for v in vehicles})
+            .order_by().values('seller_id').annotate(count=Count('pk'))
+            .values_list('seller_id', 'count')
+        )
+
+    saved_listing_ids = {}
+    if request and request.user.is_authenticated and vehicles:
+        saved_listing_ids = dict(
+            SavedListing.objects.filter(user=request.user, vehicle__in=vehicles)
+            .order_by('-pk').values_list('vehicle_id', 'pk')
+        )
+
+    return {
+        'seller_ad_counts': seller_ad_counts,
+        'saved_listing_ids': saved_listing_ids,
+    }
+
+
+class VehicleListSerializer(serializers.ListSerializer):
+    """Batches VehicleSerializer's per-row lookups for the whole list"""
+
+    def to_representation(self, data):
+        vehicles = list(data.all() if isinstance(data, BaseManager) else data)
+        self._context = dict(
+            self._context,
+            **vehicle_list_context(vehicles, self._context.get('request'))
+        )
+        return super().to_representation(vehicles)
+
 
 class MakeSerializer(serializers.ModelSerializer):
     class Meta:
@@ -25,6 +98,9 @@ class SellerSerializer(serializers.ModelSerializer):
     number_of_ads = serializers.SerializerMethodField()
 
     def get_number_of_ads(self, obj):
+        counts = self.context.get('seller_ad_counts')
+        if counts is not None and obj.pk in counts:
+            return counts[obj.pk]
         return obj.num_ads
 
 
@@ -35,6 +111,11 @@ class VehiclePhotoSerializer(serializers.ModelSerializer):
         fields = '__all__'
         depth = 1
 
+    srcset = serializers.SerializerMethodField()
+
+    def get_srcset(self, obj):
+        return srcset(obj.variants)
+
 class CitySerializer(serializers.ModelSerializer):
     class Meta:
         model = City
@@ -45,6 +126,7 @@ class VehicleSerializer(serializers.ModelSerializer):
         model = Vehicle
         fields = '__all__'
         depth = 1
+        list_serializer_class = VehicleListSerializer
 
     seller = SellerSerializer()
     photos = VehiclePhotoSerializer(many=True)
@@ -57,6 +139,8 @@ class VehicleSerializer(serializers.ModelSerializer):
             return False
         if not self.context['request'].user.is_authenticated:
             return False
+        if 'saved_listing_ids' in self.context:
+            return obj.pk in self.context['saved_listing_ids']
         return SavedListing.objects.filter(vehicle=obj, user=self.context['request'].user).exists()
 
     def get_saved_listing_id(self, obj):
@@ -64,6 +148,8 @@ class VehicleSerializer(serializers.ModelSerializer):
             return None
         if not self.context['request'].user.is_authenticated:
             return None
+        if 'saved_listing_ids' in self.context:
+            return self.context['saved_listing_ids'].get(obj.pk)
         listing = SavedListing.objects.filter(vehicle=obj, user=self.context['request'].user)
         if listing.exists():
             return listing.first().id
@@ -1,9 +1,115 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from auto_app.models import ContactEntry
+from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
+from auto_app.models import (
+    ContactEntry, Vehicle, VehiclePhoto, CMSImage, SavedListing, SavedSearch,
+    Role, RolePermission, Seller
+)
+from auto_app.utils import blobs, recommendations
+from auto_app.utils.authentication import token_cache
+from auto_app.utils.permissions import role_permissions
+from billing import entitlements
+from billing.models import Subscription
+from auto_app.utils.search_index import vehicle_index
+from auto_app.utils.similarity import refresh_worker
+from auto_app.utils.thumbnails import needs_processing, thumbnail_worker
 
 
 @receiver(post_save, sender=ContactEntry)
 def email_contact_entry(sender, instance, **kwargs):
     print("Emailing admin to notify of new contact %s" % instance)
-    print("Emailing sender to acknowledge receipt of contact")
\ No newline at end of file
+    print("Emailing sender to acknowledge receipt of contact")
+
+
+@receiver(post_save, sender=Vehicle)
+def index_vehicle(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: vehicle_index.changed([pk]))
+    if not instance.temporary:
+        transaction.on_commit(lambda: refresh_worker.enqueue([pk]))
+
+
+@receiver(post_delete, sender=Vehicle)
+def unindex_vehicle(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: vehicle_index.changed([pk]))
+    if not instance.temporary:
+        transaction.on_commit(lambda: refresh_worker.enqueue([pk]))
+
+
+@receiver(post_save, sender=SavedListing)
+@receiver(post_delete, sender=SavedListing)
+@receiver(post_save, sender=SavedSearch)
+@receiver(post_delete, sender=SavedSearch)
+def invalidate_recommendations(sender, instance, **kwargs):
+    recommendations.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=VehiclePhoto)
+@receiver(post_save, sender=CMSImage)
+def queue_image(sender, instance, **kwargs):
+    if needs_processing(instance):
+        transaction.on_commit(lambda: thumbnail_worker.enqueue(instance))
+
+
+@receiver(pre_save, sender=VehiclePhoto)
+@receiver(pre_save, sender=CMSImage)
+def remember_image(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and sender.image_field not in update_fields:
+        instance._previous_image = None
+        return
+    previous = ''
+    if instance.pk is not None:
+        previous = sender.objects.filter(pk=instance.pk) \
+            .values_list(sender.image_field, flat=True).first() or ''
+    instance._previous_image = previous
+
+
+@receiver(post_save, sender=VehiclePhoto)
+@receiver(post_save, sender=CMSImage)
+def count_image(sender, instance, **kwargs):
+    previous = instance.__dict__.pop('_previous_image', None)
+    if previous is None:
+        return
+    current = getattr(instance, sender.image_field).name or ''
+    if current != previous:
+        blobs.acquire([current])
+        blobs.release([previous])
+
+
+@receiver(post_delete, sender=VehiclePhoto)
+@receiver(post_delete, sender=CMSImage)
+def uncount_image(sender, instance, **kwargs):
+    blobs.release([getattr(instance, sender.image_field).name])
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+@receiver(post_save, sender=RolePermission)
+@receiver(post_delete, sender=RolePermission)
+@receiver(post_save, sender=Seller)
+@receiver(post_delete, sender=Seller)
+def invalidate_role_permissions(sender, instance, **kwargs):
+    role_permissions.invalidate()
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def invalidate_entitlement(sender, instance, **kwargs):
+    entitlements.invalidate(instance.user_id)
+
+
+@receiver(post_delete, sender=Token)
+def forget_token(sender, instance, **kwargs):
+    token_cache.discard(instance.key)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user_tokens(sender, instance, update_fields=None, **kwargs):
+    # logging in only touches last_login, which the cached copies may keep
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    token_cache.discard_user(instance.pk)
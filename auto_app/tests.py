@@ -1,3 +1,1774 @@
-from django.test import TestCase
+import base64
+import fcntl
+import gzip
+import importlib
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import Count, Q, QuerySet, Sum
+from django.db.models.functions import TruncDate
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from auto_app.utils import (
+    blobs, cdn, cleanup, geoip, impressions, metrics, recommendations, retention, rollups, schema,
+    search_index, similarity, thumbnails
+)
+from auto_app.utils.hyperloglog import HyperLogLog, EXACT_LIMIT, STANDARD_ERROR
+from auto_app.models import (
+    Vehicle, VehiclePhoto, Make, Model, Seller, City, Currency, SavedListing,
+    SavedSearch, Impression, HourlyImpressionRollup, DailyImpressionRollup, CMSImage,
+    UploadSession, ImageBlob, Role, RolePermission, RelatedVehicle
+)
+from auto_app.checks import shared_cache_check
+from auto_app.admin import VehicleAdmin
+from auto_app.cms_forms import JSONToModelParser
+from auto_app.logging import LogPipeline, QueueHandler
+from auto_app.middleware.instrumentation import QueryTimer, sql_template
+from auto_app.serializers import VehiclePhotoSerializer
+from billing import entitlements
+from billing.models import Subscription, SubscriptionPlan
+from auto_app.utils.authentication import TokenCache, token_cache
+from auto_app.utils.authentication import VERSION_KEY as TOKEN_VERSION_KEY
+from auto_app.utils.permissions import ReadPermission, DeletePermission, VERSION_KEY
+from auto_app.utils import database_facets, process_search, search_filters, vehicle_facets
+from auto_app.utils.search_index import INDEX_COLUMNS, VehicleSearchIndex, count_facets, vehicle_index
+from auto_app.utils.uploads import append_chunk
+
+
+def create_vehicle(seller, make, model, city, currency, photos=2, **kwargs):
+    fields = dict(
+        make=make, model=model, seller=seller, city=city, currency=currency,
+        price=10000, mileage=50000, transmission='automatic', fuel_type='petrol',
+        drivetrain='front_wheel_drive', engine='1.8', year=2015, body_type='sedan',
+        published=True,
+    )
+    fields.update(kwargs)
+    vehicle = Vehicle.objects.create(**fields)
+    for i in range(photos):
+        # a cdn url skips thumbnail generation, the files don't exist
+        VehiclePhoto.objects.create(
+            vehicle=vehicle, photo=f"vehicle_photos/{vehicle.pk}_{i}.jpg",
+            cdn_photo=f"https://cdn.example.com/{vehicle.pk}_{i}.jpg",
+        )
+    return vehicle
+
+
+@override_settings(SEARCH_INDEX_ENABLED=False)
+class VehicleListingQueryCountTests(TestCase):
+    """
+    Listing endpoints must cost the same number of queries whatever the
+    number of vehicles on the page.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='secret')
+        self.city = City.objects.create(name='Harare')
+        self.currency = Currency.objects.create(name='US Dollar', symbol='$')
+        self.make = Make.objects.create(name='Toyota', logo='make_logos/toyota-logo.png')
+        self.model = Model.objects.create(make=self.make, name='Corolla', year=2015)
+        self.sellers = []
+        for i in range(3):
+            seller_user = User.objects.create_user(username=f"seller{i}")
+            self.sellers.append(Seller.objects.create(
+                name=f"Seller {i}", email=f"seller{i}@example.com",
+                user=seller_user, city=self.city,
+            ))
+        self.seller = Seller.objects.create(
+            name='Buyer', email='buyer@example.com', user=self.user, city=self.city
+        )
+        SavedSearch.objects.create(user=self.user, filters='{"searches": []}')
+
+    def add_vehicles(self, count):
+        vehicles = []
+        for i in range(count):
+            seller = self.sellers[i % len(self.sellers)]
+            vehicle = create_vehicle(seller, self.make, self.model, self.city, self.currency)
+            create_vehicle(self.seller, self.make, self.model, self.city, self.currency)
+            SavedListing.objects.create(user=self.user, vehicle=vehicle)
+            vehicles.append(vehicle)
+        return vehicles
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def assertConstantQueries(self, url, expected):
+        self.add_vehicles(1)
+        self.assertEqual(self.count_queries(url), expected)
+        self.add_vehicles(5)
+        self.assertEqual(self.count_queries(url), expected)
+
+    def test_search_vehicles(self):
+        self.client.force_login(self.user)
+        self.assertConstantQueries('/api/search-vehicles/', 10)
+
+    def test_search_vehicles_anonymous(self):
+        self.assertConstantQueries('/api/search-vehicles/', 6)
+
+    def test_account_listings(self):
+        self.client.force_login(self.user)
+        self.assertConstantQueries('/api/account-listings/', 9)
+
+    def test_saved_listings(self):
+        self.client.force_login(self.user)
+        self.assertConstantQueries('/api/saved-listings/', 8)
+
+    def test_latest_listings(self):
+        self.assertConstantQueries('/api/latest-listings/', 6)
+
+    def test_related_listings(self):
+        vehicle = create_vehicle(self.sellers[0], self.make, self.model, self.city, self.currency)
+        url = f"/api/related-listings/{vehicle.pk}/"
+        self.add_vehicles(1)
+        similarity.rebuild()
+        self.assertEqual(self.count_queries(url), 7)
+        self.add_vehicles(5)
+        similarity.rebuild()
+        self.assertEqual(self.count_queries(url), 7)
+
+    def test_recommended_listings(self):
+        self.client.force_login(self.user)
+        url = '/api/recommended-listings/'
+        SavedSearch.objects.filter(user=self.user).update(
+            filters='{"searches": [{"make": ["%s"]}, {"max_price": ["20000"]}]}' % self.make.pk
+        )
+        for count in (1, 5):
+            self.add_vehicles(count)
+            similarity.rebuild()
+            cache.clear()
+            self.assertEqual(self.count_queries(url), 11)
+
+    def test_vehicle_viewset(self):
+        self.assertConstantQueries('/vehicle/', 7)
+
+
+class SearchIndexTests(TestCase):
+    QUERIES = [
+        {},
+        {'make': '%(toyota)s'},
+        {'make': '%(honda)s', 'fuel_type': 'Diesel'},
+        {'min_price': '5000', 'max_price': '20000'},
+        {'min_year': '2012', 'max_mileage': '80000'},
+        {'body_type': 'SUV', 'max_price': '0'},
+    ]
+
+    def setUp(self):
+        self.addCleanup(self.reset_index)
+        self.addCleanup(cache.clear)
+        user = User.objects.create_user(username='seller')
+        city = City.objects.create(name='Harare')
+        currency = Currency.objects.create(name='US Dollar', symbol='$')
+        seller = Seller.objects.create(name='Seller', email='seller@example.com', user=user, city=city)
+        self.makes = {}
+        self.vehicles = []
+        for i, (name, fuel, body) in enumerate([
+            ('Toyota', 'petrol', 'sedan'), ('Toyota', 'diesel', 'suv'), ('Honda', 'diesel', 'suv'),
+            ('Honda', 'petrol', 'hatchback'), ('Toyota', 'petrol', 'suv'), ('Honda', 'diesel', 'sedan'),
+        ]):
+            make = self.makes.get(name) or Make.objects.create(name=name, logo=f"make_logos/{name}.png")
+            self.makes[name] = make
+            model = Model.objects.create(make=make, name=f"{name} {i}", year=2010 + i)
+            self.vehicles.append(create_vehicle(
+                seller, make, model, city, currency, photos=0, fuel_type=fuel, body_type=body,
+                price=3000 * (i + 1), year=2009 + i, mileage=20000 * i, published=i != 5,
+            ))
+        vehicle_index.build()
+
+    def reset_index(self):
+        with vehicle_index._lock:
+            vehicle_index._reset()
+            vehicle_index.built_at = vehicle_index.version = None
+
+    def queries(self):
+        ids = {'toyota': self.makes['Toyota'].pk, 'honda': self.makes['Honda'].pk}
+        return [{k: v % ids for k, v in query.items()} for query in self.QUERIES]
+
+    def orm_results(self, query):
+        return set(Vehicle.objects.filter(search_filters(query)).values_list('pk', flat=True))
+
+    def test_matches_orm(self):
+        for query in self.queries():
+            with self.subTest(query=query):
+                self.assertEqual(set(vehicle_index.search(query)), self.orm_results(query))
+                self.assertEqual(set(process_search(query).values_list('pk', flat=True)), self.orm_results(query))
+
+    def assertSearchesMatchOrm(self):
+        for query in self.queries():
+            with self.subTest(query=query):
+                self.assertEqual(set(process_search(query).values_list('pk', flat=True)), self.orm_results(query))
+
+    def test_changes_recorded_by_other_processes(self):
+        published, unpublished = self.vehicles[0], self.vehicles[5]
+        Vehicle.objects.filter(pk=published.pk).update(published=False)
+        Vehicle.objects.filter(pk=unpublished.pk).update(published=True, price=50000)
+        # recorded by the process that made them
+        search_index.record_changes([published.pk])
+        search_index.record_changes([unpublished.pk])
+        self.assertSearchesMatchOrm()
+        self.assertEqual(vehicle_index.version, cache.get(search_index.VERSION_KEY))
+
+    def test_missed_changes_rebuild(self):
+        vehicle = self.vehicles[0]
+        Vehicle.objects.filter(pk=vehicle.pk).update(published=False)
+        version = search_index.record_changes([vehicle.pk])
+        cache.delete(search_index.CHANGES_KEY.format(version))
+        with mock.patch.object(vehicle_index, 'warm') as warm:
+            self.assertIsNone(vehicle_index.search({}))
+            warm.assert_called_once()
+        # answered by the database until the rebuild
+        self.assertSearchesMatchOrm()
+        vehicle_index.build()
+        self.assertNotIn(vehicle.pk, vehicle_index.search({}))
+        self.assertSearchesMatchOrm()
+
+    @override_settings(RELATED_LISTINGS_BACKGROUND=False)
+    def test_saved_vehicles(self):
+        vehicle = self.vehicles[1]
+        with self.captureOnCommitCallbacks(execute=True):
+            vehicle.body_type = 'sedan'
+            vehicle.save()
+            self.vehicles[2].delete()
+        self.assertSearchesMatchOrm()
+
+    def test_admin_publish_actions(self):
+        vehicle_admin = VehicleAdmin(Vehicle, admin.site)
+        unpublished, published = self.vehicles[5], self.vehicles[0]
+        with mock.patch.object(VehicleAdmin, 'message_user'), self.captureOnCommitCallbacks(execute=True):
+            vehicle_admin.publish_vehicles(None, Vehicle.objects.filter(pk=unpublished.pk))
+            vehicle_admin.unpublish_vehicles(None, Vehicle.objects.filter(pk=published.pk))
+        results = set(vehicle_index.search({}))
+        self.assertIn(unpublished.pk, results)
+        self.assertNotIn(published.pk, results)
+        for query in self.queries():
+            with self.subTest(query=query):
+                self.assertEqual(set(vehicle_index.search(query)), self.orm_results(query))
+
+    def test_facets_match_orm(self):
+        for query in self.queries():
+            with self.subTest(query=query):
+                rows = Vehicle.objects.filter(search_filters(query)).values_list(*INDEX_COLUMNS)
+                expected = count_facets(VehicleSearchIndex.row_from_values(r) for r in rows)
+                self.assertEqual(vehicle_index.facets(vehicle_index.match(query)), expected)
+
+    def test_database_facets(self):
+        for query in self.queries():
+            with self.subTest(query=query):
+                queryset = Vehicle.objects.filter(search_filters(query))
+                rows = queryset.values_list(*INDEX_COLUMNS)
+                expected = count_facets(VehicleSearchIndex.row_from_values(r) for r in rows)
+                with self.assertNumQueries(len(search_index.FACET_FIELDS) + 2):
+                    self.assertEqual(database_facets(queryset), expected)
+
+    def test_facets_from_the_source_of_the_results(self):
+        for query in self.queries():
+            with self.subTest(query=query):
+                from_index = vehicle_facets(query)
+                with override_settings(SEARCH_INDEX_MAX_RESULTS=0), \
+                        mock.patch.object(vehicle_index, 'facets') as index_facets:
+                    self.assertEqual(vehicle_facets(query), from_index)
+                    index_facets.assert_not_called()
+
+    def test_facets_skip_vehicles_discarded_after_match(self):
+        bitmap = vehicle_index.match({})
+        vehicle_index.discard(self.vehicles[0].pk)
+        rows = Vehicle.objects.filter(published=True).exclude(pk=self.vehicles[0].pk).values_list(*INDEX_COLUMNS)
+        expected = count_facets(VehicleSearchIndex.row_from_values(r) for r in rows)
+        self.assertEqual(vehicle_index.facets(bitmap), expected)
+
+
+class RelatedListingsTests(TestCase):
+    def setUp(self):
+        self.addCleanup(similarity.feature_matrix.reset)
+        self.addCleanup(cache.clear)
+        user = User.objects.create_user(username='seller')
+        self.city = City.objects.create(name='Harare')
+        self.currency = Currency.objects.create(name='US Dollar', symbol='$')
+        self.seller = Seller.objects.create(name='Seller', email='seller@example.com', user=user, city=self.city)
+        self.makes = [Make.objects.create(name=name, logo=f"make_logos/{name}.png") for name in ('Toyota', 'Honda')]
+        self.vehicles = [
+            self.add_vehicle(i, body_type=('sedan', 'suv', 'hatchback')[i % 3])
+            for i in range(12)
+        ]
+        similarity.rebuild()
+
+    def add_vehicle(self, i, make=None, **kwargs):
+        make = make or self.makes[i % 2]
+        model = Model.objects.create(make=make, name=f"{make.name} {i}", year=2005 + i)
+        fields = dict(price=4000 + 1700 * i, year=2005 + i, mileage=15000 * i + 700 * (i % 4))
+        fields.update(kwargs)
+        return create_vehicle(self.seller, make, model, self.city, self.currency, photos=0, **fields)
+
+    def related(self):
+        rows = RelatedVehicle.objects.order_by('vehicle_id', 'rank').values_list('vehicle_id', 'related_id', 'score')
+        return {(vehicle, related): score for vehicle, related, score in rows}
+
+    def assertMatchesRebuild(self, changed):
+        similarity.refresh(changed)
+        incremental = self.related()
+        similarity.rebuild()
+        rebuilt = self.related()
+        self.assertEqual(sorted(incremental), sorted(rebuilt))
+        for key, score in rebuilt.items():
+            self.assertAlmostEqual(incremental[key], score, places=5)
+
+    def test_incremental_refresh_matches_rebuild(self):
+        vehicle = self.vehicles[3]
+        vehicle.price = 9100
+        vehicle.save()
+        with self.subTest('within the bounds'), \
+                mock.patch.object(similarity.FeatureMatrix, 'load_rows', wraps=similarity.FeatureMatrix.load_rows) as load:
+            self.assertMatchesRebuild([vehicle.pk])
+            load.assert_any_call({vehicle.pk})
+
+        make = Make.objects.create(name='Mazda', logo='make_logos/Mazda.png')
+        added = self.add_vehicle(20, make=make, body_type='coupe', price=11000, year=2012, mileage=60000)
+        with self.subTest('new categories'):
+            self.assertMatchesRebuild([added.pk])
+
+        vehicle = self.vehicles[7]
+        vehicle.price = 500000
+        vehicle.save()
+        with self.subTest('new highest price'), \
+                mock.patch.object(similarity, 'nearest_neighbours', wraps=similarity.nearest_neighbours) as nearest:
+            self.assertMatchesRebuild([vehicle.pk])
+            self.assertLess(len(nearest.call_args_list[0].args[0]), len(self.vehicles))
+
+        vehicle = self.vehicles[5]
+        vehicle.published = False
+        vehicle.save()
+        with self.subTest('unpublished'):
+            self.assertMatchesRebuild([vehicle.pk])
+
+        pk = self.vehicles[2].pk
+        self.vehicles[2].delete()
+        with self.subTest('deleted'):
+            self.assertMatchesRebuild([pk])
+
+    def test_changes_made_by_other_processes(self):
+        first, second = self.vehicles[4], self.vehicles[9]
+        second.mileage = 1000
+        second.save()
+        # refreshed by another process, with its own matrix
+        with mock.patch.object(similarity, 'feature_matrix', similarity.FeatureMatrix()):
+            similarity.refresh([second.pk])
+        first.price = 12345
+        first.save()
+        with mock.patch.object(similarity.FeatureMatrix, 'load_rows', wraps=similarity.FeatureMatrix.load_rows) as load:
+            self.assertMatchesRebuild([first.pk])
+            load.assert_any_call({first.pk, second.pk})
+
+    def test_scores_loaded_for_affected_vehicles_only(self):
+        vehicle = self.vehicles[4]
+        vehicle.price = 12345
+        vehicle.save()
+        other = similarity.FeatureMatrix()
+        with mock.patch.object(similarity, 'feature_matrix', other):
+            affected = similarity.refresh([vehicle.pk])
+        vehicle.mileage = 5000
+        vehicle.save()
+        with mock.patch.object(similarity.FeatureMatrix, 'load_scores', wraps=similarity.feature_matrix.load_scores) as load:
+            similarity.refresh([vehicle.pk])
+        self.assertEqual(len(load.call_args.args[0]), affected)
+        loaded = similarity.FeatureMatrix()
+        loaded.sync()
+        for matrix in (similarity.feature_matrix, loaded):
+            matrix.scores = dict(zip(matrix.pks.tolist(), zip(matrix.worst.tolist(), matrix.counts.tolist())))
+        self.assertEqual(similarity.feature_matrix.scores, loaded.scores)
+
+    @override_settings(RELATED_LISTINGS_BACKGROUND=False)
+    def test_admin_actions_refresh(self):
+        vehicle_admin = VehicleAdmin(Vehicle, admin.site)
+        vehicle = self.vehicles[3]
+        with mock.patch.object(VehicleAdmin, 'message_user'), self.captureOnCommitCallbacks(execute=True):
+            vehicle_admin.unpublish_vehicles(None, Vehicle.objects.filter(pk=vehicle.pk))
+        self.assertFalse(RelatedVehicle.objects.filter(Q(vehicle=vehicle) | Q(related=vehicle)).exists())
+        with mock.patch.object(VehicleAdmin, 'message_user'), self.captureOnCommitCallbacks(execute=True):
+            vehicle_admin.publish_vehicles(None, Vehicle.objects.filter(pk=vehicle.pk))
+        incremental = self.related()
+        similarity.rebuild()
+        self.assertEqual(sorted(incremental), sorted(self.related()))
+
+    @override_settings(RELATED_LISTINGS_BACKGROUND=False)
+    def test_temporary_vehicles_skipped(self):
+        with mock.patch.object(similarity, 'refresh') as refresh, self.captureOnCommitCallbacks(execute=True):
+            temporary = self.add_vehicle(30, temporary=True)
+        refresh.assert_not_called()
+        similarity.rebuild()
+        self.assertFalse(RelatedVehicle.objects.filter(Q(vehicle=temporary) | Q(related=temporary)).exists())
+
+    def test_related_listings_published_only(self):
+        vehicle = self.vehicles[0]
+        related = list(vehicle.related_listings())
+        self.assertEqual(len(related), 10)
+        Vehicle.objects.filter(pk=related[0].pk).update(published=False)
+        self.assertNotIn(related[0], list(vehicle.related_listings()))
+
+
+@override_settings(SEARCH_INDEX_ENABLED=False)
+class RecommendationTests(TestCase):
+    def setUp(self):
+        self.addCleanup(similarity.feature_matrix.reset)
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user(username='buyer')
+        seller_user = User.objects.create_user(username='seller')
+        city = City.objects.create(name='Harare')
+        currency = Currency.objects.create(name='US Dollar', symbol='$')
+        seller = Seller.objects.create(name='Seller', email='seller@example.com', user=seller_user, city=city)
+        self.toyota = Make.objects.create(name='Toyota', logo='make_logos/toyota.png')
+        self.honda = Make.objects.create(name='Honda', logo='make_logos/honda.png')
+        self.vehicles = {}
+        for name, make, price, body in [
+            ('corolla', self.toyota, 8000, 'sedan'), ('camry', self.toyota, 9000, 'sedan'),
+            ('rav4', self.toyota, 15000, 'suv'), ('civic', self.honda, 7000, 'sedan'),
+            ('crv', self.honda, 16000, 'suv'), ('fit', self.honda, 5000, 'hatchback'),
+        ]:
+            model = Model.objects.create(make=make, name=name, year=2015)
+            self.vehicles[name] = create_vehicle(
+                seller, make, model, city, currency, photos=0, price=price, body_type=body,
+            )
+        similarity.rebuild()
+
+    def recommend(self, *searches):
+        if searches:
+            SavedSearch.objects.create(user=self.user, filters=json.dumps({'searches': list(searches)}))
+        return recommendations.recommend(self.user)
+
+    def test_saved_listings(self):
+        saved = self.vehicles['corolla']
+        SavedListing.objects.create(user=self.user, vehicle=saved)
+        Vehicle.objects.filter(pk=self.vehicles['camry'].pk).update(published=False)
+        scores = dict(
+            RelatedVehicle.objects.filter(vehicle=saved, related__published=True).values_list('related_id', 'score')
+        )
+        ranked = self.recommend()
+        self.assertEqual(ranked, sorted(scores, key=lambda pk: (-scores[pk], -pk)))
+        self.assertNotIn(saved.pk, ranked)
+        self.assertNotIn(self.vehicles['camry'].pk, ranked)
+
+    def test_saved_searches(self):
+        SavedListing.objects.create(user=self.user, vehicle=self.vehicles['crv'])
+        Vehicle.objects.filter(pk=self.vehicles['fit'].pk).update(published=False)
+        ranked = self.recommend(
+            {'body_type': ['suv'], 'page_size': ['5']},
+            {'make': [str(self.honda.pk)], 'sort_by': ['price']},
+        )
+        related = set(RelatedVehicle.objects.filter(vehicle=self.vehicles['crv']).values_list('related_id', flat=True))
+        # the newest search, Honda, outweighs the older one
+        self.assertEqual(ranked[0], self.vehicles['civic'].pk)
+        self.assertEqual(ranked[1], self.vehicles['rav4'].pk)
+        self.assertEqual(set(ranked), related - {self.vehicles['fit'].pk})
+        self.assertNotIn(self.vehicles['crv'].pk, ranked)
+        self.assertNotIn(self.vehicles['fit'].pk, ranked)
+
+    def test_cached_until_saved_listings_change(self):
+        self.assertEqual(self.recommend(), [])
+        SavedListing.objects.create(user=self.user, vehicle=self.vehicles['civic'])
+        ranked = self.recommend()
+        self.assertTrue(ranked)
+        self.assertNotIn(self.vehicles['civic'].pk, ranked)
+
+
+@override_settings(SEARCH_INDEX_ENABLED=False)
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='seller', password='secret')
+        city = City.objects.create(name='Harare')
+        currency = Currency.objects.create(name='US Dollar', symbol='$')
+        make = Make.objects.create(name='Toyota', logo='make_logos/toyota-logo.png')
+        model = Model.objects.create(make=make, name='Corolla', year=2015)
+        seller = Seller.objects.create(name='Seller', email='seller@example.com', user=self.user, city=city)
+        # some prices shared, so the pk breaks ties
+        self.vehicles = [
+            create_vehicle(seller, make, model, city, currency, photos=0, price=price)
+            for price in (9000, 5000, 7000, 5000, 12000, 7000, 3000)
+        ]
+
+    def page(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return (
+            [vehicle['id'] for vehicle in response.json()],
+            response.get('X-Next-Cursor'), response.get('X-Previous-Cursor'),
+        )
+
+    def test_round_trip(self):
+        url = '/api/search-vehicles/'
+        pages = [self.page(url, sort_by='price', page_size=3)]
+        self.assertIsNone(pages[0][2])
+        while pages[-1][1]:
+            pages.append(self.page(url, sort_by='price', page_size=3, cursor=pages[-1][1]))
+        expected = list(Vehicle.objects.order_by('price', 'pk').values_list('pk', flat=True))
+        self.assertEqual([pk for ids, _, _ in pages for pk in ids], expected)
+        self.assertEqual([len(ids) for ids, _, _ in pages], [3, 3, 1])
+
+        ids, next_cursor, previous_cursor = self.page(url, sort_by='price', page_size=3, cursor=pages[2][2])
+        self.assertEqual(ids, pages[1][0])
+        self.assertEqual(self.page(url, sort_by='price', page_size=3, cursor=next_cursor)[0], pages[2][0])
+        ids, next_cursor, previous_cursor = self.page(url, sort_by='price', page_size=3, cursor=previous_cursor)
+        self.assertEqual(ids, pages[0][0])
+        self.assertIsNone(previous_cursor)
+        self.assertEqual(self.page(url, sort_by='price', page_size=3, cursor=next_cursor)[0], pages[1][0])
+
+    def test_tampered_cursor(self):
+        url = '/api/search-vehicles/'
+        cursor = self.page(url, sort_by='price', page_size=3)[1]
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        payload['v'] = 'cheap'
+        tampered = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+        for bad in (tampered, cursor[:-4], 'not-a-cursor'):
+            with self.subTest(cursor=bad):
+                response = self.client.get(url, {'sort_by': 'price', 'cursor': bad})
+                self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'sort_by': '-year', 'cursor': cursor})
+        self.assertEqual(response.status_code, 400)
+
+    def test_shared_created_at(self):
+        Vehicle.objects.update(created_at=timezone.now() - timedelta(days=1))
+        self.client.force_login(self.user)
+        url = '/api/account-listings/'
+        pages = [self.page(url, page_size=2)]
+        while pages[-1][1]:
+            pages.append(self.page(url, page_size=2, cursor=pages[-1][1]))
+        self.assertEqual(
+            [pk for ids, _, _ in pages for pk in ids],
+            sorted((vehicle.pk for vehicle in self.vehicles), reverse=True),
+        )
+        backwards = [pages[-1][0]]
+        previous_cursor = pages[-1][2]
+        while previous_cursor:
+            ids, _, previous_cursor = self.page(url, page_size=2, cursor=previous_cursor)
+            backwards.insert(0, ids)
+        self.assertEqual(backwards, [ids for ids, _, _ in pages])
+
+    def test_full_list_without_page_params(self):
+        self.client.force_login(self.user)
+        for url, expected in (
+            ('/api/search-vehicles/', Vehicle.objects.order_by('price', 'pk')),
+            ('/api/account-listings/', Vehicle.objects.order_by('-created_at', '-pk')),
+        ):
+            with self.subTest(url=url):
+                ids, next_cursor, previous_cursor = self.page(url)
+                self.assertEqual(ids, list(expected.values_list('pk', flat=True)))
+                self.assertIsNone(next_cursor)
+                self.assertIsNone(previous_cursor)
+
+    def test_facets_endpoint(self):
+        response = self.client.get('/api/search-vehicles/facets/', {'min_price': 6000})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'facets': vehicle_facets({'min_price': '6000'})})
+        self.assertIsInstance(self.client.get('/api/search-vehicles/', {'facets': 1}).json(), list)
+
+    def test_search_saved_on_first_page_only(self):
+        self.client.force_login(self.user)
+        url = '/api/search-vehicles/'
+        cursor = self.page(url, sort_by='price', page_size=3)[1]
+        self.page(url, sort_by='price', page_size=3, cursor=cursor)
+        searches = json.loads(SavedSearch.objects.get(user=self.user).filters)['searches']
+        self.assertEqual(searches, [{'sort_by': ['price'], 'page_size': ['3']}])
+
+
+class GeolocationTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'ip-ranges.bin')
+        csv_path = os.path.join(directory, 'ranges.csv')
+        with open(csv_path, 'w') as f:
+            f.write("start,end,country_code,country,region,city,lat,lon\n")
+            f.write("41.57.64.0,41.57.127.255,ZW,Zimbabwe,Harare,Harare,-17.83,31.05\n")
+            f.write("41.57.128.0,41.57.128.255,ZW,Zimbabwe,Bulawayo,Bulawayo,-20.15,28.58\n")
+            f.write("2c0f:f8f0::,2c0f:f8f0:ffff:ffff:ffff:ffff:ffff:ffff,ZW,Zimbabwe,Harare,Harare,,\n")
+        call_command('build_geoip_database', csv_path, output=self.path, stdout=io.StringIO())
+
+    def locate(self, ip, **overrides):
+        with override_settings(**{'GEOIP_DATABASE': self.path, **overrides}):
+            locator = geoip.Locator()
+            return locator.locate(ip)
+
+    def test_lookup(self):
+        self.assertEqual(self.locate('41.57.64.0')['city'], 'Harare')
+        self.assertEqual(self.locate('41.57.127.255')['city'], 'Harare')
+        self.assertEqual(self.locate('41.57.128.10')['lat'], -20.15)
+        self.assertEqual(self.locate('2c0f:f8f0::1')['region'], 'Harare')
+
+    def test_unknown_addresses(self):
+        with mock.patch('auto_app.utils.geoip.http_lookup') as http_lookup:
+            self.assertEqual(self.locate('41.57.129.0'), geoip.empty_location())
+            self.assertEqual(self.locate('8.8.8.8'), geoip.empty_location())
+            self.assertEqual(self.locate('not an ip'), geoip.empty_location())
+            self.assertEqual(self.locate('127.0.0.1')['country_code'], 'LO')
+        http_lookup.assert_not_called()
+
+    def test_http_fallback(self):
+        location = dict(geoip.empty_location(), city='Mountain View')
+        with mock.patch('auto_app.utils.geoip.http_lookup', return_value=location) as http_lookup:
+            with override_settings(GEOIP_DATABASE=self.path, GEOIP_HTTP_FALLBACK=True):
+                locator = geoip.Locator()
+                self.assertEqual(locator.locate('8.8.8.8')['city'], 'Mountain View')
+                self.assertEqual(locator.locate('8.8.8.8')['city'], 'Mountain View')
+                self.assertEqual(locator.locate('41.57.64.1')['city'], 'Harare')
+        http_lookup.assert_called_once_with('8.8.8.8')
+
+    def test_http_without_database(self):
+        location = dict(geoip.empty_location(), city='Mountain View')
+        missing = os.path.join(os.path.dirname(self.path), 'missing.bin')
+        with mock.patch('auto_app.utils.geoip.http_lookup', return_value=location) as http_lookup:
+            self.assertEqual(self.locate('8.8.8.8', GEOIP_DATABASE=missing)['city'], 'Mountain View')
+            # a built database takes over
+            self.assertEqual(self.locate('8.8.8.8'), geoip.empty_location())
+        http_lookup.assert_called_once_with('8.8.8.8')
+
+    def test_failed_http_lookups_retried(self):
+        location = dict(geoip.empty_location(), city='Mountain View')
+        with mock.patch('auto_app.utils.geoip.http_lookup', side_effect=[None, location]) as http_lookup:
+            with override_settings(GEOIP_DATABASE=None):
+                locator = geoip.Locator()
+                self.assertEqual(locator.locate('8.8.8.8'), geoip.empty_location())
+                self.assertEqual(locator.locate('8.8.8.8')['city'], 'Mountain View')
+                self.assertEqual(locator.locate('8.8.8.8')['city'], 'Mountain View')
+        self.assertEqual(http_lookup.call_count, 2)
+
+    @override_settings(GEOIP_CACHE_SIZE=2)
+    def test_cache_size(self):
+        with override_settings(GEOIP_DATABASE=self.path):
+            locator = geoip.Locator()
+            for ip in ('41.57.64.1', '41.57.64.2', '41.57.64.1', '41.57.128.1'):
+                locator.locate(ip)
+        self.assertEqual(list(locator._cache), ['41.57.64.1', '41.57.128.1'])
+
+
+class ImpressionSpoolTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        overrides = override_settings(IMPRESSION_SPOOL_DIR=self.directory, IMPRESSION_WORKER=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        user = User.objects.create_user(username='seller')
+        city = City.objects.create(name='Harare')
+        make = Make.objects.create(name='Toyota', logo='make_logos/toyota-logo.png')
+        model = Model.objects.create(make=make, name='Corolla', year=2015)
+        currency = Currency.objects.create(name='US Dollar', symbol='$')
+        seller = Seller.objects.create(name='Seller', email='seller@example.com', user=user, city=city)
+        self.vehicle = create_vehicle(seller, make, model, city, currency, photos=0)
+
+    def records(self, count):
+        return [
+            impressions.make_record(self.vehicle.pk, '127.0.0.1', session_id=f"session-{i}")
+            for i in range(count)
+        ]
+
+    def spool_files(self, prefix):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith(prefix))
+
+    def test_full_drain(self):
+        queue = impressions.ImpressionQueue()
+        queue.spool(self.records(3))
+        queue.spool(self.records(2))
+        out = io.StringIO()
+        call_command('drain_impressions', stdout=out)
+        self.assertIn('Ingested 5', out.getvalue())
+        self.assertEqual(Impression.objects.count(), 5)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_partial_failure(self):
+        impressions.ImpressionQueue().spool(self.records(5))
+        ingest = impressions.ingest
+        calls = []
+
+        def failing(records):
+            calls.append(records)
+            if len(calls) == 2:
+                raise RuntimeError('database went away')
+            return ingest(records)
+
+        with mock.patch('auto_app.utils.impressions.ingest', side_effect=failing), \
+                self.assertLogs(impressions.logger, 'ERROR'):
+            self.assertEqual(impressions.drain_spool(batch_size=2), 2)
+        self.assertEqual(len(self.spool_files('impressions-')), 1)
+        self.assertEqual(self.spool_files('claimed-'), [])
+
+        self.assertEqual(impressions.drain_spool(batch_size=2), 3)
+        sessions = sorted(Impression.objects.values_list('session_id', flat=True))
+        self.assertEqual(sessions, [f"session-{i}" for i in range(5)])
+
+    def test_malformed_line(self):
+        records = self.records(3)
+        with open(os.path.join(self.directory, 'impressions-a.jsonl'), 'w') as f:
+            f.write(json.dumps(records[0]) + "\n{not json\n" + json.dumps(records[1]) + "\n")
+        with open(os.path.join(self.directory, 'impressions-b.jsonl'), 'w') as f:
+            f.write(json.dumps(records[2]) + "\n")
+
+        with self.assertLogs(impressions.logger, 'ERROR') as logs:
+            self.assertEqual(impressions.drain_spool(), 3)
+        self.assertIn('line 2 of impression spool impressions-a.jsonl', logs.output[0])
+        rejected = self.spool_files('rejected-')
+        self.assertEqual(len(rejected), 1)
+        with open(os.path.join(self.directory, rejected[0])) as f:
+            self.assertEqual(f.read(), "{not json\n")
+        self.assertEqual(impressions.drain_spool(), 0)
+
+    def test_put_and_flush(self):
+        queue = impressions.ImpressionQueue()
+        for record in self.records(3):
+            self.assertTrue(queue.put(record))
+        self.assertEqual(Impression.objects.count(), 0)
+        queue.flush()
+        self.assertEqual(Impression.objects.count(), 3)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @override_settings(IMPRESSION_QUEUE_SIZE=2)
+    def test_full_queue_spools(self):
+        queue = impressions.ImpressionQueue()
+        for record in self.records(5):
+            self.assertTrue(queue.put(record))
+        self.assertEqual(self.spool_files('impressions-'), [f"impressions-{os.getpid()}.jsonl"])
+        queue.flush()
+        self.assertEqual(Impression.objects.count(), 2)
+        self.assertEqual(impressions.drain_spool(), 3)
+        sessions = sorted(Impression.objects.values_list('session_id', flat=True))
+        self.assertEqual(sessions, [f"session-{i}" for i in range(5)])
+
+    def test_file_being_written_is_skipped(self):
+        queue = impressions.ImpressionQueue()
+        queue.spool(self.records(2))
+        path = os.path.join(self.directory, f"impressions-{os.getpid()}.jsonl")
+        with open(path) as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.assertEqual(impressions.drain_spool(), 0)
+        self.assertEqual(self.spool_files('impressions-'), [os.path.basename(path)])
+        self.assertEqual(impressions.drain_spool(), 2)
+
+    def test_append_after_claim_goes_to_a_new_file(self):
+        queue = impressions.ImpressionQueue()
+        queue.spool(self.records(2))
+        path = impressions.spool_dir() / f"impressions-{os.getpid()}.jsonl"
+        claimed = impressions.spool_dir() / 'claimed-test.jsonl'
+        with open(path, 'a') as f:
+            # a writer that opened the file just before a drain renamed it
+            self.assertTrue(impressions.claim(path, claimed))
+            fcntl.flock(f, fcntl.LOCK_EX)
+            fcntl.flock(f, fcntl.LOCK_UN)
+        queue.spool(self.records(1))
+        with open(claimed) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    @override_settings(IMPRESSION_QUEUE_SIZE=1)
+    def test_record_impression(self):
+        queue = impressions.ImpressionQueue()
+        client = APIClient()
+        url = '/api/impressions/record/'
+        with mock.patch('auto_app.views.api.impression_queue', queue):
+            response = client.post(url, {'vehicle_id': self.vehicle.pk, 'session_id': 'abc'}, format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(client.get(url).status_code, 405)
+            self.assertEqual(client.post(url, 'not json', content_type='application/json').status_code, 400)
+            self.assertEqual(client.post(url, {}, format='json').status_code, 400)
+            self.assertEqual(client.post(url, {'vehicle_id': 'x'}, format='json').status_code, 400)
+            # the queue is full and the spool can't be written
+            with mock.patch.object(queue, 'spool', return_value=False):
+                response = client.post(url, {'vehicle_id': self.vehicle.pk}, format='json')
+                self.assertEqual(response.status_code, 503)
+        queue.flush()
+        self.assertEqual(list(Impression.objects.values_list('vehicle_id', 'session_id')), [(self.vehicle.pk, 'abc')])
+
+    def test_stale_claim(self):
+        stale = os.path.join(self.directory, 'claimed-stale.jsonl')
+        fresh = os.path.join(self.directory, 'claimed-fresh.jsonl')
+        for path in (stale, fresh):
+            with open(path, 'w') as f:
+                f.writelines(json.dumps(r) + "\n" for r in self.records(2))
+        an_hour_ago = time.time() - 3600
+        os.utime(stale, (an_hour_ago, an_hour_ago))
+
+        self.assertEqual(impressions.drain_spool(), 2)
+        self.assertEqual(self.spool_files('claimed-'), ['claimed-fresh.jsonl'])
+
+
+@override_settings(IMPRESSION_ROLLUP_LAG=0)
+class ImpressionRollupTests(TestCase):
+    def setUp(self):
+        city = City.objects.create(name='Harare')
+        currency = Currency.objects.create(name='US Dollar', symbol='$')
+        make = Make.objects.create(name='Toyota', logo='make_logos/toyota-logo.png')
+        model = Model.objects.create(make=make, name='Corolla', year=2015)
+        self.sellers = [
+            Seller.objects.create(
+                name=f"Seller {i}", email=f"seller{i}@example.com",
+                user=User.objects.create_user(username=f"seller{i}"), city=city,
+            )
+            for i in range(2)
+        ]
+        self.vehicles = [
+            create_vehicle(seller, make, model, city, currency, photos=0)
+            for seller in self.sellers for _ in range(2)
+        ]
+        self.now = timezone.now()
+
+    def add_impressions(self, count, offset=0):
+        Impression.objects.bulk_create([
+            Impression(
+                vehicle=self.vehicles[i % len(self.vehicles)],
+                ip_address=f"10.0.0.{i % 7}",
+                city=['Harare', 'Bulawayo', ''][i % 3],
+                created_at=self.now - timedelta(hours=(i * 5) % 72),
+            )
+            for i in range(offset, offset + count)
+        ])
+
+    def expected(self, seller):
+        impressions = Impression.objects.filter(created_at__gte=self.now - timedelta(days=30))
+        if seller:
+            impressions = impressions.filter(vehicle__seller=seller)
+        return {
+            'total': impressions.count(),
+            'by_date': {
+                row['date'].isoformat(): row['count']
+                for row in impressions.annotate(date=TruncDate('created_at'))
+                .values('date').annotate(count=Count('id'))
+            },
+            'by_vehicle': dict(impressions.values_list('vehicle').annotate(Count('id'))),
+        }
+
+    def assertStats(self, seller=None):
+        stats = rollups.dashboard_stats(seller, self.now - timedelta(days=30))
+        expected = self.expected(seller)
+        self.assertEqual(stats['total_impressions'], expected['total'])
+        self.assertEqual({d['date']: d['count'] for d in stats['by_date']}, expected['by_date'])
+        self.assertEqual({v['id']: v['impressions'] for v in stats['top_vehicles']}, expected['by_vehicle'])
+
+    def test_incremental_rollup(self):
+        self.add_impressions(40)
+        self.assertEqual(rollups.rollup(batch_size=15), 40)
+        self.add_impressions(25, offset=40)
+        self.assertStats()
+        self.assertStats(self.sellers[0])
+        self.assertEqual(rollups.rollup(), 25)
+        self.assertEqual(rollups.rollup(), 0)
+        self.assertStats()
+        self.assertStats(self.sellers[1])
+
+        hourly = HourlyImpressionRollup.objects.aggregate(total=Sum('impressions'))['total']
+        daily = DailyImpressionRollup.objects.aggregate(total=Sum('impressions'))['total']
+        self.assertEqual(hourly, 65)
+        self.assertEqual(daily, 65)
+
+    def test_late_commits(self):
+        self.add_impressions(10)
+        last = Impression.objects.order_by('pk').last()
+        Impression.objects.create(id=last.pk + 100, vehicle=self.vehicles[0], ip_address='10.0.1.1')
+        self.assertEqual(rollups.rollup(), 11)
+        # a lower primary key committed after the run
+        Impression.objects.create(id=last.pk + 50, vehicle=self.vehicles[0], ip_address='10.0.1.2')
+        self.assertEqual(rollups.rollup(), 1)
+        self.assertEqual(DailyImpressionRollup.objects.aggregate(total=Sum('impressions'))['total'], 12)
+
+    @override_settings(IMPRESSION_ROLLUP_LAG=300)
+    def test_recent_impressions_left_pending(self):
+        self.add_impressions(10)
+        Impression.objects.update(inserted_at=self.now - timedelta(minutes=10))
+        self.add_impressions(5, offset=10)
+        self.assertEqual(rollups.rollup(), 10)
+        self.assertStats()
+
+    def test_partial_first_day(self):
+        start = (self.now - timedelta(days=3)).replace(hour=6, minute=0, second=0, microsecond=0)
+        Impression.objects.bulk_create([
+            Impression(vehicle=self.vehicles[0], ip_address=f"10.0.2.{i}", created_at=start + timedelta(hours=hours))
+            for i, hours in enumerate([-3, 2, 30])
+        ])
+        rollups.rollup()
+        stats = rollups.dashboard_stats(None, start)
+        self.assertEqual(stats['total_impressions'], 2)
+        self.assertEqual(stats['unique_visitors'], 2)
+        self.assertEqual(stats['top_vehicles'][0]['unique_visitors'], 2)
+
+    def test_unique_visitors(self):
+        # few visitors per day keeps the sketches exact
+        start = self.now - timedelta(days=30)
+        self.add_impressions(30)
+        rollups.rollup()
+        self.add_impressions(10, offset=30)
+        for seller in (None, self.sellers[0]):
+            self.assertEqual(
+                rollups.unique_visitors(seller, start),
+                rollups.unique_visitors(seller, start, exact=True),
+            )
+
+    @override_settings(IMPRESSION_COMPACTION_MARGIN=0)
+    def test_compact(self):
+        self.now = timezone.now() - timedelta(days=100)
+        self.add_impressions(20)
+        self.now = timezone.now()
+        self.add_impressions(10, offset=20)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.assertEqual(retention.compact(days=90, archive_dir=directory, chunk_size=7), 20)
+        self.assertEqual(Impression.objects.count(), 10)
+        self.assertEqual(DailyImpressionRollup.objects.aggregate(total=Sum('impressions'))['total'], 30)
+
+        archived = []
+        for name in os.listdir(directory):
+            with gzip.open(os.path.join(directory, name), 'rt') as f:
+                archived.extend(json.loads(line)['id'] for line in f)
+        self.assertEqual(len(set(archived)), 20)
+        self.assertEqual(retention.compact(days=90), 0)
+
+    def test_compact_keeps_rows_near_the_checkpoint(self):
+        self.now = timezone.now() - timedelta(days=100)
+        self.add_impressions(10)
+        Impression.objects.update(inserted_at=timezone.now() - timedelta(hours=2))
+        self.add_impressions(5, offset=10)
+        self.assertEqual(rollups.rollup(), 15)
+        # only the rows inserted more than the margin before the checkpoint go
+        self.assertEqual(retention.compact(days=90), 10)
+        self.assertEqual(Impression.objects.count(), 5)
+
+
+class HyperLogLogTests(TestCase):
+    def sketch(self, values):
+        sketch = HyperLogLog()
+        sketch.update(values)
+        return sketch
+
+    def test_exact_mode(self):
+        sketch = self.sketch(f"10.0.{i // 256}.{i % 256}" for i in range(EXACT_LIMIT))
+        self.assertTrue(sketch.is_exact)
+        self.assertEqual(sketch.count(), EXACT_LIMIT)
+        sketch.add('10.0.0.0')
+        self.assertEqual(HyperLogLog.from_bytes(sketch.to_bytes()).count(), EXACT_LIMIT)
+
+    def test_error_bound(self):
+        # three standard errors, which a fixed hash makes deterministic
+        for n in (1000, 10000, 100000):
+            sketch = self.sketch(f"visitor-{i}" for i in range(n))
+            self.assertFalse(sketch.is_exact)
+            self.assertLess(abs(sketch.count() - n) / n, 3 * STANDARD_ERROR)
+            restored = HyperLogLog.from_bytes(sketch.to_bytes())
+            self.assertEqual(restored.count(), sketch.count())
+
+    def test_merge(self):
+        days = [self.sketch(f"visitor-{i}" for i in range(day * 2000, day * 2000 + 5000)) for day in range(5)]
+        days.append(self.sketch(f"visitor-{i}" for i in range(100)))
+        merged = HyperLogLog.union(days)
+        union = self.sketch(f"visitor-{i}" for i in range(13000))
+        self.assertTrue((merged.registers == union.registers).all())
+        self.assertLess(abs(merged.count() - 13000) / 13000, 3 * STANDARD_ERROR)
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def image_file(self, size, name='car.jpg'):
+        output = io.BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(output, format='JPEG')
+        return ContentFile(output.getvalue(), name=name)
+
+    def test_thumbnail_keeps_aspect_ratio(self):
+        photo = VehiclePhoto.objects.create(photo=self.image_file((800, 400)))
+        # nothing is rendered while saving
+        self.assertFalse(photo.thumbnail)
+
+        self.assertEqual(thumbnails.generate(VehiclePhoto, [photo.pk]), 1)
+        photo.refresh_from_db()
+        self.assertEqual((photo.width, photo.height), (800, 400))
+        with Image.open(photo.thumbnail.path) as thumbnail:
+            self.assertEqual(thumbnail.size, (300, 150))
+        self.assertEqual(thumbnails.generate(VehiclePhoto, [photo.pk]), 0)
+
+    def test_variants(self):
+        photo = VehiclePhoto.objects.create(photo=self.image_file((800, 400)))
+        thumbnails.generate(VehiclePhoto, [photo.pk])
+        photo.refresh_from_db()
+
+        sizes = photo.variants['sizes']
+        self.assertEqual([(s['width'], s['height']) for s in sizes], [(320, 160), (640, 320)])
+        for size in sizes:
+            for name, image_format in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+                with Image.open(default_storage.path(size[name])) as variant:
+                    self.assertEqual(variant.format, image_format)
+                    self.assertEqual(variant.size, (size['width'], size['height']))
+
+        data = VehiclePhotoSerializer(photo).data
+        self.assertEqual(data['srcset']['webp'].count('w, '), 1)
+        self.assertTrue(data['srcset']['jpeg'].endswith(' 640w'))
+
+        photo.delete()
+        # the files go once nothing has used them for the grace period
+        self.assertTrue(default_storage.exists(sizes[0]['webp']))
+        self.assertEqual(blobs.collect(grace=0)[0], 1)
+        self.assertFalse(default_storage.exists(sizes[0]['webp']))
+        self.assertFalse(default_storage.exists(photo.photo.name))
+
+    def test_variants_in_process_pool(self):
+        photos = [VehiclePhoto.objects.create(photo=self.image_file(size)) for size in ((800, 400), (400, 800))]
+        executor = thumbnails.process_pool(workers=1)
+        self.addCleanup(executor.shutdown)
+        self.assertEqual(thumbnails.generate(VehiclePhoto, [photo.pk for photo in photos], executor), 2)
+        for photo, expected in zip(photos, ((300, 150), (150, 300))):
+            photo.refresh_from_db()
+            with Image.open(photo.thumbnail.path) as thumbnail:
+                self.assertEqual(thumbnail.size, expected)
+            for size in photo.variants['sizes']:
+                self.assertTrue(default_storage.exists(size['webp']))
+
+    def test_identical_uploads_are_stored_once(self):
+        first = VehiclePhoto.objects.create(photo=self.image_file((800, 400), name='car.jpg'))
+        second = VehiclePhoto.objects.create(photo=self.image_file((800, 400), name='relisted.JPG'))
+        other = VehiclePhoto.objects.create(photo=self.image_file((400, 400)))
+        self.assertEqual(first.photo.name, second.photo.name)
+        self.assertNotEqual(first.photo.name, other.photo.name)
+        self.assertEqual(ImageBlob.objects.get(name=first.photo.name).refcount, 2)
+
+        with mock.patch.object(thumbnails, 'render', wraps=thumbnails.render) as render:
+            thumbnails.generate(VehiclePhoto, [first.pk, second.pk])
+            self.assertEqual(render.call_count, 1)
+            third = VehiclePhoto.objects.create(photo=self.image_file((800, 400)))
+            thumbnails.generate(VehiclePhoto, [third.pk])
+            self.assertEqual(render.call_count, 1)
+        first.refresh_from_db()
+        third.refresh_from_db()
+        self.assertEqual(third.variants, first.variants)
+        self.assertEqual(third.thumbnail.name, first.thumbnail.name)
+
+        # released, but within the grace period
+        VehiclePhoto.objects.filter(pk__in=[first.pk, second.pk]).delete()
+        self.assertEqual(blobs.collect()[0], 0)
+        third.delete()
+        count, freed = blobs.collect(grace=0)
+        self.assertEqual(count, 1)
+        self.assertGreater(freed, 0)
+        self.assertFalse(default_storage.exists(first.photo.name))
+        self.assertFalse(default_storage.exists(first.thumbnail.name))
+        self.assertTrue(default_storage.exists(other.photo.name))
+
+    def test_legacy_thumbnail_kept(self):
+        photo = VehiclePhoto.objects.create(photo=self.image_file((800, 400)))
+        legacy = default_storage.save('vehicle_thumbnails/legacy_thumb.jpg', self.image_file((300, 150)))
+        VehiclePhoto.objects.filter(pk=photo.pk).update(thumbnail=legacy)
+
+        with mock.patch.object(thumbnails, 'render', wraps=thumbnails.render) as render:
+            thumbnails.generate(VehiclePhoto, [photo.pk])
+            self.assertFalse(render.call_args.args[2])
+            relisted = VehiclePhoto.objects.create(photo=self.image_file((800, 400)))
+            thumbnails.generate(VehiclePhoto, [relisted.pk])
+            self.assertEqual(render.call_count, 1)
+        relisted.refresh_from_db()
+        self.assertEqual(relisted.thumbnail.name, legacy)
+        blob = ImageBlob.objects.get(name=photo.photo.name)
+        self.assertEqual(blob.thumbnail, legacy)
+        self.assertIn(default_storage.path(legacy), blobs.rendered_files(blob))
+
+    def test_migrated_blobs_keep_legacy_thumbnails(self):
+        from django.apps import apps as django_apps
+        create_blobs = importlib.import_module('auto_app.migrations.0034_image_blobs').create_blobs
+
+        photo = VehiclePhoto.objects.create(photo=self.image_file((800, 400)))
+        VehiclePhoto.objects.filter(pk=photo.pk).update(thumbnail='vehicle_thumbnails/legacy_thumb.jpg')
+        ImageBlob.objects.all().delete()
+        create_blobs(django_apps, None)
+        blob = ImageBlob.objects.get(name=photo.photo.name)
+        self.assertEqual((blob.refcount, blob.thumbnail), (1, 'vehicle_thumbnails/legacy_thumb.jpg'))
+
+    def test_collect_races_with_uploads(self):
+        photo = VehiclePhoto.objects.create(photo=self.image_file((800, 400)))
+        name = photo.photo.name
+        photo.delete()
+        ImageBlob.objects.update(released_at=timezone.now() - timedelta(days=1))
+
+        def uploaded_meanwhile(path, cutoff):
+            # uploaded again between the select and the mtime check
+            VehiclePhoto.objects.create(photo=self.image_file((800, 400)))
+            return False
+
+        with mock.patch.object(blobs, 'recently_used', side_effect=uploaded_meanwhile):
+            self.assertEqual(blobs.collect(grace=60)[0], 0)
+        self.assertTrue(blobs.storage.exists(name))
+        self.assertEqual(ImageBlob.objects.get(name=name).refcount, 1)
+
+        VehiclePhoto.objects.filter(photo=name).delete()
+        ImageBlob.objects.update(released_at=timezone.now() - timedelta(days=1))
+
+        def stored_meanwhile(path, cutoff):
+            # stored again, its row isn't saved yet
+            directory = os.path.dirname(os.path.dirname(name))
+            blobs.storage.save(os.path.join(directory, 'car.jpg'), self.image_file((800, 400)))
+            return False
+
+        with mock.patch.object(blobs, 'recently_used', side_effect=stored_meanwhile):
+            self.assertEqual(blobs.collect(grace=60)[0], 1)
+        self.assertTrue(blobs.storage.exists(name))
+        self.assertEqual(os.listdir(os.path.dirname(blobs.storage.path(name))), [os.path.basename(name)])
+
+    def test_recount(self):
+        photo = VehiclePhoto.objects.create(photo=self.image_file((800, 400)))
+        ImageBlob.objects.update(refcount=0)
+        self.assertEqual(blobs.recount(), 1)
+        self.assertEqual(ImageBlob.objects.get(name=photo.photo.name).refcount, 1)
+
+    def test_cms_image_variants(self):
+        image = CMSImage.objects.create(image=self.image_file((200, 100), name='logo.png'))
+        self.assertEqual(thumbnails.generate(CMSImage, [image.pk]), 1)
+        image.refresh_from_db()
+        # narrower than every width: one variant at its own size
+        self.assertEqual([(s['width'], s['height']) for s in image.variants['sizes']], [(200, 100)])
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=media_root, CHUNKED_UPLOAD_DIR=os.path.join(media_root, 'uploads'),
+            THUMBNAIL_BACKGROUND=False,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='seller', password='secret')
+        city = City.objects.create(name='Harare')
+        seller = Seller.objects.create(name='Seller', email='seller@example.com', user=self.user, city=city)
+        make = Make.objects.create(name='Toyota', logo='make_logos/toyota-logo.png')
+        model = Model.objects.create(make=make, name='Corolla', year=2015)
+        currency = Currency.objects.create(name='US Dollar', symbol='$')
+        self.vehicle = create_vehicle(seller, make, model, city, currency, photos=0)
+        self.client.force_login(self.user)
+
+        output = io.BytesIO()
+        Image.new('RGB', (640, 480), (30, 30, 200)).save(output, format='JPEG')
+        self.image = output.getvalue()
+
+    def put_chunk(self, upload_id, start, end):
+        return self.client.put(
+            f"/api/uploads/{upload_id}/", self.image[start:end + 1],
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f"bytes {start}-{end}/{len(self.image)}",
+        )
+
+    def test_resumable_upload(self):
+        response = self.client.post(
+            '/api/uploads/', json.dumps({'filename': 'car.jpg', 'size': len(self.image)}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.json()['upload_id']
+        middle = len(self.image) // 2
+
+        self.assertEqual(self.put_chunk(upload_id, 0, middle - 1).json()['offset'], middle)
+        # a repeated chunk is refused with the offset to resume from
+        response = self.put_chunk(upload_id, 0, middle - 1)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], middle)
+        self.assertEqual(self.client.get(f"/api/uploads/{upload_id}/").json()['offset'], middle)
+        self.assertTrue(self.put_chunk(upload_id, middle, len(self.image) - 1).json()['complete'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/api/upload-vehicle-image/',
+                json.dumps({'vehicle_id': self.vehicle.pk, 'upload_id': upload_id}),
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+        photo = VehiclePhoto.objects.get(pk=response.json()['id'])
+        with photo.photo.open('rb') as f:
+            self.assertEqual(f.read(), self.image)
+        self.assertEqual((photo.width, photo.height), (640, 480))
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'uploads')), [])
+
+    def test_chunk_locks_the_session(self):
+        session = UploadSession.objects.create(user=self.user, filename='car.jpg', size=len(self.image))
+        depth = len(connection.atomic_blocks)
+        append = append_chunk
+
+        def locked_append(*args):
+            # written inside the transaction that holds the row lock
+            self.assertEqual(len(connection.atomic_blocks), depth + 1)
+            return append(*args)
+
+        with mock.patch.object(QuerySet, 'select_for_update', autospec=True,
+                               side_effect=QuerySet.select_for_update) as select_for_update, \
+                mock.patch('auto_app.views.image_upload.append_chunk', side_effect=locked_append):
+            self.assertEqual(self.put_chunk(session.pk, 0, 99).json()['offset'], 100)
+        self.assertEqual(select_for_update.call_args.args[0].model, UploadSession)
+
+    def test_incomplete_upload_is_refused(self):
+        session = UploadSession.objects.create(user=self.user, filename='car.jpg', size=len(self.image))
+        self.put_chunk(session.pk, 0, 99)
+        response = self.client.post(
+            '/api/upload-vehicle-image/',
+            json.dumps({'vehicle_id': self.vehicle.pk, 'upload_id': str(session.pk)}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_multipart_upload(self):
+        response = self.client.post('/api/upload-vehicle-image/', {
+            'vehicle_id': self.vehicle.pk, 'is_main': 'true',
+            'photo': ContentFile(self.image, name='car.jpg'),
+        })
+        self.assertEqual(response.status_code, 200)
+        photo = VehiclePhoto.objects.get(pk=response.json()['id'])
+        self.assertTrue(photo.is_main)
+        with photo.photo.open('rb') as f:
+            self.assertEqual(f.read(), self.image)
+
+    def test_bulk_upload(self):
+        session = UploadSession.objects.create(user=self.user, filename='side.jpg', size=len(self.image))
+        self.put_chunk(session.pk, 0, len(self.image) - 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/api/upload-vehicle-images/', {
+                    'vehicle_id': self.vehicle.pk,
+                    'upload_ids': [str(session.pk)],
+                    'photos': [
+                        ContentFile(self.image, name='front.jpg'),
+                        ContentFile(b'not an image', name='notes.txt'),
+                        ContentFile(self.image, name='back.jpg'),
+                    ],
+                })
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['name'] for r in results], ['front.jpg', 'notes.txt', 'back.jpg', str(session.pk)])
+        self.assertEqual([r['status'] for r in results], ['success', 'error', 'success', 'success'])
+        inserts = [q for q in queries.captured_queries
+                   if q['sql'].startswith('INSERT INTO "auto_app_vehiclephoto"')]
+        self.assertEqual(len(inserts), 1)
+
+        photos = VehiclePhoto.objects.filter(vehicle=self.vehicle)
+        self.assertEqual(photos.count(), 3)
+        for photo in photos:
+            self.assertTrue(photo.thumbnail)
+            self.assertTrue(photo.variants['sizes'])
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_bulk_upload_requires_owner(self):
+        other = User.objects.create_user(username='other', password='secret')
+        self.client.force_login(other)
+        response = self.client.post('/api/upload-vehicle-images/', {
+            'vehicle_id': self.vehicle.pk, 'photos': [ContentFile(self.image, name='front.jpg')],
+        })
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(VehiclePhoto.objects.filter(vehicle=self.vehicle).exists())
+
+
+class CDNOffloadTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.cdn_dir = os.path.join(media_root, 'cdn')
+        settings_override = override_settings(
+            MEDIA_ROOT=media_root, THUMBNAIL_BACKGROUND=False, CDN_OFFLOAD=True, CDN_BACKGROUND=False,
+            CDN_BACKEND='filesystem', CDN_LOCAL_DIR=self.cdn_dir, CDN_PUBLIC_URL='https://cdn.example.com',
+            CDN_RETRY_DELAY=0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def create_photo(self):
+        output = io.BytesIO()
+        Image.new('RGB', (800, 400), (30, 200, 30)).save(output, format='JPEG')
+        photo = VehiclePhoto.objects.create(photo=ContentFile(output.getvalue(), name='car.jpg'))
+        thumbnails.generate(VehiclePhoto, [photo.pk])
+        photo.refresh_from_db()
+        return photo
+
+    def test_offload_after_thumbnail(self):
+        photo = self.create_photo()
+        self.assertEqual(photo.cdn_photo, f"https://cdn.example.com/{photo.photo.name}")
+        self.assertEqual(photo.cdn_thumbnail, f"https://cdn.example.com/{photo.thumbnail.name}")
+        for name in (photo.photo.name, photo.thumbnail.name):
+            with open(os.path.join(self.cdn_dir, name), 'rb') as uploaded, default_storage.open(name) as stored:
+                self.assertEqual(uploaded.read(), stored.read())
+
+        # the same content isn't uploaded again
+        with mock.patch.object(cdn, 'upload') as upload:
+            duplicate = self.create_photo()
+        upload.assert_not_called()
+        self.assertEqual(duplicate.cdn_photo, photo.cdn_photo)
+
+    def test_retries_with_backoff(self):
+        backend = cdn.get_backend()
+        calls = []
+
+        def flaky(source, key, content_type):
+            calls.append(key)
+            if len(calls) <= 2:
+                raise ConnectionError("connection reset")
+            return cdn.FileSystemBackend.upload(backend, source, key, content_type)
+
+        with mock.patch.object(backend, 'upload', side_effect=flaky), \
+                mock.patch.object(cdn.time, 'sleep') as sleep:
+            photo = self.create_photo()
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertTrue(photo.cdn_photo and photo.cdn_thumbnail)
+
+    def test_gives_up_on_missing_files(self):
+        photo = VehiclePhoto.objects.create(photo='vehicle_photos/missing.jpg', thumbnail='vehicle_thumbnails/missing.jpg')
+        with cdn.upload_pool() as executor:
+            self.assertEqual(cdn.offload([photo.pk], executor), 0)
+        photo.refresh_from_db()
+        self.assertFalse(photo.cdn_photo)
+
+
+class SweepTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=media_root, CHUNKED_UPLOAD_DIR=os.path.join(media_root, 'uploads'),
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def photo_file(self, colour):
+        output = io.BytesIO()
+        Image.new('RGB', (64, 64), colour).save(output, format='JPEG')
+        return ContentFile(output.getvalue(), name='car.jpg')
+
+    def test_sweep(self):
+        long_ago = timezone.now() - timedelta(days=2)
+        user = User.objects.create_user(username='seller', password='secret')
+        city = City.objects.create(name='Harare')
+        seller = Seller.objects.create(name='Seller', email='seller@example.com', user=user, city=city)
+        make = Make.objects.create(name='Toyota', logo='make_logos/toyota-logo.png')
+        model = Model.objects.create(make=make, name='Corolla', year=2015)
+        currency = Currency.objects.create(name='US Dollar', symbol='$')
+        temporary = create_vehicle(seller, make, model, city, currency, photos=0, temporary=True)
+        kept = create_vehicle(seller, make, model, city, currency, photos=0)
+        Vehicle.objects.filter(pk__in=[temporary.pk, kept.pk]).update(created_at=long_ago)
+
+        stale = VehiclePhoto.objects.create(vehicle=temporary, photo=self.photo_file((200, 0, 0)))
+        orphan = VehiclePhoto.objects.create(photo=self.photo_file((0, 200, 0)))
+        VehiclePhoto.objects.filter(pk=orphan.pk).update(created_at=long_ago)
+        fresh_orphan = VehiclePhoto.objects.create(photo=self.photo_file((0, 0, 200)))
+        listed = VehiclePhoto.objects.create(vehicle=kept, photo=self.photo_file((200, 200, 0)))
+
+        session = UploadSession.objects.create(user=user, filename='car.jpg', size=10)
+        append_chunk(session, io.BytesIO(b'01234'), 0, 4)
+        UploadSession.objects.filter(pk=session.pk).update(updated_at=long_ago)
+
+        untracked = default_storage.save('vehicle_thumbnails/crashed.jpg', ContentFile(b'x' * 100))
+        in_flight = default_storage.save('vehicle_thumbnails/in-flight.jpg', ContentFile(b'x' * 100))
+        # written after the sweep starts, its row isn't committed yet
+        future = time.time() + 60
+        os.utime(default_storage.path(in_flight), (future, future))
+        released = sum(os.path.getsize(p.photo.path) for p in (stale, orphan))
+
+        report = cleanup.sweep(grace=0, batch_size=1)
+
+        self.assertEqual(report['temporary_vehicles'], 1)
+        self.assertEqual(report['orphan_photos'], 1)
+        self.assertEqual(report['uploads'], 1)
+        self.assertEqual(report['blobs'], 2)
+        self.assertEqual(report['untracked_files'], 1)
+        self.assertEqual(report['bytes_freed'], 5 + 100 + released)
+
+        self.assertFalse(Vehicle.objects.filter(pk=temporary.pk).exists())
+        self.assertEqual(set(VehiclePhoto.objects.values_list('pk', flat=True)), {fresh_orphan.pk, listed.pk})
+        for photo in (stale, orphan):
+            self.assertFalse(os.path.exists(photo.photo.path))
+        for photo in (fresh_orphan, listed):
+            self.assertTrue(os.path.exists(photo.photo.path))
+        self.assertFalse(default_storage.exists(untracked))
+        self.assertTrue(default_storage.exists(in_flight))
+        self.assertFalse(UploadSession.objects.exists())
+
+
+class SchemaRegistryTests(TestCase):
+    def setUp(self):
+        schema.clear()
+        self.addCleanup(schema.clear)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser(username='admin', password='secret'))
+        for name in ('Toyota', 'Honda', 'Mazda'):
+            Make.objects.create(name=name, logo=f"make_logos/{name}.png")
+
+    def test_schema_built_once(self):
+        with mock.patch.object(Make, 'form_fields', wraps=Make.form_fields) as form_fields, \
+                mock.patch.object(Make, 'list_field_schema', wraps=Make.list_field_schema) as list_schema:
+            for _ in range(2):
+                self.assertEqual(self.client.get('/api/cms/create/make/').status_code, 200)
+                self.assertEqual(len(self.client.get('/api/cms/list/make/').json()['data']), 3)
+                make = Make.objects.first()
+                self.assertEqual(self.client.get(f'/api/cms/update/make/{make.pk}/').json()['data']['name'], make.name)
+        self.assertEqual(form_fields.call_count, 1)
+        self.assertEqual(list_schema.call_count, 1)
+
+    def test_etag(self):
+        response = self.client.get('/api/cms/create/make/')
+        etag = response['ETag']
+        response = self.client.get('/api/cms/create/make/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get('/api/cms/create/make/', HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+        make = Make.objects.first()
+        response = self.client.get(f'/api/cms/update/make/{make.pk}/', HTTP_X_SCHEMA_ETAG=etag).json()
+        self.assertNotIn('sections', response)
+        self.assertEqual(response['data']['name'], make.name)
+
+        listing = self.client.get('/api/cms/list/make/').json()
+        self.assertTrue(listing['schema'])
+        listing = self.client.get('/api/cms/list/make/', HTTP_X_SCHEMA_ETAG=listing['schema_etag']).json()
+        self.assertIsNone(listing['schema'])
+
+    def test_list_page_queries(self):
+        user = User.objects.create_user(username='seller', password='secret')
+        city = City.objects.create(name='Harare')
+        seller = Seller.objects.create(name='Seller', email='seller@example.com', user=user, city=city)
+        make = Make.objects.first()
+        currency = Currency.objects.create(name='US Dollar', symbol='$')
+        for i in range(25):
+            model = Model.objects.create(make=make, name=f"Model {i}", year=2000 + i)
+            create_vehicle(seller, make, model, city, currency, photos=0, price=1000 + i)
+
+        self.client.get('/api/cms/list/vehicle/')  # builds the schema
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/cms/list/vehicle/').json()
+        # the count and the page, besides the request's savepoint
+        selects = [q for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 2)
+        self.assertEqual(response['count'], 25)
+        self.assertEqual(len(response['data']), 20)
+        row = response['data'][0]
+        vehicle = Vehicle.objects.get(pk=row['id'])
+        self.assertEqual(row, {
+            'make': 'Toyota', 'model': str(vehicle.model), 'price': vehicle.price,
+            'year': vehicle.year, 'name': str(vehicle), 'id': vehicle.pk,
+        })
+
+
+class RolePermissionCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='seller', password='secret')
+        city = City.objects.create(name='Harare')
+        self.role = Role.objects.create(role_name='Sales')
+        self.seller = Seller.objects.create(
+            name='Seller', email='seller@example.com', user=self.user, city=city, role=self.role
+        )
+        self.entity = ContentType.objects.get_for_model(Make)
+        self.permission = RolePermission.objects.create(role=self.role, entity=self.entity, can_read=True)
+
+    def check(self, permission, path):
+        return permission.has_permission(mock.Mock(path=path, user=self.user), None)
+
+    def test_checks_are_cached(self):
+        self.assertTrue(self.check(ReadPermission(), '/api/cms/list/make/'))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.check(ReadPermission(), '/api/cms/list/make/'))
+            self.assertFalse(self.check(ReadPermission(), '/api/cms/list/vehicle/'))
+
+    def test_invalidated_on_change(self):
+        self.assertTrue(self.check(ReadPermission(), '/api/cms/list/make/'))
+        self.permission.can_read = False
+        self.permission.save()
+        self.assertFalse(self.check(ReadPermission(), '/api/cms/list/make/'))
+
+        self.seller.role = None
+        self.seller.save()
+        self.assertFalse(self.check(DeletePermission(), '/api/cms/delete/make/'))
+
+    def test_revoked_through_cms_update(self):
+        other = Role.objects.create(role_name='Viewer')
+        self.assertTrue(self.check(ReadPermission(), '/api/cms/list/make/'))
+        data = {
+            'name': 'Seller', 'email': 'seller@example.com', 'user': self.user.pk,
+            'city': self.seller.city_id, 'role': other.pk,
+        }
+        JSONToModelParser(Seller, data, instance=self.seller, user=self.user).save()
+        self.assertEqual(Seller.objects.get(pk=self.seller.pk).role, other)
+        self.assertFalse(self.check(ReadPermission(), '/api/cms/list/make/'))
+
+    def test_expires_without_signals(self):
+        other = Role.objects.create(role_name='Viewer')
+        self.assertTrue(self.check(ReadPermission(), '/api/cms/list/make/'))
+        Seller.objects.filter(pk=self.seller.pk).update(role=other)
+        self.assertTrue(self.check(ReadPermission(), '/api/cms/list/make/'))
+        with override_settings(ROLE_PERMISSION_CACHE_TTL=0):
+            self.assertFalse(self.check(ReadPermission(), '/api/cms/list/make/'))
+
+    def test_shared_cache_required(self):
+        with override_settings(SHARED_CACHE_REQUIRED=True):
+            self.assertEqual([e.id for e in shared_cache_check(None)], ['auto_app.E001'])
+            with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://localhost:6379',
+            }}):
+                self.assertEqual(shared_cache_check(None), [])
+        self.assertEqual(shared_cache_check(None), [])
+
+    def test_version_from_another_process(self):
+        self.assertTrue(self.check(ReadPermission(), '/api/cms/list/make/'))
+        RolePermission.objects.filter(pk=self.permission.pk).update(can_read=False)
+        self.assertTrue(self.check(ReadPermission(), '/api/cms/list/make/'))
+        cache.incr(VERSION_KEY)
+        with override_settings(ROLE_PERMISSION_VERSION_CHECK_INTERVAL=0):
+            self.assertFalse(self.check(ReadPermission(), '/api/cms/list/make/'))
+
+
+class EntitlementTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='seller', password='secret')
+        city = City.objects.create(name='Harare')
+        Seller.objects.create(name='Seller', email='seller@example.com', user=self.user, city=city)
+        plan = SubscriptionPlan.objects.create(name='Monthly', price=10, tax=0, duration=30, description='')
+        self.subscription = Subscription.objects.create(user=self.user, plan=plan)
+        self.subscription.activate()
+
+    def fresh_user(self):
+        # a new request loads the user again
+        return User.objects.get(pk=self.user.pk)
+
+    def test_cached_across_requests(self):
+        user = self.fresh_user()
+        active = entitlements.entitlement(user)
+        self.assertEqual((active.subscription_id, active.plan), (self.subscription.pk, 'Monthly'))
+        with self.assertNumQueries(0):
+            self.assertTrue(entitlements.has_active_subscription(user))
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertEqual(entitlements.entitlement(user), active)
+
+    def test_invalidated_on_status_change(self):
+        self.assertTrue(entitlements.has_active_subscription(self.fresh_user()))
+        self.subscription.expire()
+        self.assertFalse(entitlements.has_active_subscription(self.fresh_user()))
+        self.subscription.activate()
+        self.assertTrue(entitlements.has_active_subscription(self.fresh_user()))
+
+    def test_activation_seen_by_other_workers(self):
+        user = User.objects.create_user(username='buyer')
+        plan = SubscriptionPlan.objects.get(name='Monthly')
+        with override_settings(ENTITLEMENT_NONE_TIMEOUT=0):
+            self.assertFalse(entitlements.has_active_subscription(User.objects.get(pk=user.pk)))
+            # activated by another worker, bulk_create sends no signal
+            Subscription.objects.bulk_create([Subscription(user=user, plan=plan, status='active')])
+            self.assertTrue(entitlements.has_active_subscription(User.objects.get(pk=user.pk)))
+
+        subscription = Subscription.objects.create(user=self.fresh_user(), plan=plan)
+        self.subscription.expire()
+        self.assertFalse(entitlements.has_active_subscription(self.fresh_user()))
+        subscription.activate()
+        cache.clear()  # a worker with a fresh cache
+        self.assertEqual(entitlements.entitlement(self.fresh_user()).subscription_id, subscription.pk)
+
+    def test_cached_until_expiry(self):
+        self.assertEqual(entitlements.timeout(None), settings.ENTITLEMENT_CACHE_TIMEOUT)
+        self.assertLessEqual(entitlements.timeout(timezone.localdate()), 24 * 3600)
+        self.assertEqual(entitlements.timeout(timezone.localdate() - timedelta(days=2)), 1)
+
+
+class TokenCacheTests(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+        self.user = User.objects.create_user(username='seller', password='secret')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def token_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/auth/current-user/')
+        return response, [q for q in queries.captured_queries if 'authtoken_token' in q['sql']]
+
+    def test_lookup_is_cached(self):
+        response, queries = self.token_queries()
+        self.assertEqual(response.json()['user']['username'], 'seller')
+        self.assertEqual(len(queries), 1)
+        response, queries = self.token_queries()
+        self.assertEqual(response.json()['user']['username'], 'seller')
+        self.assertEqual(queries, [])
+
+    def test_deactivated_user(self):
+        self.token_queries()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/auth/current-user/').status_code, 401)
+
+    def test_deleted_token(self):
+        self.token_queries()
+        self.token.delete()
+        self.assertEqual(self.client.get('/api/auth/current-user/').status_code, 401)
+
+    @override_settings(TOKEN_AUTH_VERSION_CHECK_INTERVAL=0)
+    def test_deleted_in_another_process(self):
+        self.addCleanup(cache.delete, TOKEN_VERSION_KEY)
+        self.token_queries()
+        # another process's cache bumps the shared version
+        TokenCache().discard(self.token.key)
+        self.assertEqual(len(self.token_queries()[1]), 1)
+
+    def test_login_keeps_tokens(self):
+        self.token_queries()
+        self.assertTrue(self.client.login(username='seller', password='secret'))
+        self.client.logout()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(self.token_queries()[1], [])
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        overrides = override_settings(REQUEST_METRICS_DIR=directory)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        metrics.reset()
+        self.addCleanup(metrics.request_metrics.clear)
+
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser(username='admin', password='secret'))
+        for name in ('Toyota', 'Honda'):
+            Make.objects.create(name=name, logo=f"make_logos/{name}.png")
+
+    @override_settings(REQUEST_QUERY_BUDGET=1)
+    def test_records_per_view(self):
+        with self.assertLogs(metrics.logger, 'WARNING') as logs:
+            for _ in range(3):
+                self.client.get('/api/cms/list/make/')
+        self.assertIn('over the budget of 1', logs.output[0])
+        response = self.client.get('/api/cms/request-metrics/').json()
+        entry = response['views']['GET api/cms/list/<str:entity>/']
+        self.assertEqual(entry['count'], 3)
+        self.assertEqual(entry['over_budget'], 3)
+        self.assertGreaterEqual(entry['queries']['mean'], 2)
+        self.assertGreater(entry['response_bytes']['mean'], 0)
+        self.assertGreater(entry['serialization_ms']['max'], 0)
+        self.assertEqual(sum(entry['queries']['histogram'].values()), 3)
+
+        out = io.StringIO()
+        call_command('request_metrics', stdout=out)
+        self.assertIn('GET api/cms/list/<str:entity>/', out.getvalue())
+
+    def test_merges_processes(self):
+        self.client.get('/api/cms/list/make/')
+        metrics.request_metrics.flush()
+        other = os.path.join(settings.REQUEST_METRICS_DIR, 'other-1.json')
+        shutil.copy(metrics.request_metrics.path(), other)
+        entry = metrics.summary()['GET api/cms/list/<str:entity>/']
+        self.assertEqual(entry['count'], 2)
+
+    def test_superuser_only(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='seller', password='secret'))
+        self.assertEqual(client.get('/api/cms/request-metrics/').status_code, 403)
+
+    @override_settings(REQUEST_METRICS_FLUSH_INTERVAL=0.05)
+    def test_flushed_off_the_request_thread(self):
+        self.addCleanup(metrics.request_metrics.stop)
+        metrics.request_metrics.stop()
+        flushed = threading.Event()
+        threads = []
+
+        def flush():
+            threads.append(threading.current_thread().name)
+            flushed.set()
+
+        with mock.patch.object(metrics.request_metrics, 'flush', side_effect=flush):
+            self.client.get('/api/cms/list/make/')
+            self.assertTrue(flushed.wait(5))
+        self.assertEqual(set(threads), {'request-metrics'})
+
+    @override_settings(SLOW_QUERY_MS=0)
+    def test_slow_queries_logged_without_values(self):
+        with self.assertLogs(metrics.logger, 'WARNING') as logs:
+            with connection.execute_wrapper(QueryTimer()):
+                list(User.objects.filter(username='secret-name', pk__in=range(100)))
+        self.assertIn('"username" = %s', logs.output[0])
+        self.assertIn('IN (%s, %s, ...)', logs.output[0])
+        self.assertNotIn('secret-name', logs.output[0])
+        self.assertEqual(
+            sql_template("SELECT *\n  FROM auth_user WHERE username = 'it''s me'"),
+            "SELECT * FROM auth_user WHERE username = '?'",
+        )
+
+
+class LogPipelineTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        overrides = override_settings(
+            LOG_DIR=self.directory, LOG_CONSOLE=False, LOG_MAX_BYTES=2000,
+            LOG_REMOTE_SINK={'BACKEND': 'auto_app.logging.MemorySink'}, LOG_REMOTE_BATCH_SIZE=3,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.pipeline = LogPipeline()
+        self.addCleanup(self.pipeline.stop)
+
+    def log(self, message, *args, **kwargs):
+        record = logging.getLogger('auto_app.tests').makeRecord(
+            'auto_app.tests', logging.ERROR, __file__, 1, message, args, None, extra=kwargs
+        )
+        self.pipeline.put(QueueHandler().prepare(record))
+
+    def test_writes_json_lines(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = logging.getLogger('auto_app.tests').makeRecord(
+                'auto_app.tests', logging.ERROR, __file__, 1, 'Failed', None, sys.exc_info()
+            )
+        self.pipeline.put(QueueHandler().prepare(record))
+        self.log("Vehicle %s not found", 7, vehicle=7)
+        self.pipeline.flush()
+
+        with open(os.path.join(self.directory, 'autohaus.jsonl')) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[0]['level'], 'ERROR')
+        self.assertIn('ValueError: boom', lines[0]['exception'])
+        self.assertEqual(lines[1]['message'], 'Vehicle 7 not found')
+        self.assertEqual(lines[1]['vehicle'], 7)
+
+    def test_rotates_and_ships_batches(self):
+        for i in range(20):
+            self.log(f"Message {i}")
+        self.pipeline.stop()
+
+        lines = []
+        for name in ('autohaus.jsonl.1', 'autohaus.jsonl'):
+            with open(os.path.join(self.directory, name)) as f:
+                lines.extend(json.loads(line)['message'] for line in f)
+        self.assertEqual(lines, [f"Message {i}" for i in range(20)])
+        batches = self.pipeline.sink.batches
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        messages = [json.loads(line)['message'] for batch in batches for line in batch]
+        self.assertEqual(messages, [f"Message {i}" for i in range(20)])
@@ -1,6 +1,6 @@
 from django.urls import path, re_path
 from auto_app.views import (
-    app, search, create_vehicle, search_vehicles,
+    app, search, create_vehicle, search_vehicles, search_facets,
     sign_up, login, submit_contact, get_user_details,
     save_listing, saved_listings, account_listings, reset_password, delete_account,
     update_account, remove_saved_listing, remove_listing,
@@ -18,7 +18,7 @@ from auto_app.views.serializers import (
 from auto_app.views.cms_api import (
     CMSListView, CMSCreateView, CMSUpdateView, CMSDeleteView,
     AuditTrailView, CurrentUserRolePermissionsView, DashboardAPIView,
-    SearchInputView, PhotoUploadView, PhotoDeleteView
+    SearchInputView, PhotoUploadView, PhotoDeleteView, RequestMetricsView
 )
 
 # Authentication Views
@@ -42,6 +42,7 @@ urlpatterns = [
     path("api/search/<str:model>/", search, name="search"),
     path("api/create-vehicle/", create_vehicle, name="create-vehicle"),
     path("api/search-vehicles/", search_vehicles, name="search-vehicles"),
+    path("api/search-vehicles/facets/", search_facets, name="search-facets"),
     path("api/sign-up/", sign_up, name="sign-up"),
     path("api/user-details/", get_user_details, name="user-details"),
     path("api/update-account/", update_account, name="update-account"),
@@ -64,6 +65,9 @@ urlpatterns = [
     path("api/submit-contact/", submit_contact, name="submit-contact"),
     path("api/login/", login, name="log-in"),
     path("api/upload-vehicle-image/", image_upload.upload_vehicle_image, name="upload-vehicle-image"),
+    path("api/upload-vehicle-images/", image_upload.upload_vehicle_images, name="upload-vehicle-images"),
+    path("api/uploads/", image_upload.start_upload, name="start-upload"),
+    path("api/uploads/<uuid:upload_id>/", image_upload.upload_chunk, name="upload-chunk"),
 
     # JWT Authentication
     path("api/auth/login/", LoginView.as_view(), name="jwt-login"),
@@ -79,6 +83,7 @@ urlpatterns = [
     path("api/cms/audit-trail/<str:entity>/<int:id>/", AuditTrailView.as_view(), name="cms-audit-trail"),
     path("api/cms/current-user-permissions/", CurrentUserRolePermissionsView.as_view(), name="cms-permissions"),
     path("api/cms/dashboard-stats/", DashboardAPIView.as_view(), name="cms-dashboard"),
+    path("api/cms/request-metrics/", RequestMetricsView.as_view(), name="cms-request-metrics"),
 
     # CMS Utilities
     path("api/cms/search-input/", SearchInputView.as_view(), name="cms-search-input"),
@@ -1,9 +1,7 @@
 # Utility functions for auto_app
 from django.core.files.base import ContentFile
-from django.db.models import Q
+from django.db.models import Count, Q
 import base64
-import boto3
-from auto_app.logging import logger
 
 
 def base64_file(data, name=None):
@@ -49,16 +47,21 @@ def seller_json(user):
     }
 
 
-def process_search(query_map):
-    from auto_app.models import Vehicle
+def search_filters(query_map):
+    """Builds the ORM filter for a vehicle search filter map"""
+    from auto_app.utils.search_index import search_params
 
-    filters = Q()
+    query_map = search_params(query_map)
+    filters = Q(published=True)
     if query_map.get('make'):
         filters.add(Q(make__id=query_map.get('make')), Q.AND)
 
     if query_map.get('model'):
         filters.add(Q(model__id=query_map.get('model')), Q.AND)
 
+    if query_map.get('city'):
+        filters.add(Q(city__id=query_map.get('city')), Q.AND)
+
     if query_map.get('transmission'):
         filters.add(Q(transmission__iexact=query_map.get('transmission')), Q.AND)
 
@@ -68,6 +71,12 @@ def process_search(query_map):
     if query_map.get('fuel_type'):
         filters.add(Q(fuel_type__iexact=query_map.get('fuel_type')), Q.AND)
 
+    if query_map.get('body_type'):
+        filters.add(Q(body_type__iexact=query_map.get('body_type')), Q.AND)
+
+    if query_map.get('condition'):
+        filters.add(Q(condition__iexact=query_map.get('condition')), Q.AND)
+
     if query_map.get('min_year'):
         filters.add(Q(year__gte=query_map.get('min_year')), Q.AND)
 
@@ -86,21 +95,97 @@ def process_search(query_map):
     if query_map.get('max_price') and query_map['max_price'] != '0':
         filters.add(Q(price__lte=query_map.get('max_price')), Q.AND)
 
-    order_by = query_map.get('sort_by') or 'price'
-    return Vehicle.objects.filter(filters).order_by(order_by)
-
-
-def upload_photo(file_path, name):
-    try:
-        logger.info(f"Tryging to upload {file_path}  {name}")
-        session = boto3.Session(profile_name="autohaus")
-        s3 = session.client('s3', region_name='af-south-1')
-        existing = f"Existing buckets: {[b for b in s3.list_buckets()]}"
-        logger.info(existing)
-        s3.upload_file(file_path, 'autohaus-mukuta', name)
-    except Exception as e:
-        logger.error(f"Failed to upload file {name}: {str(e)}")
-        return False
+    return filters
+
+
+def process_search(query_map):
+    from auto_app.models import Vehicle
+    from auto_app.utils.search_index import vehicle_index, search_params
+    from auto_app.utils.pagination import ordering
+
+    order_by = ordering(search_params(query_map).get('sort_by'))
+
+    # answered by the in-memory index when it is warm
+    pks = vehicle_index.search(query_map)
+    if pks is None:
+        return Vehicle.objects.filter(search_filters(query_map)).order_by(*order_by)
+    return Vehicle.objects.filter(pk__in=pks).order_by(*order_by)
+
+
+def database_facets(queryset):
+    """
+    ``{facet: {value: count}}`` for a vehicle queryset, counted by the
+    database, keyed like the search index's facets.
+    """
+    from auto_app.utils.search_index import (
+        FACET_FIELDS, ID_FIELDS, PRICE_BUCKETS, price_bucket, year_bucket
+    )
+
+    counts = {}
+    for facet, column in FACET_FIELDS.items():
+        values = {}
+        for value, count in queryset.values_list(column).annotate(count=Count('pk')).order_by():
+            if facet not in ID_FIELDS and value is not None:
+                value = value.lower()
+            values[value] = values.get(value, 0) + count
+        counts[facet] = values
+
+    counts['year'] = {}
+    for year, count in queryset.values_list('year').annotate(count=Count('pk')).order_by():
+        bucket = year_bucket(year or 0)
+        counts['year'][bucket] = counts['year'].get(bucket, 0) + count
+
+    buckets = {}
+    for i, low in enumerate(PRICE_BUCKETS):
+        condition = Q(price__gte=low) if i else Q(price__lt=PRICE_BUCKETS[1]) | Q(price__isnull=True)
+        if 0 < i < len(PRICE_BUCKETS) - 1:
+            condition &= Q(price__lt=PRICE_BUCKETS[i + 1])
+        buckets[f'price_{i}'] = Count('pk', filter=condition)
+    totals = queryset.aggregate(**buckets)
+    counts['price'] = {
+        price_bucket(low): totals[f'price_{i}']
+        for i, low in enumerate(PRICE_BUCKETS) if totals[f'price_{i}']
+    }
+    return counts
+
+
+def vehicle_facets(query_map):
+    """
+    Per-facet counts for a vehicle search, from the same source as its
+    results: the search index when it answers the search, the database
+    otherwise.
+    """
+    from auto_app.models import Vehicle, Make, Model, City
+    from auto_app.utils.search_index import vehicle_index, FACET_FIELDS
+
+    bitmap = vehicle_index.results(query_map)
+    if bitmap is not None:
+        counts = vehicle_index.facets(bitmap)
     else:
-        logger.info("Uploaded file successfully")
-        return True
+        counts = database_facets(Vehicle.objects.filter(search_filters(query_map)))
+
+    labels = {
+        'make': dict(Make.objects.filter(pk__in=counts['make']).values_list('pk', 'name')),
+        'model': {m.pk: str(m) for m in Model.objects.filter(pk__in=counts['model'])},
+        'city': dict(City.objects.filter(pk__in=counts['city']).values_list('pk', 'name')),
+    }
+    for facet in FACET_FIELDS:
+        if facet not in labels:
+            choices = Vehicle._meta.get_field(facet).choices
+            labels[facet] = {value.lower(): label for value, label in choices}
+
+    facets = {}
+    for facet, values in counts.items():
+        entries = [
+            {'value': value, 'label': labels.get(facet, {}).get(value, value), 'count': count}
+            for value, count in values.items()
+            if value is not None
+        ]
+        if facet in FACET_FIELDS:
+            entries.sort(key=lambda e: (-e['count'], str(e['label'])))
+        else:
+            # buckets are labelled "<start>-<end>" or "<start>+"
+            entries.sort(key=lambda e: int(e['value'].split('-')[0].rstrip('+')))
+        facets[facet] = entries
+    return facets
+
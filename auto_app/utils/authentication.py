@@ -0,0 +1,131 @@
+"""
+Token authentication without a query per request.
+
+``token_cache`` maps token keys to a snapshot of the token and its user,
+bounded to ``TOKEN_AUTH_CACHE_SIZE`` entries that live for
+``TOKEN_AUTH_CACHE_TTL`` seconds. CachedTokenAuthentication, which
+replaces DRF's TokenAuthentication, reads through it. TokenAuthMiddleware
+does too, but it isn't in MIDDLEWARE, so today only the API views use the
+cache. Each hit builds new Token and User instances, so nothing set on them
+during a request leaks into the next.
+
+Deleting a token or saving a user, other than just its last login, drops
+their entries in this process (see auto_app.signals) and bumps a version in
+the shared cache (see SHARED_CACHE_REQUIRED); other processes notice within
+TOKEN_AUTH_VERSION_CHECK_INTERVAL seconds and drop all their entries.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import router
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+VERSION_KEY = 'token_auth:version'
+
+
+class TokenCache:
+    """Least recently used, time limited cache of token snapshots"""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = 0.0
+
+    def _sync(self, now):
+        if now - self._checked < getattr(settings, 'TOKEN_AUTH_VERSION_CHECK_INTERVAL', 1.0):
+            return
+        version = cache.get(VERSION_KEY)
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._checked = now
+
+    def _invalidate(self):
+        """Tells the other processes to drop their entries"""
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.set(VERSION_KEY, 1, None)
+        with self._lock:
+            self._version = cache.get(VERSION_KEY)
+            self._checked = time.monotonic()
+
+    def _snapshot(self, token):
+        user = token.user
+        values = tuple(getattr(user, f.attname) for f in User._meta.concrete_fields)
+        return token.created, values
+
+    def _restore(self, key, snapshot):
+        created, values = snapshot
+        user = User.from_db(
+            router.db_for_read(User), [f.attname for f in User._meta.concrete_fields], values
+        )
+        token = Token(key=key, user=user, created=created)
+        token._state.adding = False
+        return token
+
+    def get(self, key):
+        """The Token for ``key`` with its user, None if there is no such token"""
+        now = time.monotonic()
+        self._sync(now)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return self._restore(key, entry[1])
+            version = self._version
+
+        try:
+            token = Token.objects.select_related('user').get(key=key)
+        except Token.DoesNotExist:
+            return None
+        snapshot = self._snapshot(token)
+        with self._lock:
+            # don't keep what an invalidation during the query made stale
+            if version != self._version:
+                return token
+            self._entries[key] = (now + getattr(settings, 'TOKEN_AUTH_CACHE_TTL', 60), snapshot)
+            self._entries.move_to_end(key)
+            while len(self._entries) > getattr(settings, 'TOKEN_AUTH_CACHE_SIZE', 10000):
+                self._entries.popitem(last=False)
+        return token
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        self._invalidate()
+
+    def discard_user(self, user_id):
+        pk_index = [f.attname for f in User._meta.concrete_fields].index(User._meta.pk.attname)
+        with self._lock:
+            for key in [k for k, (_, (_, values)) in self._entries.items() if values[pk_index] == user_id]:
+                del self._entries[key]
+        self._invalidate()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication reading tokens through ``token_cache``"""
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return token.user, token
@@ -0,0 +1,311 @@
+"""
+Content addressed storage for uploaded images.
+
+VehiclePhoto and CMSImage files are stored under the SHA-256 of their
+content, e.g. ``vehicle_photos/3f/3fa9...c2.jpg``, so the same photo
+uploaded again (a seller relisting a car, say) reuses the stored file.
+Each stored file has an ImageBlob row counting the photos and images that
+point to it. Signals keep the count as rows are saved and deleted,
+including the cascades from deleting vehicles.
+
+The thumbnail and variants rendered for a file are recorded on its blob
+and copied to later rows with the same content instead of being rendered
+again (see auto_app.utils.thumbnails).
+
+A blob whose count drops to zero stays on disk for ``BLOB_GC_GRACE``
+seconds, so a re-upload in the meantime revives it. ``collect`` then
+removes it with its thumbnail and variants, run by
+``manage.py collect_blobs``. It moves each file aside before checking the
+blob is still unused, so an upload of the same content racing it either
+keeps the blob or writes the file again.
+"""
+import hashlib
+import os
+import posixpath
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from auto_app.logging import logger
+
+
+HASH_BLOCK_SIZE = 64 * 1024
+
+
+def content_digest(content):
+    """The SHA-256 hex digest and size of a file's content"""
+    digest = hashlib.sha256()
+    size = 0
+    content.seek(0)
+    for chunk in content.chunks(HASH_BLOCK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+    content.seek(0)
+    return digest.hexdigest(), size
+
+
+class BlobStorage(FileSystemStorage):
+    """
+    Saves files as ``<upload_to>/<aa>/<sha256><ext>``, skipping the write
+    when the same content is already stored.
+    """
+
+    def __init__(self, **kwargs):
+        # identical names mean identical content, overwriting is harmless
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(**kwargs)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest, _ = content_digest(content)
+        directory = posixpath.dirname(name.replace('\\', '/'))
+        extension = os.path.splitext(name)[1].lower()
+        name = posixpath.join(directory, digest[:2], digest + extension)
+
+        if self.exists(name):
+            # mark it as in use so a concurrent collect leaves it alone
+            try:
+                os.utime(self.path(name))
+                return name
+            except FileNotFoundError:
+                # claimed by collect in the meantime, write it again
+                pass
+        return self._save(name, content)
+
+
+storage = BlobStorage()
+
+
+def blob_storage():
+    return storage
+
+
+def image_models():
+    """The models whose image field is content addressed"""
+    return [apps.get_model('auto_app', 'VehiclePhoto'), apps.get_model('auto_app', 'CMSImage')]
+
+
+def digest_of(name):
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return stem if len(stem) == 64 else ''
+
+
+def acquire(names):
+    """Adds a reference to each name, creating missing blobs"""
+    from auto_app.models import ImageBlob
+
+    counts = Counter(name for name in names if name)
+    if not counts:
+        return
+    existing = set(ImageBlob.objects.filter(name__in=counts).values_list('name', flat=True))
+    missing = []
+    for name in counts.keys() - existing:
+        try:
+            size = storage.size(name)
+        except OSError:
+            size = 0
+        missing.append(ImageBlob(name=name, digest=digest_of(name), size=size))
+    ImageBlob.objects.bulk_create(missing, ignore_conflicts=True)
+
+    by_count = {}
+    for name, count in counts.items():
+        by_count.setdefault(count, []).append(name)
+    for count, group in by_count.items():
+        ImageBlob.objects.filter(name__in=group).update(
+            refcount=F('refcount') + count, released_at=None
+        )
+
+
+def release(names):
+    """Removes a reference from each name"""
+    from auto_app.models import ImageBlob
+
+    counts = Counter(name for name in names if name)
+    by_count = {}
+    for name, count in counts.items():
+        by_count.setdefault(count, []).append(name)
+    for count, group in by_count.items():
+        ImageBlob.objects.filter(name__in=group).update(refcount=F('refcount') - count)
+    ImageBlob.objects.filter(name__in=counts, refcount__lte=0, released_at__isnull=True) \
+        .update(released_at=timezone.now())
+
+
+def derived(model, names):
+    """
+    ``{name: fields}`` of the thumbnail, variants and size already rendered
+    for the given image names, for the names that have them.
+    """
+    from auto_app.models import ImageBlob
+
+    needs_thumbnail = any(f.name == 'thumbnail' for f in model._meta.fields)
+    found = {}
+    for blob in ImageBlob.objects.filter(name__in=set(names)).exclude(variants={}):
+        if needs_thumbnail and not blob.thumbnail:
+            continue
+        fields = {'width': blob.width, 'height': blob.height, 'variants': blob.variants}
+        if needs_thumbnail:
+            fields['thumbnail'] = blob.thumbnail
+        found[blob.name] = fields
+    return found
+
+
+def record(name, fields):
+    """Records the files rendered for an image on its blob"""
+    from auto_app.models import ImageBlob
+
+    blob_fields = {k: v for k, v in fields.items() if k in ('width', 'height', 'variants', 'thumbnail')}
+    ImageBlob.objects.filter(name=name).update(**blob_fields)
+
+
+def rendered_files(blob):
+    """The paths of the thumbnail and variants rendered from a blob's file"""
+    from auto_app.utils.thumbnails import FORMATS
+
+    paths = []
+    if blob.thumbnail:
+        paths.append(default_storage.path(blob.thumbnail))
+    for size in (blob.variants or {}).get('sizes', []):
+        paths.extend(default_storage.path(size[fmt]) for fmt in FORMATS if size.get(fmt))
+    return paths
+
+
+def unlink(path):
+    try:
+        size = os.stat(path).st_size
+        os.unlink(path)
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logger.error(f"Failed to delete {path}: {str(e)}")
+        return 0
+    return size
+
+
+def unlink_all(paths, workers=None):
+    """Unlinks files on a thread pool, returning the bytes freed"""
+    paths = list(paths)
+    if not paths:
+        return 0
+    workers = workers or getattr(settings, 'SWEEP_WORKERS', 8)
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        return sum(executor.map(unlink, paths))
+
+
+def claim(name):
+    """
+    Moves a blob's file aside before it is deleted, so a save from then on
+    writes the file again instead of finding it about to go. Returns the
+    new path, or None if the file is gone already.
+    """
+    path = storage.path(name)
+    claimed = f"{path}.collecting"
+    try:
+        os.replace(path, claimed)
+    except FileNotFoundError:
+        return None
+    return claimed
+
+
+def unclaim(name, claimed):
+    """Puts back a claimed file that is no longer being collected"""
+    try:
+        # a save since the claim wrote the same content, replacing it is harmless
+        os.replace(claimed, storage.path(name))
+    except OSError as e:
+        logger.error(f"Failed to restore {name}: {str(e)}")
+
+
+def recently_used(path, cutoff):
+    try:
+        return os.path.getmtime(path) >= cutoff.timestamp()
+    except OSError:
+        return False
+
+
+def collect(batch_size=None, grace=None, pause=0.0):
+    """
+    Removes blobs nobody has referenced for ``grace`` seconds, with their
+    rendered files, ``batch_size`` at a time. Returns the number of blobs
+    removed and the bytes freed.
+    """
+    from auto_app.models import ImageBlob
+
+    batch_size = batch_size or getattr(settings, 'BLOB_GC_BATCH_SIZE', 500)
+    grace = grace if grace is not None else getattr(settings, 'BLOB_GC_GRACE', 3600)
+    cutoff = timezone.now() - timedelta(seconds=grace)
+
+    collected, freed, last_pk = 0, 0, 0
+    while True:
+        with transaction.atomic():
+            blobs = list(
+                ImageBlob.objects.select_for_update()
+                .filter(pk__gt=last_pk, refcount__lte=0, released_at__lt=cutoff)
+                .order_by('pk')[:batch_size]
+            )
+            if not blobs:
+                return collected, freed
+            last_pk = blobs[-1].pk
+            claimed = {blob.pk: claim(blob.name) for blob in blobs}
+            # a file saved again since the cutoff is about to be referenced,
+            # and a blob may have been acquired since the select
+            recent = {pk for pk, path in claimed.items() if path and recently_used(path, cutoff)}
+            collectable = set(
+                ImageBlob.objects.select_for_update()
+                .filter(pk__in=claimed, refcount__lte=0, released_at__lt=cutoff)
+                .values_list('pk', flat=True)
+            ) - recent
+            for blob in blobs:
+                if blob.pk not in collectable and claimed[blob.pk]:
+                    unclaim(blob.name, claimed[blob.pk])
+            blobs = [blob for blob in blobs if blob.pk in collectable]
+            ImageBlob.objects.filter(pk__in=collectable).delete()
+            freed += unlink_all(
+                [claimed[blob.pk] for blob in blobs if claimed[blob.pk]]
+                + [path for blob in blobs for path in rendered_files(blob)]
+            )
+        collected += len(blobs)
+        if pause:
+            time.sleep(pause)
+
+
+def recount():
+    """
+    Recomputes every reference count from the image rows, repairing drift
+    from bulk updates that bypass the signals. Returns the number of
+    blobs changed.
+    """
+    from auto_app.models import ImageBlob
+
+    counts = Counter()
+    for model in image_models():
+        rows = model.objects.exclude(**{model.image_field: ''}) \
+            .values(model.image_field).annotate(count=Count('pk')).order_by()
+        for row in rows:
+            counts[row[model.image_field]] += row['count']
+
+    acquire(set(counts) - set(ImageBlob.objects.filter(name__in=counts).values_list('name', flat=True)))
+    changed = []
+    now = timezone.now()
+    for blob in ImageBlob.objects.all().iterator():
+        refcount = counts.get(blob.name, 0)
+        if blob.refcount == refcount:
+            continue
+        blob.refcount = refcount
+        blob.released_at = None if refcount else (blob.released_at or now)
+        changed.append(blob)
+    ImageBlob.objects.bulk_update(changed, ['refcount', 'released_at'], batch_size=500)
+    if changed:
+        logger.info(f"Repaired {len(changed)} image blob reference counts")
+    return len(changed)
@@ -0,0 +1,311 @@
+"""
+Offloading vehicle photos to an S3 compatible CDN bucket.
+
+Once a photo's thumbnail is rendered (see auto_app.utils.thumbnails) the
+photo is queued here. A background thread uploads the original and the
+thumbnail concurrently on a thread pool, through one client per process
+whose connection pool the threads share, and files above
+``CDN_MULTIPART_THRESHOLD`` go up as multipart uploads in parallel parts.
+Failed uploads are retried with exponential backoff, and ``cdn_photo`` and
+``cdn_thumbnail`` are filled in once both files are up.
+
+Objects are keyed by the stored file names, which are content addressed
+(see auto_app.utils.blobs), so a photo uploaded twice is offloaded once.
+
+``CDN_BACKEND`` picks the S3 backend, for AWS or a local S3 compatible
+server such as MinIO through ``CDN_ENDPOINT_URL``, or the filesystem
+backend, which copies the files into ``CDN_LOCAL_DIR`` for development and
+tests. ``manage.py offload_photos`` queues any photo not offloaded yet.
+"""
+import mimetypes
+import os
+import queue
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.db.models import Q
+from django.dispatch import receiver
+
+from auto_app.logging import logger
+
+
+MB = 1024 * 1024
+# content addressed names never change content
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class S3Backend:
+    """Uploads to an S3 bucket with one client shared by every thread"""
+
+    def __init__(self, bucket, public_url, region=None, endpoint_url=None, profile=None,
+                 workers=4, multipart_threshold=8 * MB, multipart_chunksize=8 * MB):
+        self.bucket = bucket
+        self.public_url = public_url.rstrip('/')
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.profile = profile
+        self.workers = workers
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self._client = None
+        self._transfer_config = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import boto3
+                from boto3.s3.transfer import TransferConfig
+                from botocore.config import Config
+
+                concurrency = 4
+                session = boto3.Session(profile_name=self.profile)
+                self._client = session.client(
+                    's3', region_name=self.region, endpoint_url=self.endpoint_url,
+                    config=Config(
+                        # enough connections for every worker's parts
+                        max_pool_connections=self.workers * concurrency,
+                        retries={'mode': 'standard'},
+                    ),
+                )
+                self._transfer_config = TransferConfig(
+                    multipart_threshold=self.multipart_threshold,
+                    multipart_chunksize=self.multipart_chunksize,
+                    max_concurrency=concurrency,
+                )
+            return self._client
+
+    def upload(self, source, key, content_type):
+        client = self.client
+        extra = {'ContentType': content_type, 'CacheControl': CACHE_CONTROL}
+        if isinstance(source, (str, Path)):
+            client.upload_file(str(source), self.bucket, key, ExtraArgs=extra, Config=self._transfer_config)
+        else:
+            client.upload_fileobj(source, self.bucket, key, ExtraArgs=extra, Config=self._transfer_config)
+
+    def url(self, key):
+        return f"{self.public_url}/{key}"
+
+
+class FileSystemBackend:
+    """Copies files into a directory, a stand-in for the bucket"""
+
+    def __init__(self, location, public_url):
+        self.location = Path(location)
+        self.public_url = public_url.rstrip('/')
+
+    def upload(self, source, key, content_type):
+        path = self.location / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write aside and rename, so readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as f:
+            if isinstance(source, (str, Path)):
+                with open(source, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+            else:
+                shutil.copyfileobj(source, f)
+        os.replace(f.name, path)
+
+    def url(self, key):
+        return f"{self.public_url}/{key}"
+
+
+def create_backend():
+    public_url = getattr(settings, 'CDN_PUBLIC_URL', '')
+    if getattr(settings, 'CDN_BACKEND', 's3') == 'filesystem':
+        return FileSystemBackend(
+            getattr(settings, 'CDN_LOCAL_DIR', Path(settings.BASE_DIR) / 'cdn'),
+            public_url or '/cdn',
+        )
+    return S3Backend(
+        bucket=settings.CDN_BUCKET,
+        public_url=public_url,
+        region=getattr(settings, 'CDN_REGION', None),
+        endpoint_url=getattr(settings, 'CDN_ENDPOINT_URL', None),
+        profile=getattr(settings, 'CDN_PROFILE', None),
+        workers=getattr(settings, 'CDN_WORKERS', 4),
+        multipart_threshold=getattr(settings, 'CDN_MULTIPART_THRESHOLD', 8 * MB),
+        multipart_chunksize=getattr(settings, 'CDN_MULTIPART_CHUNKSIZE', 8 * MB),
+    )
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend()
+        return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    global _backend
+    if setting.startswith('CDN_'):
+        _backend = None
+
+
+def enabled():
+    return getattr(settings, 'CDN_OFFLOAD', False)
+
+
+def retryable(error):
+    """Whether an upload error may go away on its own"""
+    if isinstance(error, (FileNotFoundError, IsADirectoryError, PermissionError)):
+        return False
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        # botocore ClientError: only throttling and server errors
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+        return status >= 500 or status in (408, 429)
+    return True
+
+
+def with_retries(func, *args):
+    """
+    Calls ``func``, retrying failures up to ``CDN_MAX_ATTEMPTS`` times with
+    exponential backoff and full jitter.
+    """
+    attempts = getattr(settings, 'CDN_MAX_ATTEMPTS', 5)
+    delay = getattr(settings, 'CDN_RETRY_DELAY', 0.5)
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt == attempts or not retryable(e):
+                raise
+            logger.error(f"Upload attempt {attempt} failed, retrying: {str(e)}")
+            time.sleep(random.uniform(0, delay * 2 ** (attempt - 1)))
+
+
+def upload(backend, field_file):
+    """Uploads a stored file under its name and returns its CDN URL"""
+    key = field_file.name
+    content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+    def send():
+        try:
+            source = field_file.path
+        except NotImplementedError:
+            with field_file.storage.open(key, 'rb') as f:
+                return backend.upload(f, key, content_type)
+        return backend.upload(source, key, content_type)
+
+    with_retries(send)
+    return backend.url(key)
+
+
+def pending():
+    """Photos with a thumbnail that aren't on the CDN yet"""
+    from auto_app.models import VehiclePhoto
+
+    return VehiclePhoto.objects.exclude(photo='').exclude(thumbnail='').exclude(thumbnail__isnull=True) \
+        .filter(Q(cdn_photo__isnull=True) | Q(cdn_photo='') | Q(cdn_thumbnail__isnull=True) | Q(cdn_thumbnail=''))
+
+
+def offload(pks, executor):
+    """
+    Uploads the photos and thumbnails of the given VehiclePhoto rows on
+    ``executor`` and records their CDN URLs. Returns the number of rows
+    offloaded.
+    """
+    from auto_app.models import VehiclePhoto
+
+    by_name = {}
+    for photo in pending().filter(pk__in=list(pks)):
+        by_name.setdefault(photo.photo.name, []).append(photo)
+    if not by_name:
+        return 0
+
+    # the same content offloaded for another row
+    done = {}
+    existing = VehiclePhoto.objects.filter(photo__in=list(by_name)) \
+        .exclude(cdn_photo__isnull=True).exclude(cdn_photo='') \
+        .exclude(cdn_thumbnail__isnull=True).exclude(cdn_thumbnail='') \
+        .values_list('photo', 'cdn_photo', 'cdn_thumbnail')
+    for name, cdn_photo, cdn_thumbnail in existing:
+        done[name] = (cdn_photo, cdn_thumbnail)
+
+    backend = get_backend()
+    futures = {}
+    for name, photos in by_name.items():
+        if name not in done:
+            futures[name] = (
+                executor.submit(upload, backend, photos[0].photo),
+                executor.submit(upload, backend, photos[0].thumbnail),
+            )
+
+    for name, (photo_future, thumbnail_future) in futures.items():
+        try:
+            done[name] = (photo_future.result(), thumbnail_future.result())
+        except Exception as e:
+            logger.error(f"Failed to offload {name}: {str(e)}")
+
+    offloaded = 0
+    for name, (cdn_photo, cdn_thumbnail) in done.items():
+        pks = [photo.pk for photo in by_name[name]]
+        # update() so saving doesn't queue the photo again
+        offloaded += VehiclePhoto.objects.filter(pk__in=pks).update(
+            cdn_photo=cdn_photo, cdn_thumbnail=cdn_thumbnail
+        )
+    return offloaded
+
+
+def upload_pool(workers=None):
+    return ThreadPoolExecutor(max_workers=workers or getattr(settings, 'CDN_WORKERS', 4))
+
+
+class OffloadWorker:
+    """Background thread that batches queued photos and offloads them"""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self._thread = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = upload_pool()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            pks = {self.queue.get()}
+            while not self.queue.empty():
+                pks.add(self.queue.get_nowait())
+            try:
+                offload(pks, self._executor)
+            except Exception as e:
+                logger.error(f"Failed to offload photos {sorted(pks)}: {str(e)}")
+            finally:
+                connection.close()
+
+    def enqueue_many(self, model, pks):
+        if not enabled() or not any(f.name == 'cdn_photo' for f in model._meta.fields):
+            return
+        if getattr(settings, 'CDN_BACKGROUND', True):
+            for pk in pks:
+                self.queue.put(pk)
+            self._start()
+        else:
+            with upload_pool() as executor:
+                offload(pks, executor)
+
+
+offload_worker = OffloadWorker()
@@ -1,11 +1,180 @@
+"""
+Sweeping up what abandoned uploads leave behind.
+
+``sweep`` deletes, in bounded batches:
+
+* temporary vehicles (created while their photos upload) older than
+  ``SWEEP_TEMPORARY_VEHICLE_HOURS``, with their photos;
+* photos uploaded through the CMS but never attached to a vehicle;
+* chunked uploads abandoned before completing;
+* files in the image directories that no row or blob refers to, e.g. from
+  a crash between storing a file and committing its row.
+
+Deleting rows releases their image blobs (see auto_app.utils.blobs), which
+``blobs.collect`` then removes with their thumbnails and variants. Files
+are unlinked on a thread pool. Run it with ``manage.py sweep_media``.
+"""
+import os
+import time
 from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
 from django.utils import timezone
-from auto_app.models import Vehicle, User, Make, Model
+from auto_app.models import Vehicle, VehiclePhoto, CMSImage, ImageBlob, UploadSession
+from auto_app.utils import blobs
+from auto_app.utils.thumbnails import FORMATS
+from auto_app.utils.uploads import session_path
+
+
+def delete_in_batches(queryset, batch_size, pause=0.0):
+    """Deletes the rows of ``queryset`` ``batch_size`` at a time"""
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            queryset.model.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
+        if pause:
+            time.sleep(pause)
+
 
-def cleanup_temporary_vehicles():
+def batch_size_setting(batch_size):
+    return batch_size or getattr(settings, 'SWEEP_BATCH_SIZE', 500)
+
+
+def cleanup_temporary_vehicles(hours=None, batch_size=None, pause=0.0):
     """Delete temporary vehicles older than 24 hours"""
-    cutoff = timezone.now() - timedelta(hours=24)
-    Vehicle.objects.filter(
-        temporary=True,
-        created_at__lt=cutoff
-    ).delete()
+    hours = hours if hours is not None else getattr(settings, 'SWEEP_TEMPORARY_VEHICLE_HOURS', 24)
+    cutoff = timezone.now() - timedelta(hours=hours)
+    return delete_in_batches(
+        Vehicle.objects.filter(temporary=True, created_at__lt=cutoff),
+        batch_size_setting(batch_size), pause,
+    )
+
+
+def cleanup_orphan_photos(hours=None, batch_size=None, pause=0.0):
+    """Delete photos uploaded without a vehicle and never attached to one"""
+    hours = hours if hours is not None else getattr(settings, 'SWEEP_ORPHAN_PHOTO_HOURS', 24)
+    cutoff = timezone.now() - timedelta(hours=hours)
+    return delete_in_batches(
+        VehiclePhoto.objects.filter(vehicle__isnull=True, created_at__lt=cutoff),
+        batch_size_setting(batch_size), pause,
+    )
+
+
+def cleanup_uploads(hours=None, batch_size=None, workers=None):
+    """
+    Delete chunked uploads that haven't received a chunk for ``hours``.
+    Returns the number deleted and the bytes freed.
+    """
+    hours = hours if hours is not None else getattr(settings, 'CHUNKED_UPLOAD_EXPIRY_HOURS', 24)
+    cutoff = timezone.now() - timedelta(hours=hours)
+
+    deleted, freed = 0, 0
+    while True:
+        sessions = list(UploadSession.objects.filter(updated_at__lt=cutoff)[:batch_size_setting(batch_size)])
+        if not sessions:
+            return deleted, freed
+        UploadSession.objects.filter(pk__in=[s.pk for s in sessions]).delete()
+        deleted += len(sessions)
+        freed += blobs.unlink_all((session_path(s) for s in sessions), workers)
+
+
+def image_directories():
+    """``(storage, directory)`` for every directory the image models write to"""
+    directories = set()
+    for model in (VehiclePhoto, CMSImage):
+        for field in model._meta.fields:
+            if field.get_internal_type() in ('FileField', 'ImageField'):
+                directories.add((field.storage, field.upload_to.rstrip('/')))
+        directories.add((default_storage, model.variants_upload_to.rstrip('/')))
+    return directories
+
+
+def manifest_files(manifest):
+    for size in (manifest or {}).get('sizes', []):
+        for name in FORMATS:
+            if size.get(name):
+                yield size[name]
+
+
+def referenced_files():
+    """The names of every stored image and rendered file still in use"""
+    names = set()
+    for name, thumbnail, variants in ImageBlob.objects.values_list('name', 'thumbnail', 'variants').iterator():
+        names.update((name, thumbnail))
+        names.update(manifest_files(variants))
+    # rows whose blob counts have drifted still keep their files
+    for photo, thumbnail, variants in VehiclePhoto.objects.values_list('photo', 'thumbnail', 'variants').iterator():
+        names.update((photo, thumbnail))
+        names.update(manifest_files(variants))
+    for image, variants in CMSImage.objects.values_list('image', 'variants').iterator():
+        names.add(image)
+        names.update(manifest_files(variants))
+    names.discard('')
+    names.discard(None)
+    return names
+
+
+def untracked_files(grace):
+    """
+    Paths of the files in the image directories that nothing refers to
+    and that haven't been written for ``grace`` seconds.
+    """
+    referenced = referenced_files()
+    cutoff = time.time() - grace
+    for storage, directory in image_directories():
+        root = storage.path(directory)
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, storage.location).replace(os.sep, '/')
+                if name in referenced:
+                    continue
+                try:
+                    if os.path.getmtime(path) >= cutoff:
+                        continue
+                except OSError:
+                    continue
+                yield path
+
+
+def cleanup_untracked_files(grace=None, batch_size=None, workers=None):
+    """
+    Delete files in the image directories that no row refers to. Returns
+    the number deleted and the bytes freed.
+    """
+    grace = grace if grace is not None else getattr(settings, 'BLOB_GC_GRACE', 3600)
+    batch_size = batch_size_setting(batch_size)
+
+    deleted, freed, batch = 0, 0, []
+    for path in untracked_files(grace):
+        batch.append(path)
+        if len(batch) >= batch_size:
+            freed += blobs.unlink_all(batch, workers)
+            deleted += len(batch)
+            batch = []
+    freed += blobs.unlink_all(batch, workers)
+    return deleted + len(batch), freed
+
+
+def sweep(batch_size=None, workers=None, grace=None, pause=0.0):
+    """
+    Runs every cleanup and collects the blobs they released. Returns a
+    report of the rows and files deleted and the bytes freed.
+    """
+    report = {
+        'temporary_vehicles': cleanup_temporary_vehicles(batch_size=batch_size, pause=pause),
+        'orphan_photos': cleanup_orphan_photos(batch_size=batch_size, pause=pause),
+    }
+    report['uploads'], uploads_freed = cleanup_uploads(batch_size=batch_size, workers=workers)
+    report['blobs'], blobs_freed = blobs.collect(batch_size=batch_size, grace=grace, pause=pause)
+    report['untracked_files'], untracked_freed = cleanup_untracked_files(
+        grace=grace, batch_size=batch_size, workers=workers
+    )
+    report['bytes_freed'] = uploads_freed + blobs_freed + untracked_freed
+    return report
@@ -0,0 +1,249 @@
+"""
+IP geolocation from a local range database.
+
+``manage.py build_geoip_database`` compiles a CSV of IP ranges into a
+binary file of fixed-width, sorted ``(start, end, location)`` records, one
+table for IPv4 and one for IPv6. The file is memory-mapped and looked up
+with a binary search over the raw big-endian addresses, so nothing is parsed
+per lookup and the table isn't copied into every process's heap. An LRU
+cache of recent IPs sits in front of the lookup.
+
+Until a database file has been built, addresses are looked up with
+ip-api.com as before. ``GEOIP_HTTP_FALLBACK`` True also sends the addresses
+the database misses there, False never uses it. Failed HTTP lookups aren't
+cached, so they are retried.
+"""
+import bisect
+import ipaddress
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from django.conf import settings
+
+from auto_app.logging import logger
+
+
+MAGIC = b'AHGEOIP1'
+HEADER = struct.Struct('<8sIII')  # magic, ipv4 records, ipv6 records, locations bytes
+LOCATION_INDEX = struct.Struct('<I')
+ADDRESS_SIZES = {4: 4, 6: 16}
+
+LOCAL_ADDRESSES = ('127.0.0.1', 'localhost', '::1')
+LOCATION_FIELDS = ['city', 'region', 'country', 'country_code', 'lat', 'lon']
+
+# seconds between checks for a rebuilt database file
+RELOAD_INTERVAL = 60
+
+
+def empty_location():
+    return {'city': '', 'region': '', 'country': '', 'country_code': '', 'lat': None, 'lon': None}
+
+
+def local_location():
+    return {
+        'city': 'Local', 'region': 'Local', 'country': 'Local', 'country_code': 'LO',
+        'lat': None, 'lon': None,
+    }
+
+
+def write_database(path, ranges):
+    """
+    Writes ``ranges``, an iterable of ``(start, end, location)`` with
+    ipaddress objects and a location dict, to a database file. Overlapping
+    ranges are not merged; the one with the highest start wins.
+    """
+    locations = []
+    location_ids = {}
+    tables = {4: [], 6: []}
+    for start, end, location in ranges:
+        if start.version != end.version or int(start) > int(end):
+            raise ValueError(f"Invalid range {start} - {end}")
+        key = tuple(location.get(f) for f in LOCATION_FIELDS)
+        if key not in location_ids:
+            location_ids[key] = len(locations)
+            locations.append(key)
+        tables[start.version].append((start.packed, end.packed, location_ids[key]))
+
+    encoded = json.dumps(locations).encode()
+    os.makedirs(os.path.dirname(os.fspath(path)) or '.', exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(tables[4]), len(tables[6]), len(encoded)))
+        for version in (4, 6):
+            for start, end, location_id in sorted(tables[version]):
+                f.write(start + end + LOCATION_INDEX.pack(location_id))
+        f.write(encoded)
+    # readers keep their mapping of the old file until they reload
+    os.replace(tmp, path)
+    return len(tables[4]) + len(tables[6])
+
+
+class RangeTable:
+    """
+    Sorted fixed-width range records inside a memory map. Indexing yields a
+    record's start address bytes, which is all ``bisect`` needs.
+    """
+
+    def __init__(self, buffer, offset, count, address_size):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.address_size = address_size
+        self.record_size = 2 * address_size + LOCATION_INDEX.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.offset + i * self.record_size
+        return self.buffer[start:start + self.address_size]
+
+    def find(self, packed):
+        """The location index of the range containing ``packed``, or None"""
+        i = bisect.bisect_right(self, packed) - 1
+        if i < 0:
+            return None
+        record = self.offset + i * self.record_size
+        end = self.buffer[record + self.address_size:record + 2 * self.address_size]
+        if packed > end:
+            return None
+        return LOCATION_INDEX.unpack_from(self.buffer, record + 2 * self.address_size)[0]
+
+
+class RangeDatabase:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count4, count6, locations_size = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a geolocation database")
+        offset = HEADER.size
+        self.tables = {}
+        for version, count in ((4, count4), (6, count6)):
+            table = RangeTable(self.buffer, offset, count, ADDRESS_SIZES[version])
+            self.tables[version] = table
+            offset += count * table.record_size
+        self.locations = json.loads(self.buffer[offset:offset + locations_size])
+
+    def lookup(self, address):
+        location_id = self.tables[address.version].find(address.packed)
+        if location_id is None:
+            return None
+        return dict(zip(LOCATION_FIELDS, self.locations[location_id]))
+
+    def close(self):
+        self.buffer.close()
+
+
+def http_lookup(ip_address):
+    """Looks an address up with ip-api.com (free service)"""
+    try:
+        response = requests.get(f'http://ip-api.com/json/{ip_address}', timeout=2)
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('status') == 'success':
+                return {
+                    'city': data.get('city', ''),
+                    'region': data.get('regionName', ''),
+                    'country': data.get('country', ''),
+                    'country_code': data.get('countryCode', ''),
+                    'lat': data.get('lat'),
+                    'lon': data.get('lon')
+                }
+    except (requests.RequestException, ValueError):
+        pass
+    return None
+
+
+def use_http(database):
+    """Whether addresses ``database`` doesn't locate go to ip-api.com"""
+    fallback = getattr(settings, 'GEOIP_HTTP_FALLBACK', None)
+    return database is None if fallback is None else fallback
+
+
+class Locator:
+    """
+    Resolves IP addresses with the local database, then ip-api.com (see
+    ``use_http``). Results, including database misses, are kept in an LRU
+    cache; failed HTTP lookups are not.
+    """
+
+    def __init__(self):
+        self._database = None
+        self._checked = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_size = getattr(settings, 'GEOIP_CACHE_SIZE', 10000)
+
+    @property
+    def database(self):
+        path = getattr(settings, 'GEOIP_DATABASE', None)
+        if not path:
+            return None
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < RELOAD_INTERVAL:
+            return self._database
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                return self._database
+            if self._database is None or self._database.mtime != mtime:
+                try:
+                    self._database = RangeDatabase(path)
+                    self._cache.clear()
+                except (OSError, ValueError) as e:
+                    logger.error(f"Failed to load geolocation database {path}: {str(e)}")
+        return self._database
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _resolve(self, ip_address):
+        """The location of an address, or None, and whether to cache it"""
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None, True
+        database = self.database
+        location = database.lookup(address) if database else None
+        if location is None and use_http(database) and address.is_global:
+            location = http_lookup(ip_address)
+            return location, location is not None
+        return location, True
+
+    def locate(self, ip_address):
+        """
+        Returns a dict with city, region, country, country_code, lat and lon,
+        with empty values for addresses that can't be located.
+        """
+        if ip_address in LOCAL_ADDRESSES:
+            return local_location()
+        self.database  # reloads a rebuilt file before the cache is consulted
+        with self._lock:
+            cached = ip_address in self._cache
+            if cached:
+                self._cache.move_to_end(ip_address)
+                location = self._cache[ip_address]
+        if not cached:
+            location, cacheable = self._resolve(ip_address)
+            if cacheable:
+                with self._lock:
+                    self._cache[ip_address] = location
+                    while len(self._cache) > self._cache_size:
+                        self._cache.popitem(last=False)
+        return dict(location) if location else empty_location()
+
+
+locator = Locator()
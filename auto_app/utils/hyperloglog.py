@@ -0,0 +1,133 @@
+"""
+HyperLogLog sketches for counting unique visitors.
+
+A sketch estimates the number of distinct values added to it in a few KB,
+and two sketches merge into the sketch of the union of their values, so
+daily sketches can be combined over any date range. With ``PRECISION`` 12
+the standard error is ``1.04 / sqrt(4096)``, about 1.6%.
+
+Small sketches stay in an exact mode that keeps the 64 bit hashes
+themselves, so counts up to ``EXACT_LIMIT`` are exact (barring hash
+collisions) and a vehicle's quiet days cost a few bytes each.
+"""
+import hashlib
+import struct
+import zlib
+
+import numpy as np
+
+
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+EXACT_LIMIT = 256
+STANDARD_ERROR = 1.04 / REGISTERS ** 0.5
+
+EXACT = b'E'
+DENSE = b'H'
+
+
+def hash_value(value):
+    digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+    return struct.unpack('>Q', digest)[0]
+
+
+class HyperLogLog:
+    def __init__(self, hashes=None, registers=None):
+        self.hashes = set(hashes or ())
+        self.registers = registers
+        if self.registers is None and len(self.hashes) > EXACT_LIMIT:
+            self._densify()
+
+    @property
+    def is_exact(self):
+        return self.registers is None
+
+    def _densify(self):
+        self.registers = np.zeros(REGISTERS, dtype=np.uint8)
+        self._add_hashes(self.hashes)
+        self.hashes = set()
+
+    def _add_hashes(self, hashes):
+        if not hashes:
+            return
+        hashes = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+        index = (hashes >> np.uint64(64 - PRECISION)).astype(np.int64)
+        rest = hashes << np.uint64(PRECISION)
+        # rank = position of the first set bit in the remaining 64 - p bits
+        bit_lengths = np.zeros(len(hashes), dtype=np.int64)
+        for shift in (32, 16, 8, 4, 2, 1):
+            high = rest >= np.uint64(1 << shift)
+            bit_lengths[high] += shift
+            rest[high] >>= np.uint64(shift)
+        bit_lengths += (rest != 0)
+        ranks = np.minimum(64 - bit_lengths + 1, 64 - PRECISION + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, ranks)
+
+    def add(self, value):
+        self.update([value])
+
+    def update(self, values):
+        hashes = {hash_value(v) for v in values}
+        if self.is_exact:
+            self.hashes |= hashes
+            if len(self.hashes) > EXACT_LIMIT:
+                self._densify()
+        else:
+            self._add_hashes(hashes)
+
+    def merge(self, other):
+        """Adds the values of ``other`` to this sketch"""
+        if other.is_exact:
+            if self.is_exact:
+                self.hashes |= other.hashes
+                if len(self.hashes) > EXACT_LIMIT:
+                    self._densify()
+            else:
+                self._add_hashes(other.hashes)
+        else:
+            if self.is_exact:
+                hashes = self.hashes
+                self.registers = other.registers.copy()
+                self.hashes = set()
+                self._add_hashes(hashes)
+            else:
+                np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        if self.is_exact:
+            return len(self.hashes)
+        m = float(REGISTERS)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        if self.is_exact:
+            return EXACT + struct.pack(f'>{len(self.hashes)}Q', *sorted(self.hashes))
+        return DENSE + zlib.compress(self.registers.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        if not data:
+            return cls()
+        if data[:1] == EXACT:
+            return cls(hashes=struct.unpack(f'>{(len(data) - 1) // 8}Q', data[1:]))
+        if data[:1] == DENSE:
+            registers = np.frombuffer(zlib.decompress(data[1:]), dtype=np.uint8).copy()
+            if len(registers) != REGISTERS:
+                raise ValueError("Sketch was built with a different precision")
+            return cls(registers=registers)
+        raise ValueError("Unknown sketch encoding")
+
+    @classmethod
+    def union(cls, sketches):
+        merged = cls()
+        for sketch in sketches:
+            merged.merge(sketch)
+        return merged
@@ -0,0 +1,291 @@
+"""
+Asynchronous impression ingestion.
+
+``record_impression`` only validates the request and puts a record on a
+bounded in-process queue. A background worker drains the queue in batches,
+geolocates each distinct IP once per batch, drops records for vehicles that
+no longer exist and bulk-inserts the rest.
+
+When the queue is full, records are appended to a JSON lines spool file
+instead, and a batch that fails to insert is spooled as well. The worker
+picks spool files up again whenever the queue is idle, and
+``manage.py drain_impressions`` ingests any left behind by a dead process,
+including files it had claimed but not finished. Only if the spool can't
+be written either does the endpoint refuse the impression, so nothing is
+dropped silently; malformed lines are set aside in ``rejected-*.jsonl``.
+
+Processes append to their spool file under an exclusive ``flock``, and a
+drain only renames a file it can lock without waiting, so it never takes a
+file from under a process that is still writing to it.
+"""
+import atexit
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from auto_app.logging import logger
+from auto_app.utils import geoip
+
+
+def spool_dir():
+    return Path(getattr(settings, 'IMPRESSION_SPOOL_DIR', Path(settings.BASE_DIR) / 'spool' / 'impressions'))
+
+
+def append_locked(path, lines):
+    """
+    Appends to ``path`` under an exclusive lock, reopening it if a drain
+    renamed it while this waited for the lock.
+    """
+    while True:
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                current = os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                f.writelines(lines)
+                f.flush()
+                return
+
+
+def claim(path, claimed):
+    """
+    Renames a spool file to ``claimed`` unless a process holds its lock.
+    Returns whether it did.
+    """
+    try:
+        with open(path) as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # another drain may have renamed it before this got the lock
+            if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                return False
+            path.rename(claimed)
+        os.utime(claimed)
+    except OSError:
+        return False
+    return True
+
+
+def make_record(vehicle_id, ip_address, user_agent="", referrer="", session_id=""):
+    return {
+        'vehicle_id': vehicle_id,
+        'ip_address': ip_address,
+        'user_agent': user_agent,
+        'referrer': referrer,
+        'session_id': session_id,
+        'created_at': timezone.now().isoformat(),
+    }
+
+
+def ingest(records):
+    """Geolocates and bulk-inserts a batch of impression records"""
+    from auto_app.models import Impression, Vehicle
+
+    if not records:
+        return 0
+    vehicle_ids = set(Vehicle.objects.filter(
+        pk__in={r['vehicle_id'] for r in records}
+    ).values_list('pk', flat=True))
+    locations = {ip: geoip.locator.locate(ip) for ip in {r['ip_address'] for r in records}}
+
+    impressions = []
+    for r in records:
+        if r['vehicle_id'] not in vehicle_ids:
+            continue
+        location = locations[r['ip_address']]
+        impressions.append(Impression(
+            vehicle_id=r['vehicle_id'],
+            ip_address=r['ip_address'],
+            city=location.get('city', ''),
+            region=location.get('region', ''),
+            country=location.get('country', ''),
+            country_code=location.get('country_code', ''),
+            latitude=location.get('lat'),
+            longitude=location.get('lon'),
+            user_agent=r['user_agent'],
+            referrer=r['referrer'],
+            session_id=r['session_id'],
+            created_at=parse_datetime(r['created_at']),
+        ))
+    Impression.objects.bulk_create(impressions, batch_size=500)
+    return len(impressions)
+
+
+class ImpressionQueue:
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._spool_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def queue(self):
+        if self._queue is None:
+            with self._lock:
+                if self._queue is None:
+                    self._queue = queue.Queue(maxsize=getattr(settings, 'IMPRESSION_QUEUE_SIZE', 10000))
+        return self._queue
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'IMPRESSION_BATCH_SIZE', 500)
+
+    def put(self, record):
+        """
+        Queues a record, spooling it to disk if the queue is full. Returns
+        False only if the record could not be stored anywhere.
+        """
+        self._start()
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            return self.spool([record])
+
+    def spool(self, records):
+        path = spool_dir() / f"impressions-{os.getpid()}.jsonl"
+        try:
+            with self._spool_lock:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                append_locked(path, [json.dumps(r) + "\n" for r in records])
+        except OSError as e:
+            logger.error(f"Failed to spool {len(records)} impressions: {str(e)}")
+            return False
+        return True
+
+    def _start(self):
+        if not getattr(settings, 'IMPRESSION_WORKER', True):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _take_batch(self, timeout=None):
+        batch = []
+        try:
+            # without a timeout, only take what is already queued
+            if timeout is None:
+                batch.append(self.queue.get_nowait())
+            else:
+                batch.append(self.queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _ingest(self, batch):
+        try:
+            ingest(batch)
+        except Exception as e:
+            logger.error(f"Failed to ingest {len(batch)} impressions, spooling them: {str(e)}")
+            self.spool(batch)
+
+    def _run(self):
+        interval = getattr(settings, 'IMPRESSION_FLUSH_INTERVAL', 2.0)
+        while True:
+            batch = self._take_batch(timeout=interval)
+            with self._flush_lock:
+                try:
+                    if batch:
+                        self._ingest(batch)
+                    elif self.queue.empty():
+                        drain_spool()
+                finally:
+                    connection.close()
+
+    def flush(self):
+        """Ingests everything queued so far on the calling thread"""
+        with self._flush_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    break
+                self._ingest(batch)
+
+
+def claimable_files(directory):
+    """
+    Spool files waiting to be drained, and files claimed by a drain that
+    hasn't touched them for ``IMPRESSION_CLAIM_TIMEOUT`` seconds, e.g.
+    because its process died.
+    """
+    cutoff = time.time() - getattr(settings, 'IMPRESSION_CLAIM_TIMEOUT', 600)
+    paths = sorted(directory.glob('impressions-*.jsonl'))
+    for path in sorted(directory.glob('claimed-*.jsonl')):
+        try:
+            if path.stat().st_mtime < cutoff:
+                paths.append(path)
+        except FileNotFoundError:
+            pass
+    return paths
+
+
+def read_spool(path, name):
+    """The records of a spool file, setting aside lines that aren't JSON"""
+    records, rejected = [], []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.error(f"Skipping malformed line {number} of impression spool {name}")
+                rejected.append(line if line.endswith("\n") else line + "\n")
+    if rejected:
+        # kept for inspection, never drained again
+        with open(path.with_name(f"rejected-{uuid.uuid4().hex}.jsonl"), 'w') as f:
+            f.writelines(rejected)
+    return records
+
+
+def drain_spool(batch_size=500):
+    """
+    Ingests the records of every spool file. Files are renamed before they
+    are read so concurrent drains don't ingest them twice, and skipped while
+    their process is appending to them. If ingesting
+    fails, the records not ingested yet go back to the spool and draining
+    stops until the next run.
+    """
+    directory = spool_dir()
+    if not directory.exists():
+        return 0
+    count = 0
+    for path in claimable_files(directory):
+        claimed = directory / f"claimed-{uuid.uuid4().hex}.jsonl"
+        if not claim(path, claimed):
+            continue
+        records = read_spool(claimed, path.name)
+        for start in range(0, len(records), batch_size):
+            try:
+                count += ingest(records[start:start + batch_size])
+            except Exception as e:
+                # hand back only what hasn't been ingested
+                logger.error(f"Failed to drain impression spool {path.name}: {str(e)}")
+                remaining = directory / f"impressions-{uuid.uuid4().hex}.jsonl"
+                with open(remaining, 'w') as f:
+                    f.writelines(json.dumps(r) + "\n" for r in records[start:])
+                claimed.unlink()
+                return count
+            # still being drained, not stale
+            os.utime(claimed)
+        claimed.unlink()
+    return count
+
+
+impression_queue = ImpressionQueue()
+atexit.register(impression_queue.flush)
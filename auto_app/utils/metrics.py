@@ -0,0 +1,220 @@
+"""
+Per view request metrics.
+
+InstrumentationMiddleware (auto_app.middleware.instrumentation) records,
+for every request, its query count, the time spent in the database, the
+time spent rendering DRF and template responses, the response size and
+the total time, under the view's route, e.g. ``GET api/cms/list/<str:entity>/``.
+Views returning a JsonResponse encode it inside the view, so their
+serialization time shows up in the total rather than separately.
+
+Each metric is kept as a histogram with fixed buckets, so processes can
+be merged and percentiles estimated. A background thread in every process
+writes its totals to ``REQUEST_METRICS_DIR/<host>-<pid>.json`` every
+``REQUEST_METRICS_FLUSH_INTERVAL`` seconds, so requests never wait on the
+file; ``summary`` merges the files.
+Read them with ``manage.py request_metrics`` or, as a superuser, from
+``/api/cms/request-metrics/``.
+"""
+import atexit
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from auto_app.logging import logger
+
+
+BUCKETS = {
+    'queries': [0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500],
+    'db_ms': [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000],
+    'serialization_ms': [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000],
+    'duration_ms': [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000],
+    'response_bytes': [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304],
+}
+PERCENTILES = (50, 95, 99)
+RESET_MARKER = 'reset'
+
+
+def metrics_dir():
+    return Path(getattr(settings, 'REQUEST_METRICS_DIR', Path(settings.BASE_DIR) / 'spool' / 'metrics'))
+
+
+def empty_view():
+    return {
+        'count': 0,
+        'over_budget': 0,
+        'metrics': {
+            name: {'sum': 0, 'max': 0, 'buckets': [0] * (len(bounds) + 1)}
+            for name, bounds in BUCKETS.items()
+        },
+    }
+
+
+def bucket_index(bounds, value):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+def merge(into, stats):
+    """Adds the per view ``stats`` of one process to ``into``"""
+    for view, data in stats.items():
+        total = into.setdefault(view, empty_view())
+        total['count'] += data['count']
+        total['over_budget'] += data['over_budget']
+        for name, metric in data['metrics'].items():
+            if name not in total['metrics']:
+                continue
+            target = total['metrics'][name]
+            target['sum'] += metric['sum']
+            target['max'] = max(target['max'], metric['max'])
+            target['buckets'] = [a + b for a, b in zip(target['buckets'], metric['buckets'])]
+    return into
+
+
+def percentile(bounds, metric, count, q):
+    """The bucket bound below which ``q`` percent of the values fall"""
+    rank = count * q / 100
+    seen = 0
+    for i, n in enumerate(metric['buckets']):
+        seen += n
+        if n and seen >= rank:
+            return bounds[i] if i < len(bounds) else metric['max']
+    return metric['max']
+
+
+class RequestMetrics:
+    """This process's histograms, written out every flush interval"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+        self._started = time.time()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._exit_registered = False
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='request-metrics', daemon=True)
+            self._thread.start()
+            if not self._exit_registered:
+                atexit.register(self.stop)
+                self._exit_registered = True
+
+    def _run(self):
+        while not self._stopped.wait(getattr(settings, 'REQUEST_METRICS_FLUSH_INTERVAL', 30)):
+            self.flush()
+
+    def stop(self):
+        """Stops the flushing thread and writes out what it has not"""
+        with self._thread_lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stopped.set()
+        thread.join()
+        self.flush()
+
+    def record(self, view, over_budget=False, **values):
+        if self._thread is None or not self._thread.is_alive():
+            # first request, or a worker forked from a process that had one
+            self._start()
+        with self._lock:
+            data = self._views.setdefault(view, empty_view())
+            data['count'] += 1
+            data['over_budget'] += int(over_budget)
+            for name, value in values.items():
+                metric = data['metrics'][name]
+                metric['sum'] += value
+                metric['max'] = max(metric['max'], value)
+                metric['buckets'][bucket_index(BUCKETS[name], value)] += 1
+
+    def path(self):
+        return metrics_dir() / f"{socket.gethostname()}-{os.getpid()}.json"
+
+    def flush(self):
+        """Writes this process's totals to its file in REQUEST_METRICS_DIR"""
+        directory = metrics_dir()
+        try:
+            if (directory / RESET_MARKER).stat().st_mtime > self._started:
+                # reset since this process started counting
+                self.clear()
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            content = json.dumps(self._views)
+        try:
+            directory.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as f:
+                f.write(content)
+            os.replace(f.name, self.path())
+        except OSError as e:
+            logger.error(f"Failed to write request metrics: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._views = {}
+            self._started = time.time()
+
+
+request_metrics = RequestMetrics()
+
+
+def collect():
+    """The per view totals of every process"""
+    request_metrics.flush()
+    totals = {}
+    for path in metrics_dir().glob('*.json'):
+        try:
+            with open(path) as f:
+                merge(totals, json.load(f))
+        except (OSError, ValueError) as e:
+            logger.error(f"Skipping request metrics file {path}: {str(e)}")
+    return totals
+
+
+def summary(totals=None):
+    """
+    ``{view: {count, over_budget, <metric>: {mean, max, p50, p95, p99,
+    histogram}}}`` for every view recorded.
+    """
+    totals = collect() if totals is None else totals
+    report = {}
+    for view, data in totals.items():
+        count = data['count']
+        entry = {'count': count, 'over_budget': data['over_budget']}
+        for name, bounds in BUCKETS.items():
+            metric = data['metrics'][name]
+            entry[name] = {
+                'mean': round(metric['sum'] / count, 2) if count else 0,
+                'max': round(metric['max'], 2),
+                **{f'p{q}': percentile(bounds, metric, count, q) for q in PERCENTILES},
+                'histogram': {
+                    (f'<={bound}' if i < len(bounds) else f'>{bounds[-1]}'): n
+                    for i, (bound, n) in enumerate(zip(bounds + [bounds[-1]], metric['buckets']))
+                },
+            }
+        report[view] = entry
+    return report
+
+
+def reset():
+    """Drops the recorded metrics of every process"""
+    directory = metrics_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    for path in directory.glob('*.json'):
+        path.unlink(missing_ok=True)
+    (directory / RESET_MARKER).touch()
+    request_metrics.clear()
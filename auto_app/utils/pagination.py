@@ -0,0 +1,122 @@
+"""
+Keyset (cursor) pagination for vehicle listings.
+
+Pages are ordered by one of the supported sort columns with the pk as a
+tie-breaker, and the cursor carries the last row's ``(value, pk)`` so the
+next page is a range scan on the sort index instead of an OFFSET. The
+cursor for the previous page carries the first row's instead, and is
+read backwards.
+"""
+import base64
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Q
+
+
+SORT_COLUMNS = {
+    'price': Decimal,
+    'year': int,
+    'mileage': int,
+    'created_at': datetime.fromisoformat,
+}
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def sort_order(sort_by, default='price'):
+    """
+    Validates a ``sort_by`` value such as ``-price`` and returns
+    ``(column, descending)``. Unsupported values fall back to ``default``.
+    """
+    sort_by = sort_by or default
+    column = sort_by.lstrip('-')
+    if column not in SORT_COLUMNS:
+        return sort_order(default)
+    return column, sort_by.startswith('-')
+
+
+def ordering(sort_by, default='price'):
+    """The ``order_by`` arguments for a sort, with the pk as a tie-breaker"""
+    column, descending = sort_order(sort_by, default)
+    prefix = '-' if descending else ''
+    return [f"{prefix}{column}", f"{prefix}pk"]
+
+
+def encode_cursor(sort_by, value, pk, backwards=False):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = {'s': sort_by, 'v': str(value), 'k': pk}
+    if backwards:
+        payload['b'] = 1
+    payload = json.dumps(payload)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort_by):
+    """
+    Returns the ``(value, pk, backwards)`` stored in a cursor issued for
+    ``sort_by``.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if payload['s'] != sort_by:
+            raise InvalidCursor("Cursor was issued for a different sort order")
+        column = sort_by.lstrip('-')
+        return SORT_COLUMNS[column](payload['v']), int(payload['k']), bool(payload.get('b'))
+    except InvalidCursor:
+        raise
+    except (ValueError, TypeError, KeyError, AttributeError, InvalidOperation):
+        raise InvalidCursor("Invalid cursor")
+
+
+def page_size(value=None):
+    default = getattr(settings, 'LISTING_PAGE_SIZE', 20)
+    maximum = getattr(settings, 'LISTING_MAX_PAGE_SIZE', 100)
+    try:
+        size = int(value) if value else default
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, maximum))
+
+
+def paginate(queryset, sort_by=None, cursor=None, size=None, default='price'):
+    """
+    Returns one page of ``queryset`` with the cursors for the next and the
+    previous page, each None at that end. Raises InvalidCursor for a cursor
+    that can't be decoded or belongs to another sort order.
+    """
+    column, descending = sort_order(sort_by, default)
+    sort_by = f"{'-' if descending else ''}{column}"
+    size = page_size(size)
+
+    backwards = False
+    if cursor:
+        value, pk, backwards = decode_cursor(cursor, sort_by)
+        # a previous page is the rows before the cursor, read in reverse
+        op = 'lt' if descending != backwards else 'gt'
+        queryset = queryset.filter(
+            Q(**{f"{column}__{op}": value}) | Q(**{column: value, f"pk__{op}": pk})
+        )
+    queryset = queryset.order_by(*ordering(f"{'-' if descending != backwards else ''}{column}"))
+
+    rows = list(queryset[:size + 1])
+    more = len(rows) > size
+    rows = rows[:size]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return rows, None, None
+    first, last = rows[0], rows[-1]
+    next_cursor = previous_cursor = None
+    # reading backwards, the cursor's own row comes next
+    if more or backwards:
+        next_cursor = encode_cursor(sort_by, getattr(last, column), last.pk)
+    if (more and backwards) or (cursor and not backwards):
+        previous_cursor = encode_cursor(sort_by, getattr(first, column), first.pk, backwards=True)
+    return rows, next_cursor, previous_cursor
@@ -1,17 +1,125 @@
 from rest_framework.permissions import BasePermission
 import re
-from auto_app.models import RolePermission
-from django.contrib.auth.models import ContentType
+import threading
+import time
+from auto_app.models import RolePermission, Seller
+from billing import entitlements
+from django.conf import settings
+from django.core.cache import cache
+
+
+CMS_PATH = re.compile(r"/api/cms/(?P<action>[a-z]+)/(?P<model>[a-z]+)/")
+LIST_PATH = re.compile(r"/api/cms/list/(?P<model>[a-z]+)/$")
+DELETE_PATH = re.compile(r"/api/cms/delete/(?P<model>[a-z]+)/")
+
+VERSION_KEY = 'role_permissions:version'
+READ, WRITE, DELETE = 0, 1, 2
+NO_SELLER = object()
+
+
+class RolePermissionCache:
+    """
+    Process local cache of each role's permission matrix, entity model name
+    to (read, write, delete), and of each user's role, so permission checks
+    run no queries once warm. Saving a Role, RolePermission or Seller, or
+    editing one through the CMS, bumps a version number in the shared cache
+    (see SHARED_CACHE_REQUIRED); other processes notice within
+    ROLE_PERMISSION_VERSION_CHECK_INTERVAL seconds and drop their copies.
+    Copies are also dropped after ROLE_PERMISSION_CACHE_TTL seconds, which
+    bounds how long a change made without signals goes unnoticed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = 0.0
+        self._loaded = 0.0
+        self._roles = {}
+        self._matrices = {}
+
+    def _sync(self):
+        now = time.monotonic()
+        if now - self._loaded >= getattr(settings, 'ROLE_PERMISSION_CACHE_TTL', 60):
+            with self._lock:
+                self._roles.clear()
+                self._matrices.clear()
+                self._loaded = now
+        if now - self._checked < getattr(settings, 'ROLE_PERMISSION_VERSION_CHECK_INTERVAL', 1.0):
+            return
+        version = cache.get(VERSION_KEY)
+        with self._lock:
+            if version != self._version:
+                self._roles.clear()
+                self._matrices.clear()
+                self._version = version
+                self._loaded = now
+            self._checked = now
+
+    def invalidate(self):
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.set(VERSION_KEY, 1, None)
+        with self._lock:
+            self._roles.clear()
+            self._matrices.clear()
+            self._version = cache.get(VERSION_KEY)
+            self._checked = self._loaded = time.monotonic()
+
+    def _seller_role(self, user):
+        self._sync()
+        try:
+            return self._roles[user.pk]
+        except KeyError:
+            pass
+        version = self._version
+        roles = list(Seller.objects.filter(user_id=user.pk).values_list('role_id', flat=True)[:1])
+        role_id = roles[0] if roles else NO_SELLER
+        with self._lock:
+            if version == self._version:
+                self._roles[user.pk] = role_id
+        return role_id
+
+    def role_id(self, user):
+        """The user's seller role, None without a seller or role"""
+        role_id = self._seller_role(user)
+        return None if role_id is NO_SELLER else role_id
+
+    def has_seller(self, user):
+        return self._seller_role(user) is not NO_SELLER
+
+    def matrix(self, role_id):
+        self._sync()
+        try:
+            return self._matrices[role_id]
+        except KeyError:
+            pass
+        version = self._version
+        matrix = {}
+        rows = RolePermission.objects.filter(role_id=role_id, entity__app_label='auto_app') \
+            .values_list('entity__model', 'can_read', 'can_write', 'can_delete')
+        for model, *bits in rows:
+            current = matrix.get(model, (False, False, False))
+            matrix[model] = tuple(a or b for a, b in zip(current, bits))
+        with self._lock:
+            if version == self._version:
+                self._matrices[role_id] = matrix
+        return matrix
+
+    def allowed(self, role_id, model, action):
+        return self.matrix(role_id).get(model, (False, False, False))[action]
+
+
+role_permissions = RolePermissionCache()
 
 
 def has_active_subscription(user):
     """Check if user has an active subscription"""
     if user.is_superuser:
         return True
-    seller = getattr(user, 'seller', None)
-    if not seller:
+    if not role_permissions.has_seller(user):
         return False
-    return seller.has_active_subscription()
+    return entitlements.has_active_subscription(user)
 
 
 class ActiveSubscriptionRequired(BasePermission):
@@ -36,7 +144,7 @@ class WritePermission(BasePermission):
         if request.user.is_superuser:
             return True
 
-        re_match = re.match(r"/api/cms/(?P<action>[a-z]+)/(?P<model>[a-z]+)/", request.path)
+        re_match = CMS_PATH.match(request.path)
         if re_match:
             action = re_match.group("action")
             if action not in ["create", "update"]:
@@ -44,7 +152,8 @@ class WritePermission(BasePermission):
             model = re_match.group("model")
 
             # Check if user has seller and role
-            if not hasattr(request.user, 'seller') or not request.user.seller.role:
+            role_id = role_permissions.role_id(request.user)
+            if not role_id:
                 return False
 
             # Check for active subscription for write operations
@@ -52,16 +161,7 @@ class WritePermission(BasePermission):
                 self.message = 'You need an active subscription to create or update content.'
                 return False
 
-            user_role = request.user.seller.role
-            try:
-                permissions = RolePermission.objects.filter(
-                    can_write=True,
-                    entity=ContentType.objects.get(app_label='auto_app', model=model),
-                    role=user_role
-                )
-                return permissions.exists()
-            except ContentType.DoesNotExist:
-                return False
+            return role_permissions.allowed(role_id, model, WRITE)
         return True
 
 
@@ -75,7 +175,7 @@ class ReadPermission(BasePermission):
         if request.user.is_superuser:
             return True
 
-        re_match = re.match(r"/api/cms/list/(?P<model>[a-z]+)/$", request.path)
+        re_match = LIST_PATH.match(request.path)
         if re_match:
             model = re_match.group("model")
 
@@ -83,19 +183,11 @@ class ReadPermission(BasePermission):
                 return True
 
             # Check if user has seller and role
-            if not hasattr(request.user, 'seller') or not request.user.seller.role:
+            role_id = role_permissions.role_id(request.user)
+            if not role_id:
                 return False
 
-            user_role = request.user.seller.role
-            try:
-                permissions = RolePermission.objects.filter(
-                    can_read=True,
-                    entity=ContentType.objects.get(app_label='auto_app', model=model),
-                    role=user_role
-                )
-                return permissions.exists()
-            except ContentType.DoesNotExist:
-                return False
+            return role_permissions.allowed(role_id, model, READ)
         return True
 
 
@@ -109,12 +201,13 @@ class DeletePermission(BasePermission):
         if request.user.is_superuser:
             return True
 
-        re_match = re.match(r"/api/cms/delete/(?P<model>[a-z]+)/", request.path)
+        re_match = DELETE_PATH.match(request.path)
         if re_match:
             model = re_match.group("model")
 
             # Check if user has seller and role
-            if not hasattr(request.user, 'seller') or not request.user.seller.role:
+            role_id = role_permissions.role_id(request.user)
+            if not role_id:
                 return False
 
             # Check for active subscription for delete operations
@@ -122,16 +215,7 @@ class DeletePermission(BasePermission):
                 self.message = 'You need an active subscription to delete content.'
                 return False
 
-            user_role = request.user.seller.role
-            try:
-                permissions = RolePermission.objects.filter(
-                    can_delete=True,
-                    entity=ContentType.objects.get(app_label='auto_app', model=model),
-                    role=user_role
-                )
-                return permissions.exists()
-            except ContentType.DoesNotExist:
-                return False
+            return role_permissions.allowed(role_id, model, DELETE)
         return True
 
 
@@ -0,0 +1,101 @@
+"""
+Recommended listings for a user.
+
+Candidates come from two signals, each scored in a single query: the
+precomputed neighbours of the user's saved vehicles and the filters of their
+recent searches, newer searches weighing more. The ranked ids are cached per
+user until one of their saved listings or searches changes.
+"""
+import json
+from functools import reduce
+from operator import add, or_
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, FloatField, Value, When
+
+from auto_app.utils import search_filters
+from auto_app.utils.search_index import search_params
+
+
+SAVED_LISTING_WEIGHT = 1.0
+SAVED_SEARCH_WEIGHT = 0.5
+SEARCH_RECENCY_DECAY = 0.8
+
+# params that change how results are presented, not which vehicles match
+PRESENTATION_PARAMS = ['sort_by', 'cursor', 'page_size', 'facets']
+
+
+def cache_key(user_id):
+    return f"recommendations:{user_id}"
+
+
+def invalidate(user_id):
+    cache.delete(cache_key(user_id))
+
+
+def saved_search_filters(user):
+    """The user's distinct saved searches, newest first"""
+    from auto_app.models import SavedSearch
+
+    saved_search = SavedSearch.objects.filter(user=user).first()
+    if not saved_search or not saved_search.filters:
+        return []
+    try:
+        searches = json.loads(saved_search.filters).get('searches', [])
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        return []
+
+    distinct = []
+    for search in reversed(searches):
+        params = {
+            k: v for k, v in search_params(search).items()
+            if v and k not in PRESENTATION_PARAMS
+        }
+        if params not in distinct:
+            distinct.append(params)
+    return distinct
+
+
+def score_candidates(user, limit):
+    """Returns ``{vehicle_pk: score}`` for the user's best candidates"""
+    from auto_app.models import Vehicle, RelatedVehicle
+
+    scores = {}
+    related = RelatedVehicle.objects.filter(
+        vehicle__savedlisting__user=user, related__published=True
+    ).exclude(related__savedlisting__user=user).values_list('related_id', 'score')
+    for pk, score in related:
+        scores[pk] = scores.get(pk, 0.0) + SAVED_LISTING_WEIGHT * score
+
+    searches = saved_search_filters(user)
+    if searches:
+        conditions = [search_filters(search) for search in searches]
+        matches = reduce(add, [
+            Case(
+                When(condition, then=Value(SAVED_SEARCH_WEIGHT * SEARCH_RECENCY_DECAY ** i)),
+                default=Value(0.0),
+                output_field=FloatField(),
+            )
+            for i, condition in enumerate(conditions)
+        ])
+        searched = Vehicle.objects.filter(reduce(or_, conditions)) \
+            .exclude(savedlisting__user=user) \
+            .annotate(search_score=matches) \
+            .order_by('-search_score', '-created_at') \
+            .values_list('pk', 'search_score')[:limit * 5]
+        for pk, score in searched:
+            scores[pk] = scores.get(pk, 0.0) + score
+
+    return scores
+
+
+def recommend(user, limit=10):
+    """Ranked ids of the vehicles to recommend to ``user``"""
+    key = cache_key(user.pk)
+    ranked = cache.get(key)
+    if ranked is None:
+        scores = score_candidates(user, limit)
+        ranked = sorted(scores, key=lambda pk: (-scores[pk], -pk))[:limit]
+        cache.set(key, ranked, getattr(settings, 'RECOMMENDATIONS_CACHE_TIMEOUT', 10 * 60))
+    return ranked
@@ -0,0 +1,92 @@
+"""
+Retention for raw impressions.
+
+``compact`` rolls up any impressions the rollup job hasn't reached, then
+deletes the ones older than the retention window in small chunks, each in
+its own short transaction, so the live table stays small and ingestion is
+never blocked for long. Only rows inserted ``IMPRESSION_COMPACTION_MARGIN``
+seconds before the rollup checkpoint go, so a row the rollups may not have
+counted is never deleted. Deleted rows can be archived first to gzipped JSON
+lines files, one per day of impressions.
+"""
+import gzip
+import json
+import os
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from auto_app.utils import rollups
+
+
+ARCHIVE_FIELDS = [
+    'id', 'vehicle_id', 'ip_address', 'city', 'region', 'country', 'country_code',
+    'latitude', 'longitude', 'user_agent', 'referrer', 'session_id', 'created_at',
+]
+
+
+def archive(rows, directory):
+    """
+    Appends impression rows to ``impressions-<date>.jsonl.gz`` files. Each
+    append adds a gzip member, which gzip readers concatenate.
+    """
+    by_date = {}
+    for row in rows:
+        by_date.setdefault(row['created_at'].date(), []).append(row)
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for date, date_rows in by_date.items():
+        path = directory / f"impressions-{date.isoformat()}.jsonl.gz"
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+                for row in date_rows:
+                    f.write((json.dumps(row, default=str) + "\n").encode())
+            # the rows are deleted right after, make sure they're on disk
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+def compact(days=None, archive_dir=None, chunk_size=None, pause=0.0):
+    """
+    Deletes impressions older than ``days`` once they are rolled up,
+    archiving them to ``archive_dir`` if given. Returns the number deleted.
+    """
+    from auto_app.models import Impression
+
+    days = days if days is not None else getattr(settings, 'IMPRESSION_RETENTION_DAYS', 90)
+    chunk_size = chunk_size or getattr(settings, 'IMPRESSION_COMPACTION_CHUNK_SIZE', 5000)
+    cutoff = timezone.now() - timedelta(days=days)
+
+    rollups.rollup()
+    # only rows the rollups already count may go
+    watermark, position = rollups.checkpoint_position()
+    if watermark is None:
+        return 0
+    margin = timedelta(seconds=getattr(settings, 'IMPRESSION_COMPACTION_MARGIN', 60 * 60))
+    counted = rollups.through(watermark, position) & Q(inserted_at__lt=watermark - margin)
+
+    deleted = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Impression.objects.filter(
+                    counted, pk__gt=last_pk, created_at__lt=cutoff
+                ).order_by('pk').values(*ARCHIVE_FIELDS)[:chunk_size]
+            )
+            if not rows:
+                return deleted
+            if archive_dir:
+                archive(rows, archive_dir)
+            pks = [row['id'] for row in rows]
+            Impression.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
+        last_pk = pks[-1]
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,305 @@
+"""
+Hourly and daily impression rollups.
+
+``rollup`` aggregates the impressions inserted since its last run, by
+vehicle, visitor city and hour or day, and adds them to the rollup tables.
+It walks the Impression table in insertion time order from a checkpoint, so
+impressions that arrive late (e.g. from the ingestion spool) are still
+counted once. Primary keys are handed out before their transactions commit,
+so they can commit out of order; the walk stops ``IMPRESSION_ROLLUP_LAG``
+seconds short of now, longer than any insert transaction takes, so nothing
+commits behind the checkpoint. Run it periodically with
+``manage.py rollup_impressions``.
+
+Each run also adds the visitor IPs to daily HyperLogLog sketches per
+vehicle and per seller (see auto_app.utils.hyperloglog), which merge into
+unique visitor estimates for any date range.
+
+``dashboard_stats`` reads the daily rollups and sketches plus the
+impressions the last run hasn't reached yet, so the stats are current
+without scanning the raw table. The first, partial day of the range comes
+from the hourly rollups, and its visitors from the raw table.
+"""
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate, TruncHour
+from django.utils import timezone
+
+from auto_app.utils.hyperloglog import HyperLogLog
+
+
+CHECKPOINT = 'impression_rollups'
+KEY_FIELDS = ['vehicle_id', 'city', 'region']
+
+
+def granularities():
+    from auto_app.models import HourlyImpressionRollup, DailyImpressionRollup
+
+    return [
+        (HourlyImpressionRollup, 'hour', TruncHour),
+        (DailyImpressionRollup, 'date', TruncDate),
+    ]
+
+
+def after(watermark, position):
+    """Impressions past a checkpoint, i.e. not rolled up yet"""
+    if watermark is None:
+        return Q(pk__gt=position)
+    return Q(inserted_at__gt=watermark) | Q(inserted_at=watermark, pk__gt=position)
+
+
+def through(watermark, position):
+    """Impressions up to and including a checkpoint, i.e. rolled up"""
+    if watermark is None:
+        return Q(pk__lte=position)
+    return Q(inserted_at__lt=watermark) | Q(inserted_at=watermark, pk__lte=position)
+
+
+def checkpoint_position():
+    """The ``(watermark, position)`` the rollups have reached"""
+    from auto_app.models import RollupCheckpoint
+
+    return RollupCheckpoint.objects.filter(name=CHECKPOINT).values_list('watermark', 'position').first() or (None, 0)
+
+
+def aggregate(impressions, period, trunc):
+    """Impression and distinct IP counts per vehicle, location and period"""
+    return impressions.annotate(**{period: trunc('created_at')}) \
+        .values(*KEY_FIELDS, period) \
+        .annotate(
+            impressions=Count('id'),
+            visitors=Count('ip_address', distinct=True),
+        ).order_by()
+
+
+def apply(model, period, rows, sellers):
+    """Adds aggregated rows to the matching rollup rows, creating missing ones"""
+    fields = KEY_FIELDS + [period]
+    existing = {
+        tuple(getattr(r, f) for f in fields): r
+        for r in model.objects.filter(
+            vehicle_id__in={row['vehicle_id'] for row in rows},
+            **{f"{period}__in": {row[period] for row in rows}}
+        )
+    }
+    created, updated = [], []
+    for row in rows:
+        key = tuple(row[f] for f in fields)
+        rollup = existing.get(key)
+        if rollup is None:
+            rollup = model(seller_id=sellers.get(row['vehicle_id']), **dict(zip(fields, key)))
+            created.append(rollup)
+        else:
+            updated.append(rollup)
+        rollup.impressions += row['impressions']
+        rollup.visitors += row['visitors']
+    model.objects.bulk_update(updated, ['impressions', 'visitors'], batch_size=500)
+    model.objects.bulk_create(created, batch_size=500)
+
+
+def store_sketches(model, owner, visitors):
+    """Adds ``{(owner_id, date): ips}`` to the matching daily sketches"""
+    existing = {
+        (getattr(r, owner), r.date): r
+        for r in model.objects.filter(date__in={date for _, date in visitors}).filter(
+            Q(**{f"{owner}__in": {pk for pk, _ in visitors if pk is not None}})
+            | Q(**{f"{owner}__isnull": True})
+        )
+    }
+    created, updated = [], []
+    for (pk, date), ips in visitors.items():
+        row = existing.get((pk, date))
+        if row is None:
+            row = model(**{owner: pk, 'date': date})
+            sketch = HyperLogLog()
+            created.append(row)
+        else:
+            sketch = HyperLogLog.from_bytes(row.sketch)
+            updated.append(row)
+        sketch.update(ips)
+        row.sketch = sketch.to_bytes()
+    model.objects.bulk_update(updated, ['sketch'], batch_size=500)
+    model.objects.bulk_create(created, batch_size=500)
+
+
+def update_sketches(impressions, sellers):
+    from auto_app.models import VehicleVisitorSketch, SellerVisitorSketch
+
+    vehicle_visitors, seller_visitors = {}, {}
+    rows = impressions.annotate(date=TruncDate('created_at')) \
+        .values_list('vehicle_id', 'ip_address', 'date').distinct().order_by()
+    for vehicle_id, ip, date in rows:
+        vehicle_visitors.setdefault((vehicle_id, date), set()).add(ip)
+        # the sketch without a seller counts every vehicle's visitors
+        for seller_id in {sellers.get(vehicle_id), None}:
+            seller_visitors.setdefault((seller_id, date), set()).add(ip)
+    store_sketches(VehicleVisitorSketch, 'vehicle_id', vehicle_visitors)
+    store_sketches(SellerVisitorSketch, 'seller_id', seller_visitors)
+
+
+def rollup(batch_size=None):
+    """
+    Rolls up every impression inserted since the last run and at least
+    ``IMPRESSION_ROLLUP_LAG`` seconds ago, in batches of ``batch_size`` rows.
+    Returns the number of impressions rolled up.
+    """
+    from auto_app.models import Impression, RollupCheckpoint, Vehicle
+
+    batch_size = batch_size or getattr(settings, 'IMPRESSION_ROLLUP_BATCH_SIZE', 50000)
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'IMPRESSION_ROLLUP_LAG', 300))
+    total = 0
+    while True:
+        with transaction.atomic():
+            checkpoint, _ = RollupCheckpoint.objects.select_for_update().get_or_create(name=CHECKPOINT)
+            pending = after(checkpoint.watermark, checkpoint.position)
+            keys = list(
+                Impression.objects.filter(pending, inserted_at__lt=cutoff)
+                .order_by('inserted_at', 'pk').values_list('inserted_at', 'pk')[:batch_size]
+            )
+            if not keys:
+                return total
+
+            batch = Impression.objects.filter(pending).filter(through(*keys[-1]))
+            sellers = dict(
+                Vehicle.objects.filter(pk__in=batch.values('vehicle_id')).values_list('pk', 'seller_id')
+            )
+            for model, period, trunc in granularities():
+                apply(model, period, list(aggregate(batch, period, trunc)), sellers)
+            update_sketches(batch, sellers)
+
+            checkpoint.watermark, checkpoint.position = keys[-1]
+            checkpoint.save()
+        total += len(keys)
+
+
+def pending_impressions(seller, start):
+    """Impressions since ``start`` that haven't been rolled up yet"""
+    from auto_app.models import Impression
+
+    pending = Impression.objects.filter(after(*checkpoint_position()), created_at__gte=start)
+    if seller is not None:
+        pending = pending.filter(vehicle__seller=seller)
+    return pending
+
+
+def first_day(start):
+    """The first whole day from ``start`` on and the time it starts"""
+    local = timezone.localtime(start)
+    day = local.date() if local.time() == time.min else local.date() + timedelta(days=1)
+    return day, timezone.make_aware(datetime.combine(day, time.min))
+
+
+def daily_rows(seller, start, pending):
+    """
+    The rollup rows since ``start``, daily from its first whole day and
+    hourly, to the hour, before that, plus the same aggregation over the ``pending``
+    impressions. ``seller`` None means every vehicle.
+    """
+    from auto_app.models import DailyImpressionRollup, HourlyImpressionRollup
+
+    day, day_start = first_day(start)
+    daily = DailyImpressionRollup.objects.filter(date__gte=day)
+    hourly = HourlyImpressionRollup.objects.filter(
+        hour__gte=timezone.localtime(start).replace(minute=0, second=0, microsecond=0), hour__lt=day_start,
+    )
+    if seller is not None:
+        daily, hourly = daily.filter(seller=seller), hourly.filter(seller=seller)
+
+    rows = list(daily.values(*KEY_FIELDS, 'date', 'impressions', 'visitors'))
+    for row in hourly.values(*KEY_FIELDS, 'hour', 'impressions', 'visitors'):
+        row['date'] = timezone.localtime(row.pop('hour')).date()
+        rows.append(row)
+    rows.extend(aggregate(pending, 'date', TruncDate))
+    return rows
+
+
+def partial_day_visitors(start):
+    """Impressions from ``start`` to its first whole day, for exact visitors"""
+    from auto_app.models import Impression
+
+    return Impression.objects.filter(created_at__gte=start, created_at__lt=first_day(start)[1])
+
+
+def unique_visitors(seller, start, exact=False):
+    """
+    Distinct visitor IPs since ``start``, estimated from the daily seller
+    sketches. ``exact`` counts them on the raw table instead, which is only
+    right for ranges the table still holds and only cheap for short ones.
+    """
+    from auto_app.models import Impression, SellerVisitorSketch
+
+    if exact:
+        impressions = Impression.objects.filter(created_at__gte=start)
+        if seller is not None:
+            impressions = impressions.filter(vehicle__seller=seller)
+        return impressions.values('ip_address').distinct().count()
+
+    sketches = SellerVisitorSketch.objects.filter(date__gte=first_day(start)[0])
+    sketches = sketches.filter(seller=seller) if seller is not None else sketches.filter(seller__isnull=True)
+    merged = HyperLogLog.union(HyperLogLog.from_bytes(s) for s in sketches.values_list('sketch', flat=True))
+    partial = partial_day_visitors(start)
+    if seller is not None:
+        partial = partial.filter(vehicle__seller=seller)
+    for impressions in (pending_impressions(seller, start), partial):
+        merged.update(impressions.values_list('ip_address', flat=True).distinct())
+    return merged.count()
+
+
+def vehicle_visitors(vehicle_ids, start, pending):
+    """Estimated unique visitors per vehicle since ``start``"""
+    from auto_app.models import VehicleVisitorSketch
+
+    sketches = {pk: HyperLogLog() for pk in vehicle_ids}
+    rows = VehicleVisitorSketch.objects.filter(vehicle_id__in=vehicle_ids, date__gte=first_day(start)[0]) \
+        .values_list('vehicle_id', 'sketch')
+    for pk, sketch in rows:
+        sketches[pk].merge(HyperLogLog.from_bytes(sketch))
+    for impressions in (pending, partial_day_visitors(start)):
+        ips = impressions.filter(vehicle_id__in=vehicle_ids).values_list('vehicle_id', 'ip_address').distinct()
+        for pk, ip in ips:
+            sketches[pk].add(ip)
+    return {pk: sketch.count() for pk, sketch in sketches.items()}
+
+
+def dashboard_stats(seller, start, exact_visitors=False):
+    """
+    Totals, top cities, daily counts and top vehicles for ``impression_stats``.
+    """
+    from auto_app.models import Vehicle
+
+    pending = pending_impressions(seller, start)
+    rows = daily_rows(seller, start, pending)
+    cities, dates, vehicles = {}, {}, {}
+    for row in rows:
+        if row['city']:
+            key = (row['city'], row['region'])
+            cities[key] = cities.get(key, 0) + row['impressions']
+        dates[row['date']] = dates.get(row['date'], 0) + row['impressions']
+        vehicles[row['vehicle_id']] = vehicles.get(row['vehicle_id'], 0) + row['impressions']
+
+    top_ids = sorted(vehicles, key=lambda pk: (-vehicles[pk], pk))[:10]
+    names = {
+        v['id']: f"{v['make__name']} {v['model__name']} ({v['year']})"
+        for v in Vehicle.objects.filter(pk__in=top_ids).values('id', 'make__name', 'model__name', 'year')
+    }
+    visitors = vehicle_visitors(top_ids, start, pending)
+
+    return {
+        'total_impressions': sum(row['impressions'] for row in rows),
+        'unique_visitors': unique_visitors(seller, start, exact=exact_visitors),
+        'by_city': [
+            {'city': city, 'region': region, 'count': count}
+            for (city, region), count in sorted(cities.items(), key=lambda item: (-item[1], item[0]))[:10]
+        ],
+        'by_date': [
+            {'date': date.isoformat(), 'count': count}
+            for date, count in sorted(dates.items())
+        ],
+        'top_vehicles': [
+            {'id': pk, 'name': names.get(pk, ''), 'impressions': vehicles[pk], 'unique_visitors': visitors[pk]}
+            for pk in top_ids
+        ],
+    }
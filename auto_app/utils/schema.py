@@ -0,0 +1,96 @@
+"""
+Per-model registry of the CMS schemas.
+
+``form_fields()`` and ``list_field_schema()`` only depend on the model
+class, so each is built once per model and process and then shared. The
+registry lives as long as the process, which the development server's
+autoreloader restarts on code changes.
+
+Each schema has an ETag, a hash of its JSON, so the CMS frontend can
+revalidate the schema it holds instead of downloading it again: the
+create view answers ``If-None-Match`` with 304 Not Modified, and the list
+and update views leave the schema out when the ``X-Schema-ETag`` request
+header matches. The schemas are shared, treat them as read only.
+"""
+import hashlib
+import json
+import threading
+
+from django.utils.http import parse_etags
+
+
+SCHEMA_ETAG_HEADER = 'X-Schema-ETag'
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def _cached(model, kind, build):
+    key = (model._meta.label_lower, kind)
+    try:
+        return _registry[key]
+    except KeyError:
+        pass
+    value = build()
+    with _lock:
+        return _registry.setdefault(key, value)
+
+
+def clear():
+    _registry.clear()
+
+
+def form_fields(model):
+    return _cached(model, 'form', model.form_fields)
+
+
+def list_field_schema(model):
+    return _cached(model, 'list', model.list_field_schema)
+
+
+def detail_fields(model):
+    """
+    The field names ``detail_json`` serializes, ``related_model:fieldname``
+    for child tables.
+    """
+    def build():
+        try:
+            form = form_fields(model).get('sections', [])
+        except Exception:
+            # If form_fields not implemented, return basic serialization
+            form = []
+        fields = []
+        for section in form:
+            for column in section:
+                for field_dict in column:
+                    if field_dict.get('fieldtype') == 'table':
+                        fields.append(f"{field_dict.get('related_model')}:{field_dict.get('fieldname')}")
+                    else:
+                        fields.append(field_dict.get('fieldname'))
+        return fields
+
+    return _cached(model, 'detail', build)
+
+
+def compute_etag(value):
+    content = json.dumps(value, sort_keys=True, default=str).encode()
+    return f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+
+
+def form_etag(model):
+    return _cached(model, 'form_etag', lambda: compute_etag(form_fields(model)))
+
+
+def list_etag(model):
+    return _cached(model, 'list_etag', lambda: compute_etag(list_field_schema(model)))
+
+
+def not_modified(request, etag):
+    """Whether the request's ``If-None-Match`` includes ``etag``"""
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    return etag in etags or '*' in etags
+
+
+def schema_unchanged(request, etag):
+    """Whether the client already holds the schema with ``etag``"""
+    return request.headers.get(SCHEMA_ETAG_HEADER) == etag
@@ -0,0 +1,440 @@
+"""
+In-memory inverted index over published vehicles.
+
+Every categorical column maps each value to a bitmap (a python int with bit
+``pk`` set), so a search filter map is answered by AND-ing a handful of
+bitmaps. Numeric columns are kept as sorted ``(value, pk)`` lists, so range
+filters are two bisects. The index lives per process and is built in a
+background thread the first time it is needed; while it is cold,
+``process_search`` falls back to the ORM.
+
+Searches are answered from the index alone, so every process has to see
+every change: ``changed`` is called once a write to vehicles commits (from
+the Vehicle signals, the admin actions and the CMS) and records the pks
+under a version number in the shared cache (see SHARED_CACHE_REQUIRED).
+Each search first reloads the vehicles recorded since the index last
+synced, or drops the index for a rebuild when an entry has expired. It is
+also rebuilt every ``SEARCH_INDEX_MAX_AGE`` seconds, for writes that bypass
+all of these.
+"""
+import bisect
+import re
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from auto_app.logging import logger
+
+
+# query param -> vehicle column, for exact match filters
+CATEGORICAL_FIELDS = {
+    'make': 'make_id',
+    'model': 'model_id',
+    'city': 'city_id',
+    'transmission': 'transmission',
+    'fuel_type': 'fuel_type',
+    'drivetrain': 'drivetrain',
+    'body_type': 'body_type',
+    'condition': 'condition',
+}
+
+# foreign key filters take ids, the rest are matched case insensitively
+ID_FIELDS = ['make', 'model', 'city']
+
+NUMERIC_FIELDS = {
+    'price': Decimal,
+    'year': int,
+    'mileage': int,
+}
+
+# query param -> (column, is_upper_bound, ignored values)
+RANGE_FILTERS = {
+    'min_price': ('price', False, ()),
+    'max_price': ('price', True, ('0',)),
+    'min_year': ('year', False, ()),
+    'max_year': ('year', True, ()),
+    'min_mileage': ('mileage', False, ()),
+    'max_mileage': ('mileage', True, ('0',)),
+}
+
+# facets returned next to search results, as query param -> vehicle column
+FACET_FIELDS = {
+    'make': 'make_id',
+    'model': 'model_id',
+    'city': 'city_id',
+    'body_type': 'body_type',
+    'fuel_type': 'fuel_type',
+    'transmission': 'transmission',
+    'drivetrain': 'drivetrain',
+}
+YEAR_BUCKET_SIZE = 5
+PRICE_BUCKETS = [0, 2500, 5000, 10000, 20000, 50000, 100000]
+
+INDEX_COLUMNS = ['pk'] + list(CATEGORICAL_FIELDS.values()) + list(NUMERIC_FIELDS.keys())
+
+VERSION_KEY = 'search_index:version'
+CHANGES_KEY = 'search_index:changes:{}'
+
+
+def record_changes(pks):
+    """Records changed vehicles for every process, returns the new version"""
+    try:
+        version = cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 0, None)
+        version = cache.incr(VERSION_KEY)
+    cache.set(
+        CHANGES_KEY.format(version), sorted(set(pks)),
+        getattr(settings, 'SEARCH_INDEX_CHANGES_TIMEOUT', 24 * 60 * 60),
+    )
+    return version
+
+
+def search_params(query_map):
+    """
+    Flattens a filter map to single values. Saved searches are stored as
+    ``dict(request.GET)`` so their values are lists.
+    """
+    params = {}
+    for key in query_map.keys():
+        value = query_map.get(key)
+        if isinstance(value, (list, tuple)):
+            value = value[-1] if value else None
+        params[key] = value
+    return params
+
+
+def year_bucket(year):
+    start = year - year % YEAR_BUCKET_SIZE
+    return f"{start}-{start + YEAR_BUCKET_SIZE - 1}"
+
+
+def price_bucket(price):
+    i = max(bisect.bisect_right(PRICE_BUCKETS, price) - 1, 0)
+    if i == len(PRICE_BUCKETS) - 1:
+        return f"{PRICE_BUCKETS[i]}+"
+    return f"{PRICE_BUCKETS[i]}-{PRICE_BUCKETS[i + 1]}"
+
+
+def count_facets(rows, categorical=True):
+    """
+    Counts facet values over an iterable of row dicts keyed by vehicle column
+    in one pass. Returns ``{facet: {value: count}}``.
+    """
+    counts = {'year': {}, 'price': {}}
+    facets = FACET_FIELDS if categorical else {}
+    counts.update({facet: {} for facet in facets})
+    for row in rows:
+        for facet, column in facets.items():
+            facet_counts = counts[facet]
+            facet_counts[row[column]] = facet_counts.get(row[column], 0) + 1
+        for facet, bucket in (('year', year_bucket), ('price', price_bucket)):
+            value = bucket(row[facet])
+            counts[facet][value] = counts[facet].get(value, 0) + 1
+    return counts
+
+
+def bitmap_members(bitmap):
+    """Returns the pks set in a bitmap in ascending order"""
+    return [m.start() for m in re.finditer('1', bin(bitmap)[:1:-1])]
+
+
+def bitmap_from_pks(pks):
+    if not pks:
+        return 0
+    bits = bytearray(max(pks) // 8 + 1)
+    for pk in pks:
+        bits[pk >> 3] |= 1 << (pk & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class VehicleSearchIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._building = False
+        self._pending = []
+        self.built_at = None
+        self.version = None
+        self._reset()
+
+    def _reset(self):
+        self.rows = {}
+        self.universe = 0
+        self.bitmaps = {field: {} for field in CATEGORICAL_FIELDS}
+        self.columns = {field: [] for field in NUMERIC_FIELDS}
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'SEARCH_INDEX_ENABLED', True)
+
+    @property
+    def is_warm(self):
+        return self.built_at is not None
+
+    @property
+    def is_stale(self):
+        max_age = getattr(settings, 'SEARCH_INDEX_MAX_AGE', 15 * 60)
+        return self.built_at is None or time.monotonic() - self.built_at > max_age
+
+    @staticmethod
+    def row_from_values(values):
+        """Normalizes a ``values_list(*INDEX_COLUMNS)`` tuple"""
+        row = dict(zip(INDEX_COLUMNS, values))
+        for param, column in CATEGORICAL_FIELDS.items():
+            if param not in ID_FIELDS and row[column] is not None:
+                row[column] = row[column].lower()
+        for field, cast in NUMERIC_FIELDS.items():
+            # instances saved straight from request data may hold strings
+            row[field] = cast(str(row[field] or 0))
+        return row
+
+    def build(self):
+        """Loads every published vehicle in one query and swaps the index in"""
+        from auto_app.models import Vehicle
+
+        with self._lock:
+            if not self._building:
+                self._building = True
+                self._pending = []
+
+        try:
+            # changes recorded after this are applied by the next sync
+            version = cache.get(VERSION_KEY) or 0
+            values = Vehicle.objects.filter(published=True).values_list(*INDEX_COLUMNS)
+            rows = [self.row_from_values(v) for v in values.iterator()]
+        except Exception:
+            with self._lock:
+                self._building = False
+            raise
+
+        bitmaps = {field: {} for field in CATEGORICAL_FIELDS}
+        members = {field: {} for field in CATEGORICAL_FIELDS}
+        for row in rows:
+            for param, column in CATEGORICAL_FIELDS.items():
+                members[param].setdefault(row[column], []).append(row['pk'])
+        for param, groups in members.items():
+            for value, pks in groups.items():
+                bitmaps[param][value] = bitmap_from_pks(pks)
+
+        with self._lock:
+            self.rows = {row['pk']: row for row in rows}
+            self.universe = bitmap_from_pks(list(self.rows))
+            self.bitmaps = bitmaps
+            self.columns = {
+                field: sorted((row[field], row['pk']) for row in rows)
+                for field in NUMERIC_FIELDS
+            }
+            self.built_at = time.monotonic()
+            self.version = version
+            self._building = False
+            pending, self._pending = self._pending, []
+            for action, args in pending:
+                action(*args)
+
+    def _build_in_background(self):
+        try:
+            self.build()
+        except Exception as e:
+            logger.error(f"Failed to build vehicle search index: {str(e)}")
+        finally:
+            connection.close()
+
+    def warm(self):
+        """Starts a background build if the index is cold or stale"""
+        with self._lock:
+            if self._building or not self.is_stale:
+                return
+            self._building = True
+        threading.Thread(target=self._build_in_background, daemon=True).start()
+
+    def update(self, row):
+        """Adds or replaces a vehicle row, removing it if unpublished"""
+        with self._lock:
+            if self._building:
+                self._pending.append((self.update, (row,)))
+            if not self.is_warm:
+                return
+            self._discard(row['pk'])
+            if row.get('published', True):
+                self._add(row)
+
+    def changed(self, pks):
+        """
+        Reloads the given vehicles here and has every other process reload
+        them on its next search. Call it once the write has committed.
+        """
+        pks = list(pks)
+        if not pks:
+            return
+        record_changes(pks)
+        self.sync()
+
+    def sync(self):
+        """Reloads the vehicles any process changed since the last sync"""
+        if not self.is_warm:
+            return
+        version = cache.get(VERSION_KEY) or 0
+        with self._lock:
+            current = self.version
+        if current is not None and version == current:
+            return
+        missed = [] if current is None or version < current else list(range(current + 1, version + 1))
+        keys = [CHANGES_KEY.format(n) for n in missed]
+        entries = cache.get_many(keys)
+        if not missed or len(entries) < len(keys):
+            # the changes are gone, or the cache was cleared
+            logger.warning("Vehicle search index missed changes, rebuilding it")
+            with self._lock:
+                self.built_at = None
+            self.warm()
+            return
+        self.refresh(set().union(*entries.values()))
+        with self._lock:
+            if self.version is not None and self.version < version:
+                self.version = version
+
+    def refresh(self, pks):
+        """Reloads the given vehicles from the database"""
+        from auto_app.models import Vehicle
+
+        pks = list(pks)
+        if not pks or not self.is_warm:
+            return
+        found = set()
+        for values in Vehicle.objects.filter(pk__in=pks, published=True).values_list(*INDEX_COLUMNS):
+            row = self.row_from_values(values)
+            found.add(row['pk'])
+            self.update(row)
+        for pk in set(pks) - found:
+            self.discard(pk)
+
+    def discard(self, pk):
+        with self._lock:
+            if self._building:
+                self._pending.append((self.discard, (pk,)))
+            if self.is_warm:
+                self._discard(pk)
+
+    def _add(self, row):
+        pk = row['pk']
+        bit = 1 << pk
+        self.rows[pk] = row
+        self.universe |= bit
+        for param, column in CATEGORICAL_FIELDS.items():
+            bitmaps = self.bitmaps[param]
+            bitmaps[row[column]] = bitmaps.get(row[column], 0) | bit
+        for field in NUMERIC_FIELDS:
+            bisect.insort(self.columns[field], (row[field], pk))
+
+    def _discard(self, pk):
+        row = self.rows.pop(pk, None)
+        if row is None:
+            return
+        mask = ~(1 << pk)
+        self.universe &= mask
+        for param, column in CATEGORICAL_FIELDS.items():
+            bitmaps = self.bitmaps[param]
+            remaining = bitmaps.get(row[column], 0) & mask
+            if remaining:
+                bitmaps[row[column]] = remaining
+            else:
+                bitmaps.pop(row[column], None)
+        for field in NUMERIC_FIELDS:
+            column = self.columns[field]
+            i = bisect.bisect_left(column, (row[field], pk))
+            if i < len(column) and column[i] == (row[field], pk):
+                del column[i]
+
+    def _range_bitmap(self, field, low=None, high=None):
+        column = self.columns[field]
+        start = 0 if low is None else bisect.bisect_left(column, (low, -1))
+        end = len(column) if high is None else bisect.bisect_right(column, (high, float('inf')))
+        return bitmap_from_pks([pk for _, pk in column[start:end]])
+
+    def match(self, query_map):
+        """
+        Returns the bitmap of published vehicles matching a search filter map,
+        or None if the index is cold or a value can't be answered from it.
+        """
+        if not self.enabled:
+            return None
+        if self.is_stale:
+            self.warm()
+        self.sync()
+        if not self.is_warm:
+            return None
+
+        params = search_params(query_map)
+        try:
+            categorical = []
+            for param in CATEGORICAL_FIELDS:
+                if params.get(param):
+                    value = params[param]
+                    value = int(value) if param in ID_FIELDS else str(value).lower()
+                    categorical.append((param, value))
+
+            ranges = {}
+            for param, (field, upper, ignored) in RANGE_FILTERS.items():
+                if params.get(param) and params[param] not in ignored:
+                    bounds = ranges.setdefault(field, [None, None])
+                    bounds[upper] = NUMERIC_FIELDS[field](params[param])
+        except (ValueError, TypeError, InvalidOperation):
+            return None
+
+        with self._lock:
+            result = self.universe
+            for param, value in categorical:
+                result &= self.bitmaps[param].get(value, 0)
+                if not result:
+                    return 0
+            for field, (low, high) in ranges.items():
+                result &= self._range_bitmap(field, low, high)
+        return result
+
+    def facets(self, bitmap):
+        """
+        Facet counts for a result bitmap. Categorical facets are one popcount
+        per value, year and price buckets come from the matching rows.
+        Vehicles discarded since the bitmap was matched are left out.
+        """
+        with self._lock:
+            bitmap &= self.universe
+            counts = count_facets(
+                (self.rows[pk] for pk in bitmap_members(bitmap)), categorical=False
+            )
+            for facet in FACET_FIELDS:
+                counts[facet] = {
+                    value: count
+                    for value, count in (
+                        (value, (values & bitmap).bit_count())
+                        for value, values in self.bitmaps[facet].items()
+                    )
+                    if count
+                }
+        return counts
+
+    def results(self, query_map):
+        """
+        Returns the bitmap of the matching vehicles, or None when the ORM
+        should answer the query instead: the index is cold, or the result
+        is too broad to be worth sending back as an ``IN`` list.
+        """
+        bitmap = self.match(query_map)
+        if bitmap is None:
+            return None
+        max_results = getattr(settings, 'SEARCH_INDEX_MAX_RESULTS', 900)
+        if bitmap.bit_count() > max_results:
+            return None
+        return bitmap
+
+    def search(self, query_map):
+        """The matching pks, or None when the ORM should answer the query"""
+        bitmap = self.results(query_map)
+        return None if bitmap is None else bitmap_members(bitmap)
+
+
+vehicle_index = VehicleSearchIndex()
@@ -0,0 +1,395 @@
+"""
+Similarity scoring for related listings.
+
+Published vehicles are turned into weighted feature vectors (one-hot make,
+model, body type and drivetrain plus normalized price, year and mileage) and
+each vehicle's nearest neighbours are found with batched NumPy distance
+computations. The top ``RELATED_LISTINGS_TOP_K`` are stored in the
+RelatedVehicle table, so ``Vehicle.related_listings`` is a single indexed
+lookup. Saving or deleting a vehicle, or updating vehicles in the admin or
+the CMS, queues an incremental refresh, which loads only the changed
+vehicles into the process's FeatureMatrix and only recomputes the rows the
+change can affect. The numeric features are scaled to fixed ranges rather
+than to the current minimum and maximum, so no change moves every vector.
+"""
+import queue
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Min, Q
+
+from auto_app.logging import logger
+
+
+CATEGORICAL_FEATURES = {
+    'make_id': 2.0,
+    'model_id': 3.0,
+    'body_type': 1.5,
+    'drivetrain': 0.5,
+}
+
+# numeric features are clipped to their range, transformed and scaled to 0-1
+NUMERIC_FEATURES = {
+    'price': (2.0, np.log1p, (0, 1000000)),
+    'year': (1.0, None, (1980, 2030)),
+    'mileage': (1.0, np.log1p, (0, 1000000)),
+}
+
+NUMERIC_WEIGHTS = np.sqrt([weight for weight, _, _ in NUMERIC_FEATURES.values()])
+
+FEATURE_COLUMNS = ['pk'] + list(CATEGORICAL_FEATURES) + list(NUMERIC_FEATURES)
+BATCH_SIZE = 512
+
+VERSION_KEY = 'related_listings:version'
+CHANGES_KEY = 'related_listings:changes:{}'
+
+
+def top_k():
+    return getattr(settings, 'RELATED_LISTINGS_TOP_K', 10)
+
+
+def transform_numeric(values):
+    """Clips and transforms an array of raw price, year and mileage rows"""
+    values = values.copy()
+    for i, (_, transform, (low, high)) in enumerate(NUMERIC_FEATURES.values()):
+        values[:, i] = np.clip(values[:, i], low, high)
+        if transform is not None:
+            values[:, i] = transform(values[:, i])
+    return values
+
+
+NUMERIC_LOW, NUMERIC_HIGH = transform_numeric(
+    np.array([bounds for _, _, bounds in NUMERIC_FEATURES.values()], dtype=float).T
+)
+
+
+def scale_numeric(values):
+    """Weighted numeric features of raw price, year and mileage rows"""
+    scaled = (transform_numeric(values) - NUMERIC_LOW) / (NUMERIC_HIGH - NUMERIC_LOW)
+    return (scaled * NUMERIC_WEIGHTS).astype(np.float32)
+
+
+def next_version():
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 0, None)
+        return cache.incr(VERSION_KEY)
+
+
+class FeatureMatrix:
+    """
+    Process local feature vectors of the published vehicles, so a refresh
+    only loads the vehicles that changed, along with the worst stored score
+    and number of stored neighbours of each. The numeric features come
+    first, then one column per categorical value in the order they were
+    first seen, which doesn't change any distance. Every refresh bumps a
+    version in the shared cache (see SHARED_CACHE_REQUIRED) and records the
+    changed pks and the vehicles whose neighbours it replaced under it, so
+    other processes reload just those, or everything when an entry is
+    missing.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.version = None
+        self.pks = np.zeros(0, dtype=np.int64)
+        self.positions = {}
+        self.columns = {}
+        self.features = np.zeros((0, len(NUMERIC_FEATURES)), dtype=np.float32)
+        self.worst = np.zeros(0)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def load_rows(pks=None):
+        """Feature values of the listed vehicles, or of those in ``pks``"""
+        from auto_app.models import Vehicle
+
+        vehicles = Vehicle.objects.filter(published=True, temporary=False)
+        if pks is not None:
+            vehicles = vehicles.filter(pk__in=list(pks))
+        return {row[0]: row[1:] for row in vehicles.values_list(*FEATURE_COLUMNS)}
+
+    def load_scores(self, pks=None):
+        """Loads the worst stored score and count of every vehicle, or of ``pks``"""
+        from auto_app.models import RelatedVehicle
+
+        rows = RelatedVehicle.objects.all()
+        if pks is not None:
+            pks = [pk for pk in pks if pk in self.positions]
+            if not pks:
+                return
+            rows = rows.filter(vehicle_id__in=pks)
+            positions = [self.positions[pk] for pk in pks]
+        else:
+            positions = slice(None)
+        self.worst[positions] = 0
+        self.counts[positions] = 0
+        for pk, worst, count in rows.values('vehicle_id').annotate(
+            worst=Min('score'), count=Count('pk')
+        ).values_list('vehicle_id', 'worst', 'count'):
+            if pk in self.positions:
+                self.worst[self.positions[pk]] = worst
+                self.counts[self.positions[pk]] = count
+
+    def scored(self, neighbours):
+        """Notes the worst score and count of freshly stored neighbours"""
+        for pk, related_list in neighbours:
+            position = self.positions[pk]
+            self.worst[position] = related_list[-1][1] if related_list else 0
+            self.counts[position] = len(related_list)
+
+    def apply(self, rows, pks=()):
+        """
+        Stores ``rows``, pk -> feature values, and removes the vehicles in
+        ``pks`` missing from them.
+        """
+        removed = [self.positions[pk] for pk in pks if pk in self.positions and pk not in rows]
+        if removed:
+            self.pks = np.delete(self.pks, removed)
+            self.features = np.delete(self.features, removed, axis=0)
+            self.worst = np.delete(self.worst, removed)
+            self.counts = np.delete(self.counts, removed)
+            self.positions = {int(pk): i for i, pk in enumerate(self.pks)}
+
+        unseen = sorted({
+            (column, row[i]) for row in rows.values() for i, column in enumerate(CATEGORICAL_FEATURES)
+        } - self.columns.keys(), key=str)
+        if unseen:
+            width = self.features.shape[1]
+            self.columns.update((key, width + n) for n, key in enumerate(unseen))
+            self.features = np.hstack([self.features, np.zeros((len(self.pks), len(unseen)), dtype=np.float32)])
+
+        added = [pk for pk in rows if pk not in self.positions]
+        if added:
+            self.positions.update((pk, len(self.pks) + n) for n, pk in enumerate(added))
+            self.pks = np.concatenate([self.pks, np.array(added, dtype=np.int64)])
+            self.features = np.vstack([
+                self.features, np.zeros((len(added), self.features.shape[1]), dtype=np.float32)
+            ])
+            self.worst = np.concatenate([self.worst, np.zeros(len(added))])
+            self.counts = np.concatenate([self.counts, np.zeros(len(added), dtype=np.int64)])
+
+        if not rows:
+            return
+        changed = np.array([self.positions[pk] for pk in rows], dtype=np.int64)
+        offset = len(CATEGORICAL_FEATURES)
+        values = np.array([[float(v or 0) for v in row[offset:]] for row in rows.values()])
+        self.features[changed, :len(NUMERIC_FEATURES)] = scale_numeric(values)
+        self.features[changed, len(NUMERIC_FEATURES):] = 0
+        for position, row in zip(changed, rows.values()):
+            for i, (column, weight) in enumerate(CATEGORICAL_FEATURES.items()):
+                self.features[position, self.columns[(column, row[i])]] = np.sqrt(weight)
+
+    def sync(self, changed=None):
+        """
+        Applies the changes other processes recorded since the last sync and
+        the vehicles ``changed`` here, every vehicle when None. The caller
+        records what it stored with ``record``.
+        """
+        version = next_version()
+        missed = [] if self.version is None else list(range(self.version + 1, version))
+        entries = cache.get_many([CHANGES_KEY.format(n) for n in missed])
+        others = [entries.get(CHANGES_KEY.format(n), (None, None)) for n in missed]
+
+        if changed is None or self.version is None or version <= self.version \
+                or any(entry[1] is None for entry in others):
+            self.reset()
+            self.apply(self.load_rows())
+            self.load_scores()
+        else:
+            pks = set(changed).union(*(entry[0] for entry in others))
+            self.apply(self.load_rows(pks), pks)
+            self.load_scores(set().union(*(entry[1] for entry in others)))
+        self.version = version
+
+    def record(self, changed, affected):
+        """
+        Records the vehicles that changed and those whose neighbours were
+        replaced under the current version, both None for all of them.
+        """
+        cache.set(
+            CHANGES_KEY.format(self.version),
+            (None if changed is None else sorted(changed), None if affected is None else sorted(affected)),
+            getattr(settings, 'RELATED_LISTINGS_CHANGES_TIMEOUT', 24 * 60 * 60),
+        )
+
+
+feature_matrix = FeatureMatrix()
+
+
+def squared_distances(batch, features, norms):
+    """Pairwise squared distances between a batch of rows and all rows"""
+    batch_norms = np.einsum('ij,ij->i', batch, batch)
+    distances = batch_norms[:, None] + norms[None, :] - 2 * batch @ features.T
+    return np.maximum(distances, 0)
+
+
+def best_scores(vectors, features):
+    """The best score any of ``vectors`` gets against each row of ``features``"""
+    norms = np.einsum('ij,ij->i', features, features)
+    best = np.zeros(len(features))
+    for start in range(0, len(vectors), BATCH_SIZE):
+        distances = squared_distances(vectors[start:start + BATCH_SIZE], features, norms)
+        best = np.maximum(best, (1.0 / (1.0 + distances)).max(axis=0))
+    return best
+
+
+def nearest_neighbours(rows, pks, features, k):
+    """
+    Yields ``(vehicle_pk, [(related_pk, score), ...])`` for each row index in
+    ``rows``, best match first. Scores are ``1 / (1 + distance²)``.
+    """
+    norms = np.einsum('ij,ij->i', features, features)
+    k = min(k, len(pks) - 1)
+    if k <= 0:
+        for row in rows:
+            yield int(pks[row]), []
+        return
+
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch_rows = np.asarray(rows[start:start + BATCH_SIZE])
+        distances = squared_distances(features[batch_rows], features, norms)
+        distances[np.arange(len(batch_rows)), batch_rows] = np.inf
+        candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+        order = np.argsort(candidate_distances, axis=1, kind='stable')
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        scores = 1.0 / (1.0 + np.take_along_axis(candidate_distances, order, axis=1))
+        for row, neighbours, row_scores in zip(batch_rows, candidates, scores):
+            yield int(pks[row]), [
+                (int(pks[n]), float(s)) for n, s in zip(neighbours, row_scores)
+            ]
+
+
+def store(neighbours):
+    """Replaces the stored neighbours of the given vehicles"""
+    from auto_app.models import RelatedVehicle
+
+    neighbours = dict(neighbours)
+    with transaction.atomic():
+        RelatedVehicle.objects.filter(vehicle_id__in=list(neighbours)).delete()
+        RelatedVehicle.objects.bulk_create([
+            RelatedVehicle(vehicle_id=pk, related_id=related, rank=rank, score=score)
+            for pk, related_list in neighbours.items()
+            for rank, (related, score) in enumerate(related_list)
+        ], batch_size=1000)
+
+
+def store_all():
+    """Replaces the whole table with the neighbours of every vehicle"""
+    from auto_app.models import RelatedVehicle
+
+    pks, features = feature_matrix.pks, feature_matrix.features
+    neighbours = list(nearest_neighbours(list(range(len(pks))), pks, features, top_k()))
+    with transaction.atomic():
+        RelatedVehicle.objects.all().delete()
+        store(neighbours)
+    feature_matrix.scored(neighbours)
+    return len(neighbours)
+
+
+def rebuild():
+    """Recomputes the related listings of every listed vehicle"""
+    with feature_matrix.lock:
+        feature_matrix.sync()
+        count = store_all()
+        feature_matrix.record(None, None)
+        return count
+
+
+def refresh(vehicle_pks):
+    """
+    Incrementally updates the table after the given vehicles changed.
+    Recomputes their own neighbours and those of every vehicle that listed
+    one of them or that one of them now beats the current k-th match of.
+    """
+    from auto_app.models import RelatedVehicle
+
+    changed = set(vehicle_pks)
+    with feature_matrix.lock:
+        previous = feature_matrix.features[[
+            feature_matrix.positions[pk] for pk in changed if pk in feature_matrix.positions
+        ]]
+        feature_matrix.sync(changed)
+        pks, features, positions = feature_matrix.pks, feature_matrix.features, feature_matrix.positions
+        worst = feature_matrix.worst
+        k = top_k()
+
+        # anything that listed a changed vehicle has stale scores
+        affected = set(RelatedVehicle.objects.filter(related_id__in=changed).values_list('vehicle_id', flat=True))
+        listed = [positions[pk] for pk in changed if pk in positions]
+        affected.update(pks[listed].tolist())
+
+        # short lists are refilled
+        affected.update(pks[feature_matrix.counts < min(k, len(pks) - 1)].tolist())
+
+        if listed:
+            affected.update(pks[best_scores(features[listed], features) > worst].tolist())
+        if len(previous):
+            # deleting a vehicle deletes the rows listing it too, so those
+            # vehicles are found from where it was instead
+            previous = np.hstack([
+                previous, np.zeros((len(previous), features.shape[1] - previous.shape[1]), dtype=np.float32)
+            ])
+            affected.update(pks[best_scores(previous, features) >= worst - 1e-6].tolist())
+
+        rows = [positions[pk] for pk in affected if pk in positions]
+        neighbours = list(nearest_neighbours(rows, pks, features, k))
+        with transaction.atomic():
+            RelatedVehicle.objects.filter(
+                Q(vehicle_id__in=changed) | Q(related_id__in=changed)
+            ).exclude(vehicle_id__in=affected).delete()
+            store(neighbours)
+            stale = [pk for pk in affected if pk not in positions]
+            RelatedVehicle.objects.filter(vehicle_id__in=stale).delete()
+        feature_matrix.scored(neighbours)
+        feature_matrix.record(changed, affected)
+    return len(affected)
+
+
+class RefreshWorker:
+    """
+    Background thread that coalesces vehicle changes and refreshes the
+    related listings for all of them at once.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            changed = {self.queue.get()}
+            while not self.queue.empty():
+                changed.add(self.queue.get_nowait())
+            try:
+                refresh(changed)
+            except Exception as e:
+                logger.error(f"Failed to refresh related listings for {changed}: {str(e)}")
+            finally:
+                connection.close()
+
+    def enqueue(self, vehicle_pks):
+        if getattr(settings, 'RELATED_LISTINGS_BACKGROUND', True):
+            for pk in vehicle_pks:
+                self.queue.put(pk)
+            self._start()
+        else:
+            refresh(vehicle_pks)
+
+
+refresh_worker = RefreshWorker()
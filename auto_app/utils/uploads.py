@@ -0,0 +1,205 @@
+"""
+Streaming and resumable photo uploads.
+
+Photos can be sent to the upload endpoints in three ways:
+
+* as a multipart file, which Django streams to a temporary file as it is
+  parsed (``streaming_uploads`` drops the in-memory handler);
+* as the id of a completed chunked upload: ``POST /api/uploads/`` with the
+  filename and size starts one, each ``PUT /api/uploads/<id>/`` appends the
+  request body at the offset given by its ``Content-Range`` header, and
+  ``GET /api/uploads/<id>/`` returns the offset to resume from;
+* as a base64 data URL in the JSON body, kept for older clients.
+
+Chunks are copied from the request stream to disk in small blocks, so the
+memory used by an upload stays flat whatever the photo's size.
+
+``save_images`` validates and stores a batch of files on a bounded thread
+pool, for endpoints that take many photos at once.
+"""
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+from auto_app.logging import logger
+from auto_app.utils import base64_file
+
+
+COPY_BLOCK_SIZE = 64 * 1024
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class UploadError(Exception):
+    pass
+
+
+def upload_dir():
+    return Path(getattr(settings, 'CHUNKED_UPLOAD_DIR', Path(settings.BASE_DIR) / 'spool' / 'uploads'))
+
+
+def max_upload_size():
+    return getattr(settings, 'CHUNKED_UPLOAD_MAX_SIZE', 50 * 1024 * 1024)
+
+
+def session_path(session):
+    return upload_dir() / f"{session.id}.part"
+
+
+def streaming_uploads(request):
+    """Makes Django write multipart files straight to temporary files"""
+    request.upload_handlers = [TemporaryFileUploadHandler(request)]
+
+
+def request_data(request):
+    """The form fields of a multipart request or the JSON body"""
+    if request.content_type == 'multipart/form-data':
+        return request.POST.dict()
+    return json.loads(request.body or '{}')
+
+
+def parse_content_range(header, size):
+    """Returns ``(start, end)`` from a ``bytes start-end/size`` header"""
+    match = CONTENT_RANGE.match(header or '')
+    if not match:
+        raise UploadError("Content-Range header required, e.g. 'bytes 0-1048575/5242880'")
+    start, end, total = (int(g) for g in match.groups())
+    if total != size or start > end or end >= size:
+        raise UploadError("Content-Range doesn't match the upload")
+    return start, end
+
+
+def append_chunk(session, stream, start, end):
+    """
+    Copies bytes ``start`` to ``end`` from ``stream`` to the session's file.
+    The start must be the number of bytes received so far.
+    """
+    if start != session.received:
+        raise UploadError(f"Expected a chunk starting at byte {session.received}")
+
+    path = session_path(session)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    remaining = end - start + 1
+    with open(path, 'ab') as f:
+        f.truncate(start)
+        while remaining:
+            block = stream.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            f.write(block)
+            remaining -= len(block)
+        written = f.tell() - start
+    if remaining:
+        # keep what arrived so the client can resume from there
+        session.received = start + written
+        session.save(update_fields=['received', 'updated_at'])
+        raise UploadError("Chunk is shorter than its Content-Range")
+    session.received = end + 1
+    session.save(update_fields=['received', 'updated_at'])
+
+
+class SessionFile(File):
+    """
+    The file of a completed upload session. Storage moves it into place
+    instead of copying it, and closing it discards the session.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        super().__init__(open(session_path(session), 'rb'), name=session.filename)
+        self.size = session.size
+
+    def temporary_file_path(self):
+        return str(session_path(self.session))
+
+    def close(self):
+        super().close()
+        try:
+            os.unlink(session_path(self.session))
+        except FileNotFoundError:
+            pass
+        if self.session.pk:
+            self.session.delete()
+
+
+def session_file(request, upload_id):
+    """The file of the user's completed upload ``upload_id``"""
+    from auto_app.models import UploadSession
+
+    if request.user.is_anonymous:
+        raise UploadError("Authentication required")
+    try:
+        session = UploadSession.objects.get(pk=upload_id, user=request.user)
+    except (UploadSession.DoesNotExist, ValidationError):
+        raise UploadError("Upload not found")
+    if not session.complete:
+        raise UploadError("Upload is incomplete")
+    return SessionFile(session)
+
+
+def resolve_upload(request, field, value):
+    """
+    The uploaded file for ``field``: the multipart file of that name, or
+    ``value``, either a completed upload id or a base64 data URL (possibly
+    as ``{"upload_id": ...}`` or ``{"src": ...}``). Returns None if nothing
+    was sent.
+    """
+    if field in request.FILES:
+        return request.FILES[field]
+    if isinstance(value, dict):
+        value = value.get('upload_id') or value.get('src')
+    if not value:
+        return None
+    if isinstance(value, str) and value.startswith('data:'):
+        return base64_file(value)[0]
+    return session_file(request, value)
+
+
+def inspect_image(f):
+    """
+    Checks ``f`` is an image PIL can read and returns its size. Only the
+    header and structure are read, the pixels are decoded later by the
+    thumbnail worker.
+    """
+    from PIL import Image
+
+    if f.size > max_upload_size():
+        raise UploadError("File is too large")
+    f.seek(0)
+    try:
+        with Image.open(f) as im:
+            size = im.size
+            im.verify()
+    except Exception:
+        raise UploadError("Not a valid image")
+    f.seek(0)
+    return size
+
+
+def save_images(field, files, workers=None):
+    """
+    Validates ``files`` and saves them to the storage of ``field``, an
+    ImageField, on a bounded thread pool. Returns ``(name, width, height)``
+    or the UploadError for each file, in order. Doesn't touch the database,
+    so callers close the files afterwards.
+    """
+    def save(f):
+        try:
+            width, height = inspect_image(f)
+            name = field.generate_filename(None, os.path.basename(f.name))
+            return field.storage.save(name, f, max_length=field.max_length), width, height
+        except UploadError as e:
+            return e
+        except Exception as e:
+            logger.error(f"Failed to save upload {f.name}: {str(e)}")
+            return UploadError("Couldn't save the file")
+
+    workers = workers or getattr(settings, 'BULK_UPLOAD_WORKERS', 4)
+    with ThreadPoolExecutor(max_workers=min(workers, len(files) or 1)) as executor:
+        return list(executor.map(save, files))
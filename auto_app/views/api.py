@@ -1,18 +1,22 @@
 from django.http import JsonResponse
+from django.conf import settings
 from django.apps import apps
-from django.db.models import Q, Count
-from django.db.models.functions import TruncDate
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 from datetime import timedelta
 import json
-import requests
 from auto_app.models import (
     Vehicle, Make, Model, Seller, City, VehiclePhoto, ContactEntry,
     SavedListing, SavedSearch, Impression
 )
 from django.views.decorators.csrf import csrf_exempt
-from auto_app.utils import base64_file, process_search
-from auto_app.serializers import VehicleSerializer
+from auto_app.utils import process_search, vehicle_facets
+from auto_app.utils.uploads import UploadError, request_data, resolve_upload, streaming_uploads
+from auto_app.utils.pagination import paginate, ordering, InvalidCursor
+from auto_app.utils import recommendations, geoip, rollups
+from auto_app.utils.impressions import impression_queue, make_record
+from auto_app.serializers import VehicleSerializer, vehicle_serialization_plan
 from auto_app.utils.permissions import has_active_subscription
 
 
@@ -28,46 +32,52 @@ def get_client_ip(request):
 
 def get_ip_location(ip_address):
     """
-    Get geolocation data from IP address using ip-api.com (free service).
+    Get geolocation data from IP address using the local range database,
+    see auto_app.utils.geoip.
     Returns dict with city, region, country, country_code, lat, lon.
     """
-    if ip_address in ('127.0.0.1', 'localhost', '::1'):
-        return {
-            'city': 'Local',
-            'region': 'Local',
-            'country': 'Local',
-            'country_code': 'LO',
-            'lat': None,
-            'lon': None
-        }
+    return geoip.locator.locate(ip_address)
 
-    try:
-        response = requests.get(
-            f'http://ip-api.com/json/{ip_address}',
-            timeout=2
+
+def serialize_vehicles(request, vehicles):
+    return VehicleSerializer(vehicles, many=True, context={'request': request}).data
+
+
+def vehicle_page(request, queryset, default_sort='price'):
+    """
+    Serializes one keyset page of ``queryset`` using the request's
+    ``sort_by``, ``cursor`` and ``page_size`` params. Returns the data and
+    the cursors for the next and the previous page. Requests with neither
+    ``cursor`` nor ``page_size`` get every row, sorted, as before pagination.
+    """
+    if not request.GET.get('cursor') and not request.GET.get('page_size'):
+        vehicles = vehicle_serialization_plan(queryset).order_by(
+            *ordering(request.GET.get('sort_by'), default_sort)
         )
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('status') == 'success':
-                return {
-                    'city': data.get('city', ''),
-                    'region': data.get('regionName', ''),
-                    'country': data.get('country', ''),
-                    'country_code': data.get('countryCode', ''),
-                    'lat': data.get('lat'),
-                    'lon': data.get('lon')
-                }
-    except (requests.RequestException, ValueError):
-        pass
-
-    return {
-        'city': '',
-        'region': '',
-        'country': '',
-        'country_code': '',
-        'lat': None,
-        'lon': None
-    }
+        return serialize_vehicles(request, vehicles), None, None
+
+    vehicles, next_cursor, previous_cursor = paginate(
+        vehicle_serialization_plan(queryset),
+        sort_by=request.GET.get('sort_by'),
+        cursor=request.GET.get('cursor'),
+        size=request.GET.get('page_size'),
+        default=default_sort,
+    )
+    return serialize_vehicles(request, vehicles), next_cursor, previous_cursor
+
+
+def page_response(data, next_cursor, previous_cursor=None):
+    """List responses carry the next and previous pages' cursors in headers"""
+    response = JsonResponse(data, safe=False)
+    if next_cursor:
+        response['X-Next-Cursor'] = next_cursor
+    if previous_cursor:
+        response['X-Previous-Cursor'] = previous_cursor
+    return response
+
+
+def invalid_cursor_response(error):
+    return JsonResponse({"status": "error", "message": str(error)}, status=400)
 
 
 def search(request, model=None):
@@ -99,9 +109,17 @@ def search(request, model=None):
 
 
 def search_vehicles(request):
-    results = process_search(request.GET)
+    """
+    Search published vehicles, all of them or one page at a time (see
+    ``vehicle_page``). ``search_facets`` counts the same matches per facet.
+    """
+    try:
+        data, next_cursor, previous_cursor = vehicle_page(request, process_search(request.GET))
+    except InvalidCursor as e:
+        return invalid_cursor_response(e)
 
-    if not request.user.is_anonymous:
+    # recorded once per search, not for every page of it
+    if not request.user.is_anonymous and not request.GET.get('cursor'):
         saved_search, _ = SavedSearch.objects.get_or_create(user=request.user)
         json_string = saved_search.filters or """{"searches": []}"""
         search_list = json.loads(json_string)['searches']
@@ -112,7 +130,12 @@ def search_vehicles(request):
         })
         saved_search.save()
 
-    return JsonResponse(VehicleSerializer(results, many=True).data, safe=False)
+    return page_response(data, next_cursor, previous_cursor)
+
+
+def search_facets(request):
+    """Per-facet counts of the vehicles ``search_vehicles`` matches"""
+    return JsonResponse({"facets": vehicle_facets(request.GET)})
 
 
 @csrf_exempt
@@ -258,7 +281,8 @@ def update_account(request):
     if request.user.is_anonymous:
         return JsonResponse({"status": "error", "message": "Not authenticated"}, status=401)
 
-    data = json.loads(request.body)
+    streaming_uploads(request)
+    data = request_data(request)
     user = request.user
 
     # Update user fields
@@ -282,15 +306,20 @@ def update_account(request):
         if data.get('city') is not None:
             seller.city_id = data.get('city')
 
-        # Handle photo upload
-        if data.get('photo'):
-            photo_data = data.get('photo')
-            if isinstance(photo_data, dict) and photo_data.get('src'):
-                file_obj, _ = base64_file(photo_data.get('src'))
-                if file_obj:
-                    seller.photo = file_obj
+        # Handle photo upload: a multipart file, a completed chunked upload
+        # or a base64 data URL
+        try:
+            file_obj = resolve_upload(request, 'photo', data.get('photo'))
+        except UploadError as e:
+            return JsonResponse({"status": "error", "message": str(e)}, status=400)
+        if file_obj:
+            seller.photo = file_obj
 
-        seller.save()
+        try:
+            seller.save()
+        finally:
+            if file_obj:
+                file_obj.close()
 
     return JsonResponse({
         "status": "success",
@@ -396,7 +425,10 @@ def account_listings(request):
         return JsonResponse([], safe=False)
 
     vehicles = Vehicle.objects.filter(seller=seller)
-    return JsonResponse(VehicleSerializer(vehicles, many=True).data, safe=False)
+    try:
+        return page_response(*vehicle_page(request, vehicles, default_sort='-created_at'))
+    except InvalidCursor as e:
+        return invalid_cursor_response(e)
 
 
 @csrf_exempt
@@ -426,9 +458,11 @@ def saved_listings(request):
     if request.user.is_anonymous:
         return JsonResponse([], safe=False)
 
-    saved = SavedListing.objects.filter(user=request.user)
-    vehicles = [s.vehicle for s in saved]
-    return JsonResponse(VehicleSerializer(vehicles, many=True).data, safe=False)
+    vehicles = Vehicle.objects.filter(savedlisting__user=request.user)
+    try:
+        return page_response(*vehicle_page(request, vehicles, default_sort='-created_at'))
+    except InvalidCursor as e:
+        return invalid_cursor_response(e)
 
 
 @csrf_exempt
@@ -478,7 +512,8 @@ def related_listings(request, id=None):
     """Get related listings for a vehicle"""
     try:
         vehicle = Vehicle.objects.get(pk=id)
-        return JsonResponse(VehicleSerializer(vehicle.related_listings(), many=True).data, safe=False)
+        vehicles = vehicle_serialization_plan(vehicle.related_listings())
+        return JsonResponse(serialize_vehicles(request, vehicles), safe=False)
     except Vehicle.DoesNotExist:
         return JsonResponse([], safe=False)
 
@@ -486,7 +521,7 @@ def related_listings(request, id=None):
 def latest_listings(request, id=None):
     """Get latest vehicle listings"""
     vehicles = Vehicle.objects.filter(published=True).order_by("-created_at")[:10]
-    return JsonResponse(VehicleSerializer(vehicles, many=True).data, safe=False)
+    return JsonResponse(serialize_vehicles(request, vehicle_serialization_plan(vehicles)), safe=False)
 
 
 def recommended_listings(request):
@@ -495,32 +530,22 @@ def recommended_listings(request):
     if not user.is_authenticated:
         return JsonResponse([], safe=False)
 
-    saved_vehicles = SavedListing.objects.filter(user=user)
-    recommended_vehicle_ids = []
-
-    for saved_vehicle in saved_vehicles:
-        recommended_vehicle_ids.extend([v.pk for v in saved_vehicle.vehicle.related_listings()])
-
-    saved_searches = SavedSearch.objects.filter(user=user).first()
-    if saved_searches and saved_searches.filters:
-        try:
-            searches = json.loads(saved_searches.filters).get('searches', [])
-            for saved_search in searches:
-                recommended_vehicle_ids.extend([v.pk for v in process_search(saved_search)])
-        except (json.JSONDecodeError, TypeError):
-            pass
-
-    unique_pks = set(recommended_vehicle_ids)
-    vehicles = Vehicle.objects.filter(pk__in=list(unique_pks)[:10])
+    ranked = recommendations.recommend(user)
+    vehicles = vehicle_serialization_plan(Vehicle.objects.filter(pk__in=ranked, published=True))
+    by_pk = {v.pk: v for v in vehicles}
+    vehicles = [by_pk[pk] for pk in ranked if pk in by_pk]
 
-    return JsonResponse(VehicleSerializer(vehicles, many=True).data, safe=False)
+    return JsonResponse(serialize_vehicles(request, vehicles), safe=False)
 
 
 @csrf_exempt
+@transaction.non_atomic_requests
 def record_impression(request):
     """
     Record a page view impression for a vehicle.
     This endpoint is public and does not require authentication.
+    The impression is queued and written by a background worker, see
+    auto_app.utils.impressions.
     """
     if request.method != "POST":
         return JsonResponse({"status": "error", "message": "POST required"}, status=405)
@@ -535,28 +560,19 @@ def record_impression(request):
         return JsonResponse({"status": "error", "message": "vehicle_id required"}, status=400)
 
     try:
-        vehicle = Vehicle.objects.get(pk=vehicle_id)
-    except Vehicle.DoesNotExist:
-        return JsonResponse({"status": "error", "message": "Vehicle not found"}, status=404)
+        vehicle_id = int(vehicle_id)
+    except (TypeError, ValueError):
+        return JsonResponse({"status": "error", "message": "Invalid vehicle_id"}, status=400)
 
-    # Get client IP and location
-    ip_address = get_client_ip(request)
-    location = get_ip_location(ip_address)
-
-    # Create impression record
-    Impression.objects.create(
-        vehicle=vehicle,
-        ip_address=ip_address,
-        city=location.get('city', ''),
-        region=location.get('region', ''),
-        country=location.get('country', ''),
-        country_code=location.get('country_code', ''),
-        latitude=location.get('lat'),
-        longitude=location.get('lon'),
+    record = make_record(
+        vehicle_id,
+        get_client_ip(request),
         user_agent=request.META.get('HTTP_USER_AGENT', ''),
         referrer=data.get('referrer', ''),
-        session_id=data.get('session_id', '')
+        session_id=data.get('session_id', ''),
     )
+    if not impression_queue.put(record):
+        return JsonResponse({"status": "error", "message": "Try again later"}, status=503)
 
     return JsonResponse({"status": "success"})
 
@@ -566,7 +582,7 @@ def impression_stats(request):
     Get impression statistics for the authenticated dealer's vehicles.
     Returns aggregated statistics including:
     - Total impressions
-    - Unique visitors (by IP)
+    - Unique visitors (by IP, estimated for periods over a day)
     - Impressions by location
     - Impressions over time
     - Top viewed vehicles
@@ -588,57 +604,18 @@ def impression_stats(request):
     # Filter impressions based on user role
     if is_admin:
         base_queryset = Impression.objects.filter(created_at__gte=start_date)
-        vehicles_queryset = Vehicle.objects.all()
     else:
         base_queryset = Impression.objects.filter(
             vehicle__seller=seller,
             created_at__gte=start_date
         )
-        vehicles_queryset = Vehicle.objects.filter(seller=seller)
-
-    # Total impressions
-    total_impressions = base_queryset.count()
 
-    # Unique visitors
-    unique_visitors = base_queryset.values('ip_address').distinct().count()
-
-    # Impressions by city (primary grouping for single-country focus)
-    by_city = list(
-        base_queryset
-        .exclude(city='')
-        .values('city', 'region')
-        .annotate(count=Count('id'))
-        .order_by('-count')[:10]
-    )
-
-    # Impressions over time (daily)
-    by_date = list(
-        base_queryset
-        .annotate(date=TruncDate('created_at'))
-        .values('date')
-        .annotate(count=Count('id'))
-        .order_by('date')
+    # Totals, locations, dates and top vehicles come from the daily rollups
+    # and unique visitors from the daily sketches, except for short periods
+    stats = rollups.dashboard_stats(
+        None if is_admin else seller, start_date,
+        exact_visitors=days <= getattr(settings, 'IMPRESSION_EXACT_VISITOR_DAYS', 1)
     )
-    # Convert dates to strings for JSON serialization
-    for item in by_date:
-        item['date'] = item['date'].isoformat() if item['date'] else None
-
-    # Top viewed vehicles
-    top_vehicles = list(
-        base_queryset
-        .values('vehicle__id', 'vehicle__model__name', 'vehicle__make__name', 'vehicle__year')
-        .annotate(count=Count('id'))
-        .order_by('-count')[:10]
-    )
-    # Format vehicle data
-    top_vehicles_formatted = [
-        {
-            'id': v['vehicle__id'],
-            'name': f"{v['vehicle__make__name']} {v['vehicle__model__name']} ({v['vehicle__year']})",
-            'impressions': v['count']
-        }
-        for v in top_vehicles
-    ]
 
     # Recent impressions list (last 50)
     recent_impressions = list(
@@ -660,10 +637,10 @@ def impression_stats(request):
         "status": "success",
         "is_admin": is_admin,
         "period_days": days,
-        "total_impressions": total_impressions,
-        "unique_visitors": unique_visitors,
-        "by_city": by_city,
-        "by_date": by_date,
-        "top_vehicles": top_vehicles_formatted,
+        "total_impressions": stats['total_impressions'],
+        "unique_visitors": stats['unique_visitors'],
+        "by_city": stats['by_city'],
+        "by_date": stats['by_date'],
+        "top_vehicles": stats['top_vehicles'],
         "recent_impressions": recent_impressions
     })
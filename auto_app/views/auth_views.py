@@ -5,6 +5,7 @@ from django.contrib.auth import authenticate
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import User
 from auto_app.models import Seller, Role
+from billing.entitlements import entitlement
 import re
 
 
@@ -37,7 +38,7 @@ class LoginView(APIView):
                 'is_cms_user': seller.is_cms_user if seller else False,
                 'is_superuser': user.is_superuser,
                 'has_seller': seller is not None,
-                'has_subscription': seller.has_active_subscription() if seller else False,
+                'has_subscription': seller is not None and entitlement(user) is not None,
             }
 
             if seller:
@@ -50,11 +51,11 @@ class LoginView(APIView):
                 user_data['photo'] = seller.photo.url if seller.photo else None
                 user_data['recovery_email'] = seller.recovery_email
                 # Include subscription info
-                active_sub = seller.get_active_subscription()
+                active_sub = entitlement(user)
                 if active_sub:
                     user_data['subscription'] = {
-                        'id': active_sub.id,
-                        'plan': active_sub.plan.name,
+                        'id': active_sub.subscription_id,
+                        'plan': active_sub.plan,
                         'status': active_sub.status,
                         'activated': str(active_sub.activated) if active_sub.activated else None,
                     }
@@ -108,7 +109,7 @@ class CurrentUserView(APIView):
             'is_cms_user': seller.is_cms_user if seller else False,
             'is_superuser': user.is_superuser,
             'has_seller': seller is not None,
-            'has_subscription': seller.has_active_subscription() if seller else False,
+            'has_subscription': seller is not None and entitlement(user) is not None,
         }
 
         if seller:
@@ -121,11 +122,11 @@ class CurrentUserView(APIView):
             user_data['photo'] = seller.photo.url if seller.photo else None
             user_data['recovery_email'] = seller.recovery_email
             # Include subscription info
-            active_sub = seller.get_active_subscription()
+            active_sub = entitlement(user)
             if active_sub:
                 user_data['subscription'] = {
-                    'id': active_sub.id,
-                    'plan': active_sub.plan.name,
+                    'id': active_sub.subscription_id,
+                    'plan': active_sub.plan,
                     'status': active_sub.status,
                     'activated': str(active_sub.activated) if active_sub.activated else None,
                 }
@@ -1,13 +1,16 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.apps import apps
+from django.conf import settings
 from django.db import models
 from django.core.paginator import Paginator
 from auto_app.cms_forms import JSONToModelParser
+from auto_app.utils import metrics, schema
+from auto_app.utils.serial import list_related, list_serializer
 import json
 from auto_app.utils.permissions import (
     ReadPermission, WritePermission, DeletePermission, OwnerPermission,
-    OwnerOrAdminFilterMixin
+    OwnerOrAdminFilterMixin, has_active_subscription
 )
 import datetime
 from auto_app.models import AuditLog, CMSImage
@@ -46,16 +49,18 @@ class CMSListView(OwnerOrAdminFilterMixin, APIView):
                         objects = objects.filter(**{fieldname: value})
         if hasattr(model, 'updated_at'):
             objects = objects.order_by("-updated_at")
+        objects = objects.select_related(*list_related(model))
         paginator = Paginator(objects, self.page_size)
         page = paginator.page(page_no)
-        page.start_index()
 
+        etag = schema.list_etag(model)
         return Response({
-            "schema": model.list_field_schema(),
+            "schema": None if schema.schema_unchanged(request, etag) else schema.list_field_schema(model),
+            "schema_etag": etag,
             "name": model._meta.verbose_name.title(),
-            "data": [e.list_json() for e in page.object_list],
+            "data": list_serializer(model, page.object_list),
             "page": page_no,
-            "count": objects.count(),
+            "count": paginator.count,
             "page_start": page.start_index(),
             "page_end": page.end_index(),
             "page_size": self.page_size,
@@ -69,8 +74,11 @@ class CMSCreateView(APIView):
 
     def get(self, request, entity, format=None):
         model = apps.get_model("auto_app", entity)
-        fields = model.form_fields()
-        return Response(fields)
+        etag = schema.form_etag(model)
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if schema.not_modified(request, etag):
+            return Response(status=304, headers=headers)
+        return Response(schema.form_fields(model), headers=headers)
 
     def post(self, request, entity, format=None):
         model = apps.get_model("auto_app", entity)
@@ -155,9 +163,10 @@ class CMSUpdateView(OwnerOrAdminFilterMixin, APIView):
     permission_classes = [WritePermission, OwnerPermission]
 
     def get(self, request, entity, id, format=None):
-        print(entity)
         model = apps.get_model("auto_app", entity)
-        fields = model.form_fields()
+        etag = schema.form_etag(model)
+        # leave out the schema the client already holds
+        fields = {} if schema.schema_unchanged(request, etag) else schema.form_fields(model)
 
         # Apply owner-based filtering for configured models
         queryset = model.objects.filter(pk=id)
@@ -170,7 +179,7 @@ class CMSUpdateView(OwnerOrAdminFilterMixin, APIView):
             })
         instance = queryset.first()
         data = instance.detail_json()
-        return Response(dict(**fields, data=data, success=True))
+        return Response(dict(**fields, data=data, schema_etag=etag, success=True))
 
     def post(self, request, entity, id, format=None):
         model = apps.get_model("auto_app", entity)
@@ -324,11 +333,27 @@ class CurrentUserRolePermissionsView(APIView):
             "success": True,
             "role": role.role_name,
             "permissions": permissions,
-            "has_active_subscription": seller.has_active_subscription(),
+            "has_active_subscription": has_active_subscription(request.user),
             "is_cms_user": seller.is_cms_user,
         })
 
 
+class RequestMetricsView(APIView):
+    """Per view request metrics, for superusers"""
+    def get(self, request):
+        if not request.user.is_superuser:
+            return Response({
+                "success": False,
+                "error": "Superuser access required"
+            }, status=403)
+
+        return Response({
+            "success": True,
+            "query_budget": getattr(settings, "REQUEST_QUERY_BUDGET", 50),
+            "views": metrics.summary(),
+        })
+
+
 class DashboardAPIView(APIView):
     """Dashboard statistics"""
     def get(self, request):
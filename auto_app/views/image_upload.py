@@ -1,27 +1,54 @@
 from django.http import JsonResponse
-from auto_app.models import VehiclePhoto, Vehicle
-from auto_app.utils import base64_file
+from django.db import transaction
+from auto_app.models import VehiclePhoto, Vehicle, UploadSession
+from auto_app.utils import blobs
+from auto_app.utils.thumbnails import thumbnail_worker
+from auto_app.utils.uploads import (
+    UploadError, append_chunk, max_upload_size, parse_content_range,
+    request_data, resolve_upload, save_images, session_file, streaming_uploads
+)
+from django.conf import settings
 import json
 
+
+def upload_status(session):
+    return {
+        "status": "success",
+        "upload_id": str(session.id),
+        "size": session.size,
+        "offset": session.received,
+        "complete": session.complete,
+    }
+
+
 def upload_vehicle_image(request):
-    """Handle single image upload for a vehicle"""
+    """
+    Handle single image upload for a vehicle.
+    The photo is a multipart file, the upload_id of a completed chunked
+    upload or a base64 data URL.
+    """
     if request.method != "POST":
         return JsonResponse({"status": "error", "message": "Method not allowed"}, status=405)
-    
-    data = json.loads(request.body)
+
+    streaming_uploads(request)
+    data = request_data(request)
 
     vehicle_id = data.get('vehicle_id')
-    image_data = data.get('photo')
-    is_main = data.get('is_main', False)
-    
-    if not image_data or not vehicle_id:
+    is_main = data.get('is_main', False) in (True, 'true', 'True', '1')
+
+    try:
+        photo_file = resolve_upload(request, 'photo', data.get('upload_id') or data.get('photo'))
+    except UploadError as e:
+        return JsonResponse({"status": "error", "message": str(e)}, status=400)
+
+    if not photo_file or not vehicle_id:
         return JsonResponse({"status": "error", "message": "Vehicle ID and image are required"}, status=400)
         
     try:
         vehicle = Vehicle.objects.get(pk=vehicle_id)
         photo = VehiclePhoto.objects.create(
             vehicle=vehicle,
-            photo=base64_file(image_data)[0],
+            photo=photo_file,
             is_main=is_main
         )
         
@@ -35,4 +62,159 @@ def upload_vehicle_image(request):
     except Vehicle.DoesNotExist:
         return JsonResponse({"status": "error", "message": "Vehicle not found"}, status=404)
     except Exception as e:
-        return JsonResponse({"status": "error", "message": str(e)}, status=500)
\ No newline at end of file
+        return JsonResponse({"status": "error", "message": str(e)}, status=500)
+    finally:
+        photo_file.close()
+
+
+def upload_vehicle_images(request):
+    """
+    Upload several photos for a vehicle in one request: multipart ``photos``
+    files and/or the ``upload_ids`` of completed chunked uploads.
+    The files are validated and stored in parallel, the photos created in
+    one insert and their thumbnails rendered by the thumbnail worker's pool.
+    Returns a result per file, in the order sent.
+    """
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": "Method not allowed"}, status=405)
+
+    if request.user.is_anonymous:
+        return JsonResponse({"status": "error", "message": "Not authenticated"}, status=401)
+
+    streaming_uploads(request)
+    data = request_data(request)
+    if request.content_type == 'multipart/form-data':
+        upload_ids = request.POST.getlist('upload_ids')
+    else:
+        upload_ids = data.get('upload_ids') or []
+
+    try:
+        vehicle = Vehicle.objects.get(pk=data.get('vehicle_id'))
+    except (Vehicle.DoesNotExist, ValueError, TypeError):
+        return JsonResponse({"status": "error", "message": "Vehicle not found"}, status=404)
+
+    seller = getattr(request.user, 'seller', None)
+    if vehicle.seller != seller and not request.user.is_superuser:
+        return JsonResponse({
+            "status": "error",
+            "message": "You don't have permission to edit this listing"
+        }, status=403)
+
+    # (name, file or UploadError) in the order sent
+    entries = [(f.name, f) for f in request.FILES.getlist('photos')]
+    for upload_id in upload_ids:
+        try:
+            entries.append((str(upload_id), session_file(request, upload_id)))
+        except UploadError as e:
+            entries.append((str(upload_id), e))
+
+    if not entries:
+        return JsonResponse({"status": "error", "message": "Vehicle ID and images are required"}, status=400)
+    max_files = getattr(settings, 'BULK_UPLOAD_MAX_FILES', 30)
+    if len(entries) > max_files:
+        for _, entry in entries:
+            if not isinstance(entry, UploadError):
+                entry.close()
+        return JsonResponse({"status": "error", "message": f"At most {max_files} photos per request"}, status=400)
+
+    files = [entry for _, entry in entries if not isinstance(entry, UploadError)]
+    try:
+        saved = iter(save_images(VehiclePhoto._meta.get_field('photo'), files))
+    finally:
+        for f in files:
+            f.close()
+
+    results, photos = [], []
+    for name, entry in entries:
+        outcome = entry if isinstance(entry, UploadError) else next(saved)
+        if isinstance(outcome, UploadError):
+            results.append({"name": name, "status": "error", "message": str(outcome)})
+            continue
+        path, width, height = outcome
+        photos.append(VehiclePhoto(
+            vehicle=vehicle, photo=path, width=width, height=height,
+            created_by=request.user, updated_by=request.user,
+        ))
+        results.append({"name": name, "status": "success"})
+
+    VehiclePhoto.objects.bulk_create(photos)
+
+    # bulk_create sends no signals, count the references and queue the
+    # thumbnails here
+    blobs.acquire([photo.photo.name for photo in photos])
+    pks = [photo.pk for photo in photos]
+    transaction.on_commit(lambda: thumbnail_worker.enqueue_many(VehiclePhoto, pks))
+
+    created = iter(photos)
+    for result in results:
+        if result["status"] == "success":
+            photo = next(created)
+            result.update({"id": photo.pk, "photo_url": photo.photo.url})
+
+    return JsonResponse({
+        "status": "success" if photos else "error",
+        "vehicle_id": vehicle.id,
+        "results": results,
+    }, status=200 if photos else 400)
+
+
+def start_upload(request):
+    """Start a resumable chunked upload of ``size`` bytes"""
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": "POST required"}, status=405)
+
+    if request.user.is_anonymous:
+        return JsonResponse({"status": "error", "message": "Not authenticated"}, status=401)
+
+    data = json.loads(request.body or '{}')
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return JsonResponse({"status": "error", "message": "size required"}, status=400)
+    if size <= 0 or size > max_upload_size():
+        return JsonResponse({"status": "error", "message": "File is too large"}, status=413)
+
+    session = UploadSession.objects.create(
+        user=request.user,
+        filename=(data.get('filename') or 'upload')[:255],
+        content_type=(data.get('content_type') or '')[:100],
+        size=size,
+    )
+    return JsonResponse(upload_status(session), status=201)
+
+
+@transaction.non_atomic_requests
+def upload_chunk(request, upload_id):
+    """
+    GET returns the offset to resume an upload from, PUT appends the request
+    body at the offset given by its Content-Range header. A PUT holds the
+    session row's lock from the offset check until the chunk is written, so
+    concurrent retries of the same chunk can't both append it.
+    """
+    if request.user.is_anonymous:
+        return JsonResponse({"status": "error", "message": "Not authenticated"}, status=401)
+    if request.method not in ("GET", "PUT"):
+        return JsonResponse({"status": "error", "message": "PUT required"}, status=405)
+
+    with transaction.atomic():
+        sessions = UploadSession.objects.filter(user=request.user)
+        if request.method == "PUT":
+            sessions = sessions.select_for_update()
+        try:
+            session = sessions.get(pk=upload_id)
+        except UploadSession.DoesNotExist:
+            return JsonResponse({"status": "error", "message": "Upload not found"}, status=404)
+
+        if request.method == "GET":
+            return JsonResponse(upload_status(session))
+
+        try:
+            start, end = parse_content_range(request.headers.get('Content-Range'), session.size)
+            # request is read as a stream, never as request.body
+            append_chunk(session, request, start, end)
+        except UploadError as e:
+            response = upload_status(session)
+            response.update({"status": "error", "message": str(e)})
+            return JsonResponse(response, status=409)
+
+    return JsonResponse(upload_status(session))
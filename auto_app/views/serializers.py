@@ -3,7 +3,7 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.db.models import Count
 from auto_app.serializers import (
-    VehicleSerializer, MakeSerializer, VehiclePhotoSerializer,
+    VehicleSerializer, vehicle_serialization_plan, MakeSerializer, VehiclePhotoSerializer,
     ModelSerializer , SellerSerializer, FAQCategorySerializer,
     CitySerializer
 )
@@ -15,7 +15,7 @@ from auto_app.models import (
 
 
 class VehicleViewSet(viewsets.ModelViewSet):
-    queryset = Vehicle.objects.all()
+    queryset = vehicle_serialization_plan(Vehicle.objects.all())
     serializer_class = VehicleSerializer
 
 
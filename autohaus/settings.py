@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -48,6 +51,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'auto_app.middleware.instrumentation.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.common.CommonMiddleware',
@@ -109,7 +113,7 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'auto_app.utils.authentication.CachedTokenAuthentication',
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
@@ -193,24 +197,171 @@ LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'handlers': {
-        'errors': {
+        # hands records to a background writer, see auto_app.logging
+        'queue': {
+            '()': 'auto_app.logging.queue_handler',
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
-            'filename': 'errors.log',
-            'formatter': 'basic'
         }
     },
-    'formatters': {
-        'basic': {
-            'format': '[{levelname}] {asctime} {message}',
-            'style': '{',
-        },
-    },
     'loggers': {
         'django.request': {
-            'handlers': ['errors'],
+            'handlers': ['queue'],
             'level': 'ERROR',
             'propagate': True,
-        }
+        },
+        'auto_app': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
+        'billing': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
     },
 }
+
+# Vehicle search index (auto_app.utils.search_index)
+SEARCH_INDEX_ENABLED = True
+SEARCH_INDEX_MAX_AGE = 15 * 60  # seconds before a background rebuild
+SEARCH_INDEX_MAX_RESULTS = 900  # broader searches are left to the database
+SEARCH_INDEX_CHANGES_TIMEOUT = 24 * 60 * 60  # seconds other processes can catch up on changes incrementally
+
+# Keyset pagination for vehicle listings (auto_app.utils.pagination)
+LISTING_PAGE_SIZE = 20
+LISTING_MAX_PAGE_SIZE = 100
+CORS_EXPOSE_HEADERS = ["X-Next-Cursor", "X-Previous-Cursor", "ETag"]
+
+# Precomputed related listings (auto_app.utils.similarity)
+RELATED_LISTINGS_TOP_K = 10
+RELATED_LISTINGS_BACKGROUND = True  # refresh in a worker thread rather than on commit
+RELATED_LISTINGS_CHANGES_TIMEOUT = 24 * 60 * 60  # seconds other processes can catch up on changes incrementally
+
+# Per-user recommended listings cache (auto_app.utils.recommendations)
+RECOMMENDATIONS_CACHE_TIMEOUT = 10 * 60
+
+# Impression ingestion queue (auto_app.utils.impressions)
+IMPRESSION_WORKER = True
+IMPRESSION_QUEUE_SIZE = 10000  # records beyond this are spooled to disk
+IMPRESSION_BATCH_SIZE = 500
+IMPRESSION_FLUSH_INTERVAL = 2.0  # seconds
+IMPRESSION_SPOOL_DIR = BASE_DIR / 'spool' / 'impressions'
+IMPRESSION_CLAIM_TIMEOUT = 600  # seconds before a half drained spool file is drained again
+
+# Local IP geolocation (auto_app.utils.geoip), built with
+# manage.py build_geoip_database
+GEOIP_DATABASE = BASE_DIR / 'geoip' / 'ip-ranges.bin'
+GEOIP_CACHE_SIZE = 10000
+# ask ip-api.com about addresses the database misses: None only until the
+# database file is built, True always, False never
+GEOIP_HTTP_FALLBACK = None
+
+# Impression rollups (auto_app.utils.rollups), updated by
+# manage.py rollup_impressions
+IMPRESSION_ROLLUP_BATCH_SIZE = 50000
+# seconds the rollups stay behind now, longer than any impression insert
+# transaction and any clock skew between the app servers
+IMPRESSION_ROLLUP_LAG = 300
+# periods up to this many days count unique visitors exactly on the raw
+# table instead of merging the daily sketches
+IMPRESSION_EXACT_VISITOR_DAYS = 1
+
+# Raw impression retention (auto_app.utils.retention), enforced by
+# manage.py compact_impressions
+IMPRESSION_RETENTION_DAYS = 90
+IMPRESSION_COMPACTION_CHUNK_SIZE = 5000
+IMPRESSION_COMPACTION_MARGIN = 60 * 60  # seconds before the rollup checkpoint rows must be inserted to be deleted
+IMPRESSION_ARCHIVE_DIR = None  # e.g. BASE_DIR / 'archive' / 'impressions'
+
+# Image thumbnails and responsive variants (auto_app.utils.thumbnails)
+THUMBNAIL_BACKGROUND = True
+THUMBNAIL_WORKERS = 2  # worker processes
+IMAGE_VARIANT_WIDTHS = [320, 640, 1024, 1600]
+
+# Resumable chunked photo uploads (auto_app.utils.uploads)
+CHUNKED_UPLOAD_DIR = BASE_DIR / 'spool' / 'uploads'
+CHUNKED_UPLOAD_MAX_SIZE = 50 * 1024 * 1024
+BULK_UPLOAD_MAX_FILES = 30  # photos per request to api/upload-vehicle-images/
+BULK_UPLOAD_WORKERS = 4  # threads validating and storing them
+
+# Content addressed image storage (auto_app.utils.blobs), unreferenced files
+# are removed by manage.py collect_blobs
+BLOB_GC_GRACE = 3600  # seconds a file stays after its last reference goes
+BLOB_GC_BATCH_SIZE = 500
+
+# CDN offload of vehicle photos and thumbnails (auto_app.utils.cdn)
+CDN_OFFLOAD = False
+CDN_BACKEND = 's3'  # or 'filesystem', copying into CDN_LOCAL_DIR
+CDN_BUCKET = 'autohaus-mukuta'
+CDN_REGION = 'af-south-1'
+CDN_PROFILE = 'autohaus'
+CDN_ENDPOINT_URL = None  # an S3 compatible server, e.g. 'http://localhost:9000' for MinIO
+CDN_PUBLIC_URL = 'https://autohaus-mukuta.s3.af-south-1.amazonaws.com'
+CDN_LOCAL_DIR = BASE_DIR / 'cdn'
+CDN_BACKGROUND = True
+CDN_WORKERS = 4  # concurrent uploads
+CDN_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+CDN_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+CDN_MAX_ATTEMPTS = 5
+CDN_RETRY_DELAY = 0.5  # seconds, doubled after each failed attempt
+
+# Media sweeper (auto_app.utils.cleanup), run by manage.py sweep_media
+SWEEP_TEMPORARY_VEHICLE_HOURS = 24
+SWEEP_ORPHAN_PHOTO_HOURS = 24  # CMS photos never attached to a vehicle
+CHUNKED_UPLOAD_EXPIRY_HOURS = 24
+SWEEP_BATCH_SIZE = 500
+SWEEP_WORKERS = 8  # concurrent file deletions
+
+# CMS schema revalidation (auto_app.utils.schema)
+CORS_ALLOW_HEADERS = (*default_headers, "if-none-match", "x-schema-etag")
+
+# Role permissions and subscription entitlements are invalidated through
+# the default cache, so every worker must share it: set CACHE_URL, e.g.
+# redis://localhost:6379/0, when running more than one process. Without it
+# each process has its own cache. The auto_app.E001 check fails on a per
+# process cache when the SHARED_CACHE_REQUIRED environment variable is set.
+CACHE_URL = os.environ.get('CACHE_URL', '')
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+SHARED_CACHE_REQUIRED = os.environ.get('SHARED_CACHE_REQUIRED', '').lower() in ('1', 'true', 'yes')
+
+# CMS role permission cache (auto_app.utils.permissions)
+ROLE_PERMISSION_VERSION_CHECK_INTERVAL = 1.0  # seconds between checks for changes from other processes
+ROLE_PERMISSION_CACHE_TTL = 60  # seconds before cached roles and permissions are reloaded
+
+# Subscription entitlements (billing.entitlements)
+ENTITLEMENT_CACHE_TIMEOUT = 3600  # seconds, shorter when the subscription expires sooner
+ENTITLEMENT_NONE_TIMEOUT = 5  # seconds a user without a subscription is cached for
+
+# Token authentication cache (auto_app.utils.authentication)
+TOKEN_AUTH_CACHE_TTL = 60  # seconds before a cached token is looked up again
+TOKEN_AUTH_CACHE_SIZE = 10000
+TOKEN_AUTH_VERSION_CHECK_INTERVAL = 1.0  # seconds between checks for invalidations from other processes
+
+# Request instrumentation (auto_app.middleware.instrumentation, auto_app.utils.metrics)
+REQUEST_METRICS_ENABLED = True
+REQUEST_QUERY_BUDGET = 50  # queries per request before it is logged
+SLOW_QUERY_MS = 200
+REQUEST_METRICS_DIR = BASE_DIR / 'spool' / 'metrics'
+REQUEST_METRICS_FLUSH_INTERVAL = 30  # seconds between writes of each process's totals
+
+# Structured logging (auto_app.logging)
+LOG_DIR = BASE_DIR / 'logs'  # JSON lines in autohaus.jsonl, rotated
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_CONSOLE = DEBUG
+LOG_QUEUE_SIZE = 10000  # records beyond this are dropped rather than blocking
+LOG_BATCH_SIZE = 500
+LOG_REMOTE_SINK = None  # e.g. {'BACKEND': 'auto_app.logging.CloudWatchSink', 'OPTIONS': {...}}
+LOG_REMOTE_BATCH_SIZE = 500
+LOG_REMOTE_INTERVAL = 5  # seconds
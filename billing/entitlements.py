@@ -0,0 +1,93 @@
+"""
+Resolving what a user's subscription entitles them to.
+
+``entitlement(user)`` returns the user's active subscription, plan and
+expiry as an Entitlement, or None without one. It is looked up once per
+request, kept on the user object, and cached across requests until the
+subscription's ``expires_at`` (at most ``ENTITLEMENT_CACHE_TIMEOUT``
+seconds). Saving or deleting a Subscription drops the user's entry, see
+``auto_app.signals``; the cache must be shared by every worker for that to
+reach them all (see SHARED_CACHE_REQUIRED). Not having a subscription is
+only cached for ``ENTITLEMENT_NONE_TIMEOUT`` seconds, so a user who just
+paid is let in straight away.
+"""
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+
+NONE = 'none'
+
+
+@dataclass(frozen=True)
+class Entitlement:
+    subscription_id: int
+    plan_id: int
+    plan: str
+    status: str
+    activated: date = None
+    expires_at: date = None
+
+
+def cache_key(user_id):
+    return f'entitlement:{user_id}'
+
+
+def timeout(expires_at):
+    """Seconds to cache an entitlement for, up to the end of its expiry day"""
+    limit = getattr(settings, 'ENTITLEMENT_CACHE_TIMEOUT', 3600)
+    if not expires_at:
+        return limit
+    end = timezone.make_aware(datetime.combine(expires_at + timedelta(days=1), time.min))
+    return max(1, min(limit, int((end - timezone.now()).total_seconds())))
+
+
+def load(user_id):
+    from billing.models import Subscription
+
+    subscription = Subscription.objects.filter(user_id=user_id, status='active') \
+        .select_related('plan').first()
+    if subscription is None:
+        return None
+    return Entitlement(
+        subscription_id=subscription.pk,
+        plan_id=subscription.plan_id,
+        plan=subscription.plan.name,
+        status=subscription.status,
+        activated=subscription.activated,
+        expires_at=subscription.expires_at,
+    )
+
+
+def entitlement(user):
+    """The active subscription of ``user``, None without one"""
+    if user is None or user.is_anonymous:
+        return None
+    try:
+        return user._entitlement
+    except AttributeError:
+        pass
+
+    key = cache_key(user.pk)
+    found = cache.get(key)
+    if found is None:
+        found = load(user.pk)
+        if found:
+            cache.set(key, found, timeout(found.expires_at))
+        else:
+            cache.set(key, NONE, getattr(settings, 'ENTITLEMENT_NONE_TIMEOUT', 5))
+    elif found == NONE:
+        found = None
+    user._entitlement = found
+    return found
+
+
+def has_active_subscription(user):
+    return entitlement(user) is not None
+
+
+def invalidate(user_id):
+    cache.delete(cache_key(user_id))